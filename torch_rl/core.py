@@ -70,7 +70,8 @@ class Agent(Module):
             return out
         else:
             x = args[0]
-            x = to_tensor(x, **kwargs)
+            if not tor.is_tensor(x):
+                x = to_tensor(x, **kwargs)
             out = self.forward(x)
             self.out = out
             return out
@@ -143,3 +144,64 @@ class ActorCriticAgent(Agent):
 
 
 
+
+
+
+class InferenceSession(object):
+    """
+        Runs a network for single environment steps without building autograd graphs.
+        Inputs are written into a preallocated tensor, the network runs under
+        torch.inference_mode and the outputs are returned as numpy arrays.
+    """
+
+    def __init__(self, network, batch_size=1):
+        self.network = network
+        self.batch_size = batch_size
+        self.input = None
+        self.noise = None
+
+    def _write(self, *args):
+        """
+        Writes the inputs concatenated along the last axis into the input tensor.
+        """
+        inputs = [np.reshape(x, (self.batch_size, -1)) for x in args]
+        size = sum(x.shape[1] for x in inputs)
+        if self.input is None or self.input.shape[1] != size:
+            device = next(self.network.parameters()).device
+            self.input = tor.zeros((self.batch_size, size), device=device)
+            # Observations are copied from pinned memory if the network is on the GPU
+            self.host_input = self.input if device.type == 'cpu' else tor.zeros((self.batch_size, size)).pin_memory()
+            self.host_array = self.host_input.numpy()
+
+        offset = 0
+        for x in inputs:
+            self.host_array[:, offset:offset + x.shape[1]] = x
+            offset += x.shape[1]
+        if self.input is not self.host_input:
+            self.input.copy_(self.host_input, non_blocking=True)
+        return self.input
+
+    def __call__(self, *args):
+        """
+        :param args: Inputs of the network, concatenated
+        :return: Output of the network
+        """
+        with tor.inference_mode():
+            return self.network.forward(self._write(*args)).cpu().numpy()
+
+    def sample(self, obs):
+        """
+        Samples actions of a Gaussian actor critic network such as ActorCriticPPO.
+        :return: Actions, values and log probabilities of the actions
+        """
+        with tor.inference_mode():
+            x = self._write(obs)
+            means = self.network.policy_mean(x)
+            values = self.network.value_forward(x)
+            if self.noise is None or self.noise.shape != means.shape:
+                self.noise = tor.empty_like(means)
+            noise = self.noise.normal_()
+            std = tor.exp(self.network.siglog)
+            actions = means + std * noise
+            logprobs = -.5 * noise**2 - tor.log(std) - .5 * np.log(2 * np.pi)
+        return actions.cpu().numpy(), values.cpu().numpy(), logprobs.cpu().numpy()
@@ -0,0 +1,281 @@
+import numpy as np
+import multiprocessing as mp
+from multiprocessing import shared_memory, resource_tracker
+from threading import BrokenBarrierError
+
+
+class VecEnv(object):
+    """
+        Steps num_envs environments in lockstep. Observations, rewards and done flags
+        are stacked along the first axis. Environments that are done are reset
+        automatically, the observation returned for them is the first observation
+        of the next episode.
+    """
+
+    def __init__(self, num_envs, observation_space, action_space):
+        self.num_envs = num_envs
+        self.observation_space = observation_space
+        self.action_space = action_space
+
+    def reset(self):
+        raise NotImplementedError()
+
+    def step_async(self, actions):
+        raise NotImplementedError()
+
+    def step_wait(self):
+        raise NotImplementedError()
+
+    def step(self, actions):
+        self.step_async(actions)
+        return self.step_wait()
+
+    def close(self):
+        pass
+
+    def __len__(self):
+        return self.num_envs
+
+
+class DummyVecEnv(VecEnv):
+    """
+        Runs all environments sequentially in the current process.
+    """
+
+    def __init__(self, env_fns):
+        self.envs = [fn() for fn in env_fns]
+        env = self.envs[0]
+        super(DummyVecEnv, self).__init__(len(self.envs), env.observation_space, env.action_space)
+        self.actions = None
+
+    def reset(self):
+        return np.stack([env.reset() for env in self.envs])
+
+    def step_async(self, actions):
+        self.actions = actions
+
+    def step_wait(self):
+        results = [step_and_reset(env, a) for env, a in zip(self.envs, self.actions)]
+        obs, rewards, dones, infos = zip(*results)
+        return np.stack(obs), np.asarray(rewards, dtype=np.float32), np.asarray(dones, dtype=np.bool_), list(infos)
+
+
+def step_and_reset(env, action):
+    obs, reward, done, info = env.step(action)
+    if done:
+        obs = env.reset()
+    return obs, reward, done, info
+
+
+def env_worker(remote, parent_remote, env_fn):
+    parent_remote.close()
+    env = env_fn()
+    try:
+        while True:
+            cmd, data = remote.recv()
+            if cmd == 'step':
+                remote.send(step_and_reset(env, data))
+            elif cmd == 'reset':
+                remote.send(env.reset())
+            elif cmd == 'spaces':
+                remote.send((env.observation_space, env.action_space))
+            elif cmd == 'close':
+                break
+    except KeyboardInterrupt:
+        pass
+    finally:
+        remote.close()
+
+
+class SubprocVecEnv(VecEnv):
+    """
+        Runs every environment in its own process, steps are sent to all
+        processes before waiting for the results.
+    """
+
+    def __init__(self, env_fns, context=None):
+        ctx = mp.get_context(context)
+        self.remotes, work_remotes = zip(*[ctx.Pipe() for _ in env_fns])
+        self.processes = [ctx.Process(target=env_worker, args=(work_remote, remote, fn), daemon=True)
+                          for work_remote, remote, fn in zip(work_remotes, self.remotes, env_fns)]
+        for p in self.processes:
+            p.start()
+        for remote in work_remotes:
+            remote.close()
+
+        self.remotes[0].send(('spaces', None))
+        observation_space, action_space = self.remotes[0].recv()
+        super(SubprocVecEnv, self).__init__(len(env_fns), observation_space, action_space)
+        self.waiting = False
+        self.closed = False
+
+    def reset(self):
+        for remote in self.remotes:
+            remote.send(('reset', None))
+        return np.stack([remote.recv() for remote in self.remotes])
+
+    def step_async(self, actions):
+        for remote, action in zip(self.remotes, actions):
+            remote.send(('step', action))
+        self.waiting = True
+
+    def step_wait(self):
+        results = [remote.recv() for remote in self.remotes]
+        self.waiting = False
+        obs, rewards, dones, infos = zip(*results)
+        return np.stack(obs), np.asarray(rewards, dtype=np.float32), np.asarray(dones, dtype=np.bool_), list(infos)
+
+    def close(self):
+        if self.closed:
+            return
+        if self.waiting:
+            for remote in self.remotes:
+                remote.recv()
+        for remote in self.remotes:
+            remote.send(('close', None))
+        for p in self.processes:
+            p.join()
+        self.closed = True
+
+
+class SharedArrays(object):
+    """
+        Numpy arrays in one shared memory block, workers attach to the block by name.
+    """
+
+    def __init__(self, specs, name=None):
+        self.specs = specs
+        offsets, size = [], 0
+        for _, shape, dtype in specs:
+            # Keep every array aligned to 8 bytes
+            offsets.append(size)
+            size += -(-int(np.prod(shape, dtype=np.int64)) * np.dtype(dtype).itemsize // 8) * 8
+        self.shm = shared_memory.SharedMemory(name=name, create=name is None, size=max(size, 1))
+        if name is not None:
+            # The creating process owns the block, attached processes must not unlink it on exit
+            resource_tracker.unregister(self.shm._name, 'shared_memory')
+        for (key, shape, dtype), offset in zip(specs, offsets):
+            setattr(self, key, np.ndarray(shape, dtype=dtype, buffer=self.shm.buf, offset=offset))
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def close(self, unlink=False):
+        for key, _, _ in self.specs:
+            delattr(self, key)
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+STEP, RESET, CLOSE = 0, 1, 2
+
+
+def shared_env_worker(index, env_fn, remote, command_barrier, result_barrier):
+    env = env_fn()
+    remote.send((env.observation_space, env.action_space))
+    arrays = SharedArrays(*remote.recv())
+    remote.close()
+    try:
+        while True:
+            command_barrier.wait()
+            command = arrays.command[0]
+            if command == STEP:
+                obs, reward, done, _ = step_and_reset(env, arrays.actions[index])
+                arrays.rewards[index] = reward
+                arrays.dones[index] = done
+                arrays.observations[index] = obs
+            elif command == RESET:
+                arrays.observations[index] = env.reset()
+            elif command == CLOSE:
+                break
+            result_barrier.wait()
+    except BrokenBarrierError:
+        pass
+    except:
+        # Let the main process fail instead of waiting for this worker forever
+        command_barrier.abort()
+        result_barrier.abort()
+        raise
+    finally:
+        arrays.close()
+
+
+class SharedMemoryVecEnv(VecEnv):
+    """
+        Runs every environment in its own process. Actions, observations, rewards and
+        done flags are exchanged through arrays in shared memory instead of pickled
+        messages, commands are issued to all workers at once through a barrier. Made for
+        slow simulators such as OpenSim where many environments run on one node.
+        Observations are stored as float32, the info dicts of the environments are not
+        transferred.
+    """
+
+    def __init__(self, env_fns, context=None):
+        ctx = mp.get_context(context)
+        num_envs = len(env_fns)
+        self.command_barrier = ctx.Barrier(num_envs + 1)
+        self.result_barrier = ctx.Barrier(num_envs + 1)
+        remotes, work_remotes = zip(*[ctx.Pipe() for _ in env_fns])
+        self.processes = [ctx.Process(target=shared_env_worker, daemon=True,
+                                      args=(i, fn, work_remote, self.command_barrier, self.result_barrier))
+                          for i, (fn, work_remote) in enumerate(zip(env_fns, work_remotes))]
+        for p in self.processes:
+            p.start()
+        for remote in work_remotes:
+            remote.close()
+
+        observation_space, action_space = [remote.recv() for remote in remotes][0]
+        super(SharedMemoryVecEnv, self).__init__(num_envs, observation_space, action_space)
+
+        action_dtype = getattr(action_space, 'dtype', None) or np.float32
+        specs = [('command', (1,), np.int64),
+                 ('observations', (num_envs,) + observation_space.shape, np.float32),
+                 ('actions', (num_envs,) + action_space.shape, action_dtype),
+                 ('rewards', (num_envs,), np.float32),
+                 ('dones', (num_envs,), np.bool_)]
+        self.arrays = SharedArrays(specs)
+        for remote in remotes:
+            remote.send((specs, self.arrays.name))
+            remote.close()
+        self.closed = False
+
+    def _command(self, command):
+        self.arrays.command[0] = command
+        try:
+            self.command_barrier.wait()
+            if command != CLOSE:
+                self.result_barrier.wait()
+        except BrokenBarrierError:
+            raise RuntimeError("An environment worker failed")
+
+    def reset(self):
+        self._command(RESET)
+        return self.arrays.observations.copy()
+
+    def step_async(self, actions):
+        self.arrays.actions[:] = np.asarray(actions).reshape(self.arrays.actions.shape)
+        self.arrays.command[0] = STEP
+        try:
+            self.command_barrier.wait()
+        except BrokenBarrierError:
+            raise RuntimeError("An environment worker failed")
+
+    def step_wait(self):
+        try:
+            self.result_barrier.wait()
+        except BrokenBarrierError:
+            raise RuntimeError("An environment worker failed")
+        infos = [{} for _ in range(self.num_envs)]
+        return self.arrays.observations.copy(), self.arrays.rewards.copy(), self.arrays.dones.copy(), infos
+
+    def close(self):
+        if self.closed:
+            return
+        if not self.command_barrier.broken:
+            self._command(CLOSE)
+        for p in self.processes:
+            p.join()
+        self.arrays.close(unlink=True)
+        self.closed = True
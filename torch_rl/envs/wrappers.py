@@ -1,7 +1,7 @@
 import gym
 import numpy as np
 from torch_rl.envs.utils import wrapped_by
-from torch_rl.utils import RunningMeanStd
+from torch_rl.utils import RunningMeanStd, DistributedRunningMeanStd
 from gym import spaces
 
 
@@ -143,13 +143,16 @@ class RunningMeanStdNormalize(gym.Wrapper):
     """
         Normalization wrapper by running mean and standard deviation, as done in the OpenAI baselines
         implementation. This wrapper is made only for one environment, not a vector
-        of environments as in the baselines implementation.
+        of environments as in the baselines implementation. With distributed the
+        statistics are shared by all processes of a torch.distributed group, they are
+        merged whenever sync_running_stats is called on the environment.
     """
-    def __init__(self, env, ob=True, ret=True, clipob=10., cliprew=10., gamma=0.99, epsilon=1e-8):
+    def __init__(self, env, ob=True, ret=True, clipob=10., cliprew=10., gamma=0.99, epsilon=1e-8, distributed=False):
         super(RunningMeanStdNormalize, self).__init__(env)
         self.env = env
-        self.ob_rms = RunningMeanStd(shape=()) if ob else None
-        self.ret_rms = RunningMeanStd(shape=()) if ret else None
+        rms_type = DistributedRunningMeanStd if distributed else RunningMeanStd
+        self.ob_rms = rms_type(shape=()) if ob else None
+        self.ret_rms = rms_type(shape=()) if ret else None
         self.clipob = clipob
         self.cliprew = cliprew
         self.ret = np.zeros(1)
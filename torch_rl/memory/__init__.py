@@ -1,3 +1,7 @@
 from torch_rl.memory.core import *
 from torch_rl.memory.hindsight import *
-from torch_rl.memory.sequential import *
\ No newline at end of file
+from torch_rl.memory.sequential import *
+from torch_rl.memory.prioritized import *
+from torch_rl.memory.mapped import *
+from torch_rl.memory.prefetch import *
+from torch_rl.memory.shared import *
\ No newline at end of file
@@ -52,6 +52,15 @@ class RingBuffer(object):
     def last_idx(self):
         return (self.length-1 + self.start)%self.maxlen
 
+    def take(self, idxs):
+        """
+        Batched version of __getitem__, returns the entries at the (logical) indexes
+        idxs stacked into one numpy array. Indexes are not bounds checked.
+        """
+        physical_idxs = (self.start + np.asarray(idxs)) % self.maxlen
+        entries = np.asarray([self.data[i] for i in physical_idxs.ravel()])
+        return entries.reshape(physical_idxs.shape + entries.shape[1:])
+
     def append(self, v):
         if self.length < self.maxlen:
             # We have space, simply increase the length.
@@ -64,6 +73,9 @@ class RingBuffer(object):
             raise RuntimeError()
         self.data[(self.start + self.length - 1) % self.maxlen] = v
 
+    def extend(self, values):
+        for v in values:
+            self.append(v)
 
     def pop(self, size):
         if self.length-size <= 0:
@@ -86,6 +98,92 @@ class RingBuffer(object):
         self.start = 0
         self.length = 0
 
+
+class ArrayRingBuffer(RingBuffer):
+    """
+        Ring buffer that keeps its entries in one preallocated numpy array
+        instead of a list of python objects. The array is allocated when the
+        first value is appended, since only then the shape of an entry is known.
+    """
+
+    def __init__(self, maxlen, dtype=np.float32):
+        self.maxlen = maxlen
+        self.start = 0
+        self.length = 0
+        self.dtype = dtype
+        self.data = None
+
+    def _allocate(self, shape):
+        return np.zeros((self.maxlen,) + shape, dtype=self.dtype)
+
+    def append(self, v):
+        v = np.asarray(v, dtype=self.dtype)
+        if self.data is None:
+            self.data = self._allocate(v.shape)
+        super(ArrayRingBuffer, self).append(v)
+
+    def extend(self, values):
+        """
+        Appends the entries along the first axis of values with one assignment.
+        """
+        values = np.asarray(values, dtype=self.dtype)
+        n = len(values)
+        if n == 0:
+            return
+        if self.data is None:
+            self.data = self._allocate(values.shape[1:])
+
+        # Only the last maxlen entries survive if more are appended than fit
+        end = self.start + self.length
+        if n > self.maxlen:
+            end += n - self.maxlen
+            values = values[-self.maxlen:]
+        self.data[(end + np.arange(len(values))) % self.maxlen] = values
+
+        overflow = max(self.length + n - self.maxlen, 0)
+        self.length = min(self.length + n, self.maxlen)
+        self.start = (self.start + overflow) % self.maxlen
+
+    def take(self, idxs):
+        physical_idxs = (self.start + np.asarray(idxs)) % self.maxlen
+        return self.data[physical_idxs]
+
+    @property
+    def nbytes(self):
+        return 0 if self.data is None else self.data.nbytes
+
+
+class MemmapRingBuffer(ArrayRingBuffer):
+    """
+        Array ring buffer whose array is a np.memmap file, entries are only paged in
+        from disk when they are accessed.
+    """
+
+    def __init__(self, maxlen, filename, dtype=np.float32):
+        super(MemmapRingBuffer, self).__init__(maxlen, dtype=dtype)
+        self.filename = filename
+
+    def _allocate(self, shape, mode='w+'):
+        return np.memmap(self.filename, dtype=self.dtype, mode=mode, shape=(self.maxlen,) + tuple(shape))
+
+    def flush(self):
+        if self.data is not None:
+            self.data.flush()
+
+    def state_dict(self):
+        return {
+            'start': self.start,
+            'length': self.length,
+            'shape': None if self.data is None else list(self.data.shape[1:]),
+        }
+
+    def load_state_dict(self, state):
+        self.start = state['start']
+        self.length = state['length']
+        if state['shape'] is not None:
+            self.data = self._allocate(state['shape'], mode='r+')
+
+
 def zeroed_observation(observation):
     if hasattr(observation, 'shape'):
         return np.zeros(observation.shape)
@@ -113,6 +211,10 @@ class Memory(object):
         self.recent_observations.append(observation)
         self.recent_terminals.append(terminal)
 
+    def append_batch(self, observations, actions, rewards, terminals, training=True):
+        self.recent_observations.extend(observations)
+        self.recent_terminals.extend(terminals)
+
     def get_recent_state(self, current_observation):
         # This code is slightly complicated by the fact that subsequent observations might be
         # from different episodes. We ensure that an experience never spans multiple episodes.
@@ -1,26 +1,58 @@
 from torch_rl.memory.core import *
 
+
+def sample_hindsight_indexes(begins, ends, hindsight_size, num_transitions):
+    """
+    Samples root transitions uniformly over all episodes together with hindsight_size
+    future transitions of the same episode for every root.
+    :param begins: Index of the first transition of every episode
+    :param ends: Index of the terminal transition of every episode
+    :return: Root indexes [num_transitions] and hindsight indexes [num_transitions, hindsight_size]
+    """
+    # Every transition that has at least hindsight_size future transitions is a root
+    num_roots = np.maximum(ends - hindsight_size - begins, 0)
+    cum_roots = np.cumsum(num_roots)
+    assert len(cum_roots) > 0 and cum_roots[-1] > 0, "No episode in memory is long enough for hindsight sampling"
+    samples = np.random.randint(0, cum_roots[-1], size=num_transitions)
+    episode_idxs = np.searchsorted(cum_roots, samples, side='right')
+    root_idxs = begins[episode_idxs] + samples - (cum_roots[episode_idxs] - num_roots[episode_idxs])
+
+    hindsight_idxs = np.random.randint(root_idxs[:, None] + 1, ends[episode_idxs][:, None],
+                                       size=(num_transitions, hindsight_size))
+    return root_idxs, hindsight_idxs
+
+
 class HindsightMemory(Memory):
     """
         Implementation of replay memory for hindsight experience replay with future
-        transition sampling.
+        transition sampling. Only the start and terminal index of every episode is stored,
+        future transitions are drawn when sampling.
     """
 
-    def __init__(self, limit, hindsight_size=8, goal_indices=None, reward_function=lambda observation,goal: 1, **kwargs):
+    def __init__(self, limit, hindsight_size=8, goal_indices=None, reward_function=lambda observation,goal: 1,
+                 contiguous=False, **kwargs):
         super(HindsightMemory, self).__init__(**kwargs)
+        self.limit = limit
+        self.contiguous = contiguous
         self.hindsight_size = hindsight_size
         self.reward_function = reward_function
-        self.hindsight_buffer = RingBuffer(limit)
-        self.goals = RingBuffer(limit)
-        self.actions = RingBuffer(limit)
-        self.rewards = RingBuffer(limit)
-        self.terminals = RingBuffer(limit)
-        self.observations = RingBuffer(limit)
-
-        self.limit = limit
+        self.goals = self._create_buffer('goals', np.float32)
+        self.actions = self._create_buffer('actions', np.float32)
+        self.rewards = self._create_buffer('rewards', np.float32)
+        self.terminals = self._create_buffer('terminals', np.bool_)
+        self.observations = self._create_buffer('observations', np.float32)
+
+        # Episodes as [first index, terminal index], counted over all appended transitions
+        self.episodes = ArrayRingBuffer(limit, dtype=np.int64)
+        self.nb_appended = 0
         self.last_terminal_idx = 0
         self.goal_indices = goal_indices
 
+    def _create_buffer(self, name, dtype):
+        if self.contiguous:
+            return ArrayRingBuffer(self.limit, dtype=dtype)
+        return RingBuffer(self.limit)
+
     def append(self, observation, action, reward, terminal, goal=None, training=True):
         if training:
             self.observations.append(observation)
@@ -30,74 +62,78 @@ class HindsightMemory(Memory):
             if goal is None:
                 goal = observation[self.goal_indices]
             self.goals.append(goal)
+            self.nb_appended += 1
             if terminal:
-                """
-                Sample hindsight_size of states added from recent terminal state to this one.
-                """
                 self.add_hindsight()
-                self.last_terminal_idx = self.goals.last_idx
 
             super(HindsightMemory, self).append(observation, action, reward, terminal, training=True)
 
+    def append_goal(self, observation, goal, action, reward, terminal, training=True):
+        self.append(observation, action, reward, terminal, goal=goal, training=training)
+
+    def append_batch(self, observations, actions, rewards, terminals, goals=None, training=True):
+        """
+        Appends the transitions along the first axis of all arguments, contiguous
+        memories write every field with one assignment.
+        """
+        if training:
+            if goals is None:
+                goals = np.asarray(observations)[:, self.goal_indices]
+            self.observations.extend(observations)
+            self.actions.extend(actions)
+            self.rewards.extend(rewards)
+            self.terminals.extend(terminals)
+            self.goals.extend(goals)
+            first_idx = self.nb_appended
+            self.nb_appended += len(observations)
+            for i in np.flatnonzero(terminals):
+                self.add_hindsight(first_idx + i)
+
+            super(HindsightMemory, self).append_batch(observations, actions, rewards, terminals, training=True)
+
     def __getitem__(self, idx):
         if idx < 0 or idx >= self.nb_entries:
             raise KeyError()
         return self.observations[idx], self.goals[idx], self.actions[idx], self.rewards[idx], self.terminals[idx]
 
+    def add_hindsight(self, terminal_idx=None):
+        """
+        Stores the episode that ended with the transition terminal_idx, by default
+        the last appended one.
+        """
+        if terminal_idx is None:
+            terminal_idx = self.nb_appended - 1
+        if terminal_idx - self.hindsight_size > self.last_terminal_idx + 1:
+            self.episodes.append([self.last_terminal_idx + 1, terminal_idx])
+        self.last_terminal_idx = terminal_idx
 
-    def pop(self):
+    def episode_bounds(self):
         """
-        Remove last hindsight_size of elements because they were not
-        used to generate hindsight.
+        First and terminal index of all episodes that are still completely in memory.
         """
-        self.observations.pop(self.hindsight_size)
-        self.actions.pop(self.hindsight_size)
-        self.goals.pop(self.hindsight_size)
-        self.terminals.pop(self.hindsight_size)
-        self.rewards.pop(self.hindsight_size)
-
-    def add_hindsight(self):
-        for i in range(self.last_terminal_idx+1, self.observations.last_idx-self.hindsight_size):
-            # For every state in episode sample hindsight_size from future states
-            # hindsight_idx = sample_batch_indexes(i+1, self.observations.last_idx, self.hindsight_size)
-            hindsight_experience = (self.observations.last_idx - i - 1)*[None]
-            for j,idx in enumerate(range(i+1, self.observations.last_idx)):
-                hindsight_experience[j] = [i,idx]
-            self.hindsight_buffer.append(np.asarray(hindsight_experience))
+        episodes = self.episodes.take(np.arange(len(self.episodes))).reshape(-1, 2)
+        episodes = episodes - (self.nb_appended - self.nb_entries)
+        episodes = episodes[episodes[:, 0] >= 0]
+        return episodes[:, 0], episodes[:, 1]
 
     def sample_and_split(self, num_transitions, batch_idxs=None, split_goal=False):
         batch_size = num_transitions*self.hindsight_size + num_transitions
-        batch_idxs = sample_batch_indexes(0, self.hindsight_buffer.length, size=num_transitions)
-
-        state0_batch = []
-        reward_batch = []
-        goal_batch = []
-        action_batch = []
-        terminal1_batch = []
-        state1_batch = []
-        for idx in batch_idxs:
-            # Add hindsight experience to batch
-            hindsight_idxs = sample_batch_indexes(0, len(self.hindsight_buffer[idx]), self.hindsight_size)
-            for root_idx, hindsight_idx in self.hindsight_buffer[idx][hindsight_idxs]:
-                state0_batch.append(self.observations[hindsight_idx])
-                state1_batch.append(self.observations[hindsight_idx+1])
-                reward_batch.append(1.)
-                action_batch.append(self.actions[hindsight_idx])
-                goal_batch.append(self.observations[hindsight_idx+1] if self.goal_indices is None else \
-                                  self.observations[hindsight_idx+1][self.goal_indices])
-            state0_batch.append(self.observations[root_idx])
-            state1_batch.append(self.observations[root_idx + 1])
-            reward_batch.append(self.rewards[root_idx])
-            action_batch.append(self.actions[root_idx])
-            goal_batch.append(self.goals[root_idx])
-
-        # Prepare and validate parameters.
-        state0_batch = np.array(state0_batch).reshape(batch_size,-1)
-        state1_batch = np.array(state1_batch).reshape(batch_size,-1)
-        terminal1_batch = np.array(terminal1_batch).reshape(batch_size,-1)
-        reward_batch = np.array(reward_batch).reshape(batch_size,-1)
-        action_batch = np.array(action_batch).reshape(batch_size,-1)
-        goal_batch = np.array(goal_batch).reshape(batch_size, -1)
+        root_idxs, hindsight_idxs = sample_hindsight_indexes(*self.episode_bounds(), self.hindsight_size, num_transitions)
+
+        # For every root transition, first its hindsight transitions and then itself
+        idxs = np.hstack((hindsight_idxs, root_idxs[:, None])).ravel()
+        is_root = np.arange(batch_size) % (self.hindsight_size + 1) == self.hindsight_size
+
+        state0_batch = np.asarray(self.observations.take(idxs), dtype=np.float32).reshape(batch_size, -1)
+        state1_batch = np.asarray(self.observations.take(idxs + 1), dtype=np.float32).reshape(batch_size, -1)
+        terminal1_batch = ~self.terminals.take(idxs).astype(bool).reshape(batch_size, -1)
+        action_batch = np.asarray(self.actions.take(idxs), dtype=np.float32).reshape(batch_size, -1)
+
+        # Hindsight transitions achieve the goal they lead to
+        reward_batch = np.ones((batch_size, 1), dtype=np.float32)
+        reward_batch[is_root, 0] = self.rewards.take(root_idxs)
+        goal_batch = state1_batch.copy() if self.goal_indices is None else state1_batch[:, self.goal_indices]
+        goal_batch[is_root] = np.asarray(self.goals.take(root_idxs), dtype=np.float32).reshape(num_transitions, -1)
 
         if split_goal:
             return state0_batch, action_batch, reward_batch, state1_batch, terminal1_batch, goal_batch
@@ -119,17 +155,19 @@ from .sequential import GeneralisedMemory
 class GeneralisedHindsightMemory(GeneralisedMemory):
     """
         Implementation of replay memory for hindsight experience replay with future
-        transition sampling.
+        transition sampling. Only the start and terminal index of every episode is stored,
+        future transitions are drawn when sampling.
     """
 
     def __init__(self, limit, hindsight_size=8, goal_indices=None, reward_function=lambda observation,goal: 1, **kwargs):
         super(GeneralisedHindsightMemory, self).__init__(limit,**kwargs)
         self.hindsight_size = hindsight_size
         self.reward_function = reward_function
-        self.hindsight_buffer = RingBuffer(limit)
-        self.goals = RingBuffer(limit)
+        self.goals = self._create_buffer('goals', np.float32)
 
         self.limit = limit
+        self.episodes = ArrayRingBuffer(limit, dtype=np.int64)
+        self.nb_appended = 0
         self.last_terminal_idx = 0
         self.goal_indices = goal_indices
 
@@ -138,14 +176,25 @@ class GeneralisedHindsightMemory(GeneralisedMemory):
             if goal is None:
                 goal = observation[self.goal_indices]
             self.goals.append(goal)
+            super(GeneralisedHindsightMemory, self).append(observation, action, reward, terminal, extra_info=extra_info, training=True)
+            self.nb_appended += 1
             if terminal:
-                """
-                Sample hindsight_size of states added from recent terminal state to this one.
-                """
                 self.add_hindsight()
-                self.last_terminal_idx = self.goals.last_idx
 
-            super(GeneralisedHindsightMemory, self).append(observation, action, reward, terminal, extra_info=extra_info, training=True)
+    def append_goal(self, observation, goal, action, reward, terminal, extra_info=None, training=True):
+        self.append(observation, action, reward, terminal, extra_info=extra_info, training=training, goal=goal)
+
+    def append_batch(self, observations, actions, rewards, terminals, extra_info, goals=None, training=True):
+        if training:
+            if goals is None:
+                goals = np.asarray(observations)[:, self.goal_indices]
+            self.goals.extend(goals)
+            super(GeneralisedHindsightMemory, self).append_batch(observations, actions, rewards, terminals,
+                                                                 extra_info, training=True)
+            first_idx = self.nb_appended
+            self.nb_appended += len(observations)
+            for i in np.flatnonzero(terminals):
+                self.add_hindsight(first_idx + i)
 
     def __getitem__(self, idx):
         if idx < 0 or idx >= self.nb_entries:
@@ -153,54 +202,48 @@ class GeneralisedHindsightMemory(GeneralisedMemory):
         return self.observations[idx], self.goals[idx], self.actions[idx], self.rewards[idx], self.terminals[idx]
 
 
-    def add_hindsight(self):
-        for i in range(self.last_terminal_idx+1, self.observations.last_idx-self.hindsight_size):
-            # For every state in episode sample hindsight_size from future states
-            # hindsight_idx = sample_batch_indexes(i+1, self.observations.last_idx, self.hindsight_size)
-            hindsight_experience = (self.observations.last_idx - i - 1)*[None]
-            for j,idx in enumerate(range(i+1, self.observations.last_idx)):
-                hindsight_experience[j] = [i,idx]
-            self.hindsight_buffer.append(np.asarray(hindsight_experience))
+    def add_hindsight(self, terminal_idx=None):
+        """
+        Stores the episode that ended with the transition terminal_idx, by default
+        the last appended one.
+        """
+        if terminal_idx is None:
+            terminal_idx = self.nb_appended - 1
+        if terminal_idx - self.hindsight_size > self.last_terminal_idx + 1:
+            self.episodes.append([self.last_terminal_idx + 1, terminal_idx])
+        self.last_terminal_idx = terminal_idx
+
+    def episode_bounds(self):
+        """
+        First and terminal index of all episodes that are still completely in memory.
+        """
+        episodes = self.episodes.take(np.arange(len(self.episodes))).reshape(-1, 2)
+        episodes = episodes - (self.nb_appended - self.nb_entries)
+        episodes = episodes[episodes[:, 0] >= 0]
+        return episodes[:, 0], episodes[:, 1]
 
     def sample_and_split(self, num_transitions, batch_idxs=None, split_goal=False):
         batch_size = num_transitions*self.hindsight_size + num_transitions
-        batch_idxs = sample_batch_indexes(0, self.hindsight_buffer.length, size=num_transitions)
-
-        state0_batch = []
-        reward_batch = []
-        goal_batch = []
-        action_batch = []
-        terminal1_batch = []
-        state1_batch = []
-        extra_info = []
-        for idx in batch_idxs:
-            # Add hindsight experience to batch
-            hindsight_idxs = sample_batch_indexes(0, len(self.hindsight_buffer[idx]), self.hindsight_size)
-            for root_idx, hindsight_idx in self.hindsight_buffer[idx][hindsight_idxs]:
-                state0_batch.append(self.observations[hindsight_idx])
-                state1_batch.append(self.observations[hindsight_idx+1])
-                reward_batch.append(1.)
-                action_batch.append(self.actions[hindsight_idx])
-                goal_batch.append(self.observations[hindsight_idx+1] if self.goal_indices is None else \
-                                  self.observations[hindsight_idx+1][self.goal_indices])
-                extra_info.append(self.extra_info[hindsight_idx])
-            state0_batch.append(self.observations[root_idx])
-            state1_batch.append(self.observations[root_idx + 1])
-            reward_batch.append(self.rewards[root_idx])
-            action_batch.append(self.actions[root_idx])
-            goal_batch.append(self.goals[root_idx])
-            extra_info.append(self.extra_info[root_idx])
-
-        # Prepare and validate parameters.
-        state0_batch = np.array(state0_batch).reshape(batch_size,-1)
-        state1_batch = np.array(state1_batch).reshape(batch_size,-1)
-        terminal1_batch = np.array(terminal1_batch).reshape(batch_size,-1)
-        reward_batch = np.array(reward_batch).reshape(batch_size,-1)
-        action_batch = np.array(action_batch).reshape(batch_size,-1)
-        extra_info_batch = np.array(extra_info).reshape(batch_size,-1)
-        goal_batch = np.array(goal_batch).reshape(batch_size,-1)
+        root_idxs, hindsight_idxs = sample_hindsight_indexes(*self.episode_bounds(), self.hindsight_size, num_transitions)
+
+        # For every root transition, first its hindsight transitions and then itself
+        idxs = np.hstack((hindsight_idxs, root_idxs[:, None])).ravel()
+        is_root = np.arange(batch_size) % (self.hindsight_size + 1) == self.hindsight_size
+
+        state0_batch = np.asarray(self.observations.take(idxs), dtype=np.float32).reshape(batch_size, -1)
+        state1_batch = np.asarray(self.observations.take(idxs + 1), dtype=np.float32).reshape(batch_size, -1)
+        terminal1_batch = ~self.terminals.take(idxs).astype(bool).reshape(batch_size, -1)
+        action_batch = np.asarray(self.actions.take(idxs), dtype=np.float32).reshape(batch_size, -1)
+        extra_info_batch = np.asarray(self.extra_info.take(idxs), dtype=np.float32).reshape(batch_size, -1)
+
+        # Hindsight transitions achieve the goal they lead to
+        reward_batch = np.ones((batch_size, 1), dtype=np.float32)
+        reward_batch[is_root, 0] = self.rewards.take(root_idxs)
+        goal_batch = state1_batch.copy() if self.goal_indices is None else state1_batch[:, self.goal_indices]
+        goal_batch[is_root] = np.asarray(self.goals.take(root_idxs), dtype=np.float32).reshape(num_transitions, -1)
+
         if split_goal:
-            return state0_batch, action_batch, reward_batch, state1_batch, terminal1_batch, extra_info, goal_batch
+            return state0_batch, action_batch, reward_batch, state1_batch, terminal1_batch, extra_info_batch, goal_batch
         else:
             state0_batch[:, self.goal_indices] = goal_batch
             state1_batch[:, self.goal_indices] = goal_batch
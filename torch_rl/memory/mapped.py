@@ -0,0 +1,88 @@
+from torch_rl.memory.core import *
+from torch_rl.memory.sequential import SequentialMemory
+from torch_rl.config import root_path
+import json
+import os
+
+
+class MappedSequentialMemory(SequentialMemory):
+    """
+        Sequential memory whose storage arrays are np.memmap files in directory, by
+        default the replay_memory directory under the root path of the training session.
+        Transitions are paged in from disk on demand when sampling, so the memory can be
+        larger than RAM. The ring buffer state is stored next to the arrays on flush,
+        a memory created on an existing directory resumes with the stored transitions.
+    """
+
+    def __init__(self, limit, directory=None, flush_interval=10000, **kwargs):
+        kwargs.pop('contiguous', None)
+        self.directory = os.path.join(root_path(), 'replay_memory') if directory is None else directory
+        self.flush_interval = flush_interval
+        self.steps_since_flush = 0
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        super(MappedSequentialMemory, self).__init__(limit, contiguous=True, **kwargs)
+
+        if os.path.isfile(self.state_path):
+            self.load()
+
+    def _create_buffer(self, name, dtype):
+        return MemmapRingBuffer(self.limit, os.path.join(self.directory, name + '.dat'), dtype=dtype)
+
+    @property
+    def state_path(self):
+        return os.path.join(self.directory, 'memory.json')
+
+    @property
+    def buffers(self):
+        return {name: buffer for name, buffer in vars(self).items() if isinstance(buffer, MemmapRingBuffer)}
+
+    def _appended(self, n):
+        # Only called once all fields of the transitions are written, goals included
+        self.steps_since_flush += n
+        if self.flush_interval and self.steps_since_flush >= self.flush_interval:
+            self.flush()
+
+    def append(self, observation, action, reward, terminal, training=True):
+        super(MappedSequentialMemory, self).append(observation, action, reward, terminal, training=training)
+        self._appended(1)
+
+    def append_goal(self, observation, goal, action, reward, terminal, training=True):
+        super(MappedSequentialMemory, self).append_goal(observation, goal, action, reward, terminal, training=training)
+        self._appended(1)
+
+    def append_batch(self, observations, actions, rewards, terminals, goals=None, training=True):
+        super(MappedSequentialMemory, self).append_batch(observations, actions, rewards, terminals, goals=goals,
+                                                         training=training)
+        self._appended(len(observations))
+
+    def flush(self):
+        """
+        Writes the arrays to disk and stores the state of the ring buffers.
+        """
+        state = {'limit': self.limit, 'buffers': {}}
+        for name, buffer in self.buffers.items():
+            buffer.flush()
+            state['buffers'][name] = buffer.state_dict()
+
+        # Replace the state file at once, a crash while writing must not corrupt it
+        tmp_path = self.state_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.state_path)
+        self.steps_since_flush = 0
+
+    def load(self):
+        with open(self.state_path) as f:
+            state = json.load(f)
+        assert state['limit'] == self.limit, "Stored memory has a limit of {}".format(state['limit'])
+
+        buffers = self.buffers
+        for name, buffer_state in state['buffers'].items():
+            buffers[name].load_state_dict(buffer_state)
+
+    def get_config(self):
+        config = super(MappedSequentialMemory, self).get_config()
+        config['directory'] = self.directory
+        return config
@@ -0,0 +1,112 @@
+import threading
+from queue import Queue, Empty, Full
+
+import numpy as np
+import torch as tor
+
+
+class BatchPrefetcher(object):
+    """
+        Samples minibatches from a replay memory on a background thread and keeps up
+        to num_batches of them ready as torch tensors on the target device. Host memory
+        is pinned and the copies are issued non-blocking on a separate CUDA stream, so
+        sampling and transfer overlap with the optimization step. Without CUDA the
+        batches stay on the CPU, sampling is still moved off the training loop.
+
+        Floating point arrays of a batch are converted to tensors, other entries such
+        as prioritized replay indexes are passed through unchanged. Everything that
+        modifies the memory while the prefetcher runs has to hold lock.
+    """
+
+    def __init__(self, memory, batch_size, num_batches=4, device=None, lock=None, **sample_kwargs):
+        self.memory = memory
+        self.batch_size = batch_size
+        self.sample_kwargs = sample_kwargs
+        if device is None:
+            device = 'cuda' if tor.cuda.is_available() else 'cpu'
+        self.device = tor.device(device)
+        self.cuda = self.device.type == 'cuda'
+        self.lock = threading.Lock() if lock is None else lock
+        self.batches = Queue(maxsize=num_batches)
+        self.thread = None
+        self.running = False
+        self.error = None
+
+    def start(self):
+        if self.thread is None:
+            self.running = True
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+        return self
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            # Unblock the thread if it waits on a full queue
+            while self.thread.is_alive():
+                try:
+                    self.batches.get(timeout=1e-2)
+                except Empty:
+                    pass
+            self.thread = None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self.next()
+
+    def next(self):
+        """
+        Returns the next ready batch, blocks until one is available.
+        """
+        self.start()
+        while True:
+            try:
+                batch, event = self.batches.get(timeout=1.)
+                break
+            except Empty:
+                if self.error is not None:
+                    raise self.error
+
+        if event is not None:
+            stream = tor.cuda.current_stream(self.device)
+            stream.wait_event(event)
+            for x in batch:
+                if tor.is_tensor(x):
+                    # Memory was allocated on the prefetch stream
+                    x.record_stream(stream)
+        return batch
+
+    def _to_tensor(self, x):
+        if isinstance(x, np.ndarray) and np.issubdtype(x.dtype, np.floating):
+            x = tor.from_numpy(np.ascontiguousarray(x, dtype=np.float32))
+            if self.cuda:
+                x = x.pin_memory().to(self.device, non_blocking=True)
+        return x
+
+    def _run(self):
+        stream = tor.cuda.Stream(self.device) if self.cuda else None
+        try:
+            while self.running:
+                with self.lock:
+                    batch = self.memory.sample_and_split(self.batch_size, **self.sample_kwargs)
+
+                event = None
+                if stream is not None:
+                    with tor.cuda.stream(stream):
+                        batch = tuple(self._to_tensor(x) for x in batch)
+                        event = tor.cuda.Event()
+                        event.record(stream)
+                else:
+                    batch = tuple(self._to_tensor(x) for x in batch)
+
+                while self.running:
+                    try:
+                        self.batches.put((batch, event), timeout=1.)
+                        break
+                    except Full:
+                        pass
+        except Exception as e:
+            self.error = e
+            self.running = False
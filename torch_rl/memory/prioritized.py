@@ -0,0 +1,121 @@
+from torch_rl.memory.core import *
+from torch_rl.memory.sequential import SequentialMemory
+
+
+class SumTree(object):
+    """
+        Array based binary tree in which every inner node holds the sum of its children.
+        Leaves are the priorities, node 1 is the root. Updates and proportional sampling
+        take O(log N) and are vectorized over the whole batch.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.depth = int(np.ceil(np.log2(max(capacity, 2))))
+        self.size = 2**self.depth
+        self.tree = np.zeros(2*self.size, dtype=np.float64)
+
+    @property
+    def total(self):
+        return self.tree[1]
+
+    def __getitem__(self, idxs):
+        return self.tree[self.size + np.asarray(idxs)]
+
+    def update(self, idxs, priorities):
+        nodes = self.size + np.asarray(idxs, dtype=np.int64).ravel()
+        self.tree[nodes] = np.asarray(priorities, dtype=np.float64).ravel()
+        # Recompute the sums level by level, only for the parents of updated leaves
+        for _ in range(self.depth):
+            nodes = np.unique(nodes // 2)
+            self.tree[nodes] = self.tree[2*nodes] + self.tree[2*nodes + 1]
+
+    def find(self, values):
+        """
+        Returns the leaf indexes in which the prefix sums values fall.
+        """
+        values = np.array(values, dtype=np.float64)
+        nodes = np.ones(values.shape, dtype=np.int64)
+        for _ in range(self.depth):
+            left = 2*nodes
+            left_sum = self.tree[left]
+            # Rounding errors must not lead into empty subtrees
+            go_right = (values > left_sum) & (self.tree[left + 1] > 0)
+            values -= left_sum * go_right
+            nodes = left + go_right
+        return nodes - self.size
+
+
+class PrioritizedSequentialMemory(SequentialMemory):
+    """
+        Sequential memory with proportional prioritized sampling as in
+        https://arxiv.org/abs/1511.05952. Priorities are kept per ring buffer slot
+        in a sum tree. sample_and_split additionally returns the importance sampling
+        weights and the slot indexes that are passed back to update_priorities.
+    """
+
+    def __init__(self, limit, alpha=0.6, beta=0.4, beta_increment=0., epsilon=1e-6, **kwargs):
+        super(PrioritizedSequentialMemory, self).__init__(limit, **kwargs)
+        self.alpha = alpha
+        self.beta = beta
+        self.beta_increment = beta_increment
+        self.epsilon = epsilon
+        self.max_priority = 1.
+        self.tree = SumTree(limit)
+
+    def _append(self, observation, action, reward, terminal, training=True):
+        super(PrioritizedSequentialMemory, self)._append(observation, action, reward, terminal, training=training)
+        if training:
+            self._update_last_priorities()
+
+    def _append_batch(self, observations, actions, rewards, terminals, training=True):
+        super(PrioritizedSequentialMemory, self)._append_batch(observations, actions, rewards, terminals, training=training)
+        if training:
+            self._update_last_priorities(len(observations))
+
+    def _update_last_priorities(self, n=1):
+        # The newest n transitions have no follow-up observation yet and can't be sampled, the
+        # ones stride entries before them become available unless they directly follow a reset.
+        start = self.observations.start
+        newest = np.arange(max(self.nb_entries - n, 0), self.nb_entries)
+        self.tree.update((start + newest) % self.limit, np.zeros(len(newest)))
+
+        previous = np.arange(max(self.nb_entries - n - self.stride, 0), max(self.nb_entries - self.stride, 0))
+        if len(previous) > 0:
+            after_terminal = (previous >= self.stride) & \
+                             self.terminals.take(np.maximum(previous - self.stride, 0)).astype(bool)
+            priorities = np.where(after_terminal, 0., self.max_priority**self.alpha)
+            self.tree.update((start + previous) % self.limit, priorities)
+
+    def sample_and_split(self, batch_size, batch_idxs=None):
+        if batch_idxs is None:
+            # Stratified sampling, one value from each of batch_size equal segments
+            segment = self.tree.total / batch_size
+            values = (np.arange(batch_size) + np.random.uniform(size=batch_size)) * segment
+            tree_idxs = self.tree.find(values)
+        else:
+            tree_idxs = (self.observations.start + np.asarray(batch_idxs)) % self.limit
+
+        probabilities = self.tree[tree_idxs] / self.tree.total
+        weights = (max(self.nb_entries - self.stride, 1) * probabilities) ** -self.beta
+        weights = (weights / weights.max()).astype(np.float32).reshape(batch_size, -1)
+        self.beta = min(1., self.beta + self.beta_increment)
+
+        batch_idxs = (tree_idxs - self.observations.start) % self.limit + self.stride
+        return self._split_batch(batch_idxs) + (weights, tree_idxs)
+
+    def update_priorities(self, idxs, td_errors):
+        idxs = np.asarray(idxs).ravel()
+        priorities = np.abs(np.asarray(td_errors, dtype=np.float64)).ravel() + self.epsilon
+        self.max_priority = max(self.max_priority, priorities.max())
+        priorities = priorities**self.alpha
+        # Slot might have been overwritten by one of the newest transitions in the meantime
+        newest = (idxs - self.observations.start) % self.limit >= self.nb_entries - self.stride
+        priorities[newest] = 0.
+        self.tree.update(idxs, priorities)
+
+    def get_config(self):
+        config = super(PrioritizedSequentialMemory, self).get_config()
+        config['alpha'] = self.alpha
+        config['beta'] = self.beta
+        return config
@@ -1,48 +1,66 @@
 from torch_rl.memory.core import *
 
 class SequentialMemory(Memory):
-    def __init__(self, limit, **kwargs):
+    """
+        Replay memory storing transitions in the order in which they were observed.
+        With contiguous=True every field is kept in one preallocated, typed numpy array
+        instead of a list of per-step objects, which reduces the memory footprint of
+        large buffers considerably.
+
+        Transitions of stride environments that are stepped in lockstep can be appended
+        interleaved, the follow-up of the entry at index i is then the entry at i + stride.
+    """
+
+    def __init__(self, limit, contiguous=False, stride=1, **kwargs):
         super(SequentialMemory, self).__init__(**kwargs)
 
         self.limit = limit
+        self.contiguous = contiguous
+        self.stride = stride
 
         # Do not use deque to implement the memory. This data structure may seem convenient but
         # it is way too slow on random access. Instead, we use our own ring buffer implementation.
-        self.actions = RingBuffer(limit)
-        self.rewards = RingBuffer(limit)
-        self.terminals = RingBuffer(limit)
-        self.observations = RingBuffer(limit)
-        self.goals = RingBuffer(limit)
+        self.actions = self._create_buffer('actions', np.float32)
+        self.rewards = self._create_buffer('rewards', np.float32)
+        self.terminals = self._create_buffer('terminals', np.bool_)
+        self.observations = self._create_buffer('observations', np.float32)
+        self.goals = self._create_buffer('goals', np.float32)
+
+    def _create_buffer(self, name, dtype):
+        if self.contiguous:
+            return ArrayRingBuffer(self.limit, dtype=dtype)
+        return RingBuffer(self.limit)
 
     def sample(self, batch_size, batch_idxs=None):
+        stride = self.stride
         if batch_idxs is None:
             # Draw random indexes such that we have at least a single entry before each
             # index.
-            batch_idxs = sample_batch_indexes(0, self.nb_entries - 1, size=batch_size)
-        batch_idxs = np.array(batch_idxs) + 1
-        assert np.min(batch_idxs) >= 1
+            batch_idxs = sample_batch_indexes(0, self.nb_entries - stride, size=batch_size)
+        batch_idxs = np.array(batch_idxs) + stride
+        assert np.min(batch_idxs) >= stride
         assert np.max(batch_idxs) < self.nb_entries
         assert len(batch_idxs) == batch_size
 
         # Create experiences
         experiences = []
         for idx in batch_idxs:
-            terminal0 = self.terminals[idx - 2] if idx >= 2 else False
+            terminal0 = self.terminals[idx - 2*stride] if idx >= 2*stride else False
             while terminal0:
                 # Skip this transition because the environment was reset here. Select a new, random
                 # transition and use this instead. This may cause the batch to contain the same
                 # transition twice.
-                idx = sample_batch_indexes(1, self.nb_entries, size=1)[0]
-                terminal0 = self.terminals[idx - 2] if idx >= 2 else False
-            assert 1 <= idx < self.nb_entries
+                idx = sample_batch_indexes(stride, self.nb_entries, size=1)[0]
+                terminal0 = self.terminals[idx - 2*stride] if idx >= 2*stride else False
+            assert stride <= idx < self.nb_entries
 
             # This code is slightly complicated by the fact that subsequent observations might be
             # from different episodes. We ensure that an experience never spans multiple episodes.
             # This is probably not that important in practice but it seems cleaner.
-            state0 = [self.observations[idx - 1]]
+            state0 = [self.observations[idx - stride]]
             for offset in range(0, self.window_length - 1):
-                current_idx = idx - 2 - offset
-                current_terminal = self.terminals[current_idx - 1] if current_idx - 1 > 0 else False
+                current_idx = idx - (2 + offset) * stride
+                current_terminal = self.terminals[current_idx - stride] if current_idx - stride > 0 else False
                 if current_idx < 0 or (not self.ignore_episode_boundaries and current_terminal):
                     # The previously handled observation was terminal, don't add the current one.
                     # Otherwise we would leak into a different episode.
@@ -50,10 +68,10 @@ class SequentialMemory(Memory):
                 state0.insert(0, self.observations[current_idx])
             while len(state0) < self.window_length:
                 state0.insert(0, zeroed_observation(state0[0]))
-            action = self.actions[idx - 1]
-            reward = self.rewards[idx - 1]
-            terminal1 = self.terminals[idx - 1]
-            goal = self.goals[idx - 1] if self.goals.length > 0 else None
+            action = self.actions[idx - stride]
+            reward = self.rewards[idx - stride]
+            terminal1 = self.terminals[idx - stride]
+            goal = self.goals[idx - stride] if self.goals.length > 0 else None
 
             # Okay, now we need to create the follow-up state. This is state0 shifted on timestep
             # to the right. Again, we need to be careful to not include an observation from the next
@@ -68,31 +86,77 @@ class SequentialMemory(Memory):
         assert len(experiences) == batch_size
         return experiences
 
+    def _sample_batch_idxs(self, batch_size, batch_idxs=None):
+        """
+        Vectorized version of the index handling in sample. Returns the indexes of the
+        follow-up observations, transitions directly after a reset are redrawn.
+        """
+        if batch_idxs is None:
+            # Draw random indexes such that we have at least a single entry before each
+            # index.
+            batch_idxs = sample_batch_indexes(0, self.nb_entries - self.stride, size=batch_size)
+        batch_idxs = np.array(batch_idxs) + self.stride
+        assert np.min(batch_idxs) >= self.stride
+        assert np.max(batch_idxs) < self.nb_entries
+        assert len(batch_idxs) == batch_size
+
+        # Skip transitions because the environment was reset there and redraw only those,
+        # the same transition may occur twice in the batch.
+        resample = self._after_terminal(batch_idxs)
+        while np.any(resample):
+            redrawn_idxs = np.random.randint(self.stride, self.nb_entries, size=np.sum(resample))
+            batch_idxs[resample] = redrawn_idxs
+            resample[resample] = self._after_terminal(redrawn_idxs)
+        return batch_idxs
+
+    def _after_terminal(self, batch_idxs):
+        before = batch_idxs - 2*self.stride
+        return (before >= 0) & self.terminals.take(np.maximum(before, 0)).astype(bool)
+
+    def _sample_states(self, batch_idxs):
+        """
+        Gathers the stacked windows state0 and state1 for all indexes at once, the
+        same way sample does for every index separately.
+        """
+        batch_size = len(batch_idxs)
+        # Column k holds the observation k steps before idx - 1, window is stored oldest first
+        offsets = np.arange(self.window_length)
+        obs_idxs = batch_idxs[:, None] - (1 + offsets[None, :]) * self.stride
+
+        # An observation is only part of the window if none of the newer ones crosses
+        # an episode boundary, otherwise we would leak into a different episode.
+        prev_idxs = obs_idxs[:, 1:] - self.stride
+        crossed = obs_idxs[:, 1:] < 0
+        if not self.ignore_episode_boundaries:
+            crossed |= (prev_idxs > 0) & self.terminals.take(np.maximum(prev_idxs, 0)).astype(bool)
+        in_window = np.hstack((np.ones((batch_size, 1), dtype=bool), np.cumprod(~crossed, axis=1).astype(bool)))
+
+        state0 = np.asarray(self.observations.take(np.maximum(obs_idxs, 0)), dtype=np.float32)
+        state0[~in_window] = 0.
+        state0 = state0[:, ::-1]
+
+        next_observations = np.asarray(self.observations.take(batch_idxs), dtype=np.float32)
+        state1 = np.concatenate((state0[:, 1:], next_observations[:, None]), axis=1)
+        return state0, state1
+
     def sample_and_split(self, batch_size, batch_idxs=None):
-        experiences = self.sample(batch_size, batch_idxs)
-
-        state0_batch = []
-        goal_batch = []
-        reward_batch = []
-        action_batch = []
-        terminal1_batch = []
-        state1_batch = []
-        for e in experiences:
-            state0_batch.append(e.state0)
-            state1_batch.append(e.state1)
-            reward_batch.append(e.reward)
-            action_batch.append(e.action)
-            goal_batch.append(e.goal)
-            terminal1_batch.append(0. if e.terminal1 else 1.)
+        batch_idxs = self._sample_batch_idxs(batch_size, batch_idxs)
+        return self._split_batch(batch_idxs)
+
+    def _split_batch(self, batch_idxs):
+        batch_size = len(batch_idxs)
+        state0_batch, state1_batch = self._sample_states(batch_idxs)
 
         # Prepare and validate parameters.
-        state0_batch = np.array(state0_batch, dtype=np.float32).reshape(batch_size, -1)
-        state1_batch = np.array(state1_batch, dtype=np.float32).reshape(batch_size, -1)
-        terminal1_batch = np.array(terminal1_batch, dtype=np.bool).reshape(batch_size, -1)
-        reward_batch = np.array(reward_batch, dtype=np.float32).reshape(batch_size, -1)
-        action_batch = np.array(action_batch, dtype=np.float32).reshape(batch_size, -1)
+        state0_batch = state0_batch.reshape(batch_size, -1)
+        state1_batch = state1_batch.reshape(batch_size, -1)
+        idxs = batch_idxs - self.stride
+        terminal1_batch = ~self.terminals.take(idxs).astype(bool).reshape(batch_size, -1)
+        reward_batch = np.asarray(self.rewards.take(idxs), dtype=np.float32).reshape(batch_size, -1)
+        action_batch = np.asarray(self.actions.take(idxs), dtype=np.float32).reshape(batch_size, -1)
 
         if self.goals.length > 0:
+            goal_batch = np.asarray(self.goals.take(idxs), dtype=np.float32).reshape(batch_size, -1)
             return state0_batch, goal_batch, action_batch, reward_batch, state1_batch, terminal1_batch
         else:
             return state0_batch, action_batch, reward_batch, state1_batch, terminal1_batch
@@ -108,16 +172,31 @@ class SequentialMemory(Memory):
             self.rewards.append(reward)
             self.terminals.append(terminal)
 
-    def _appendg(self, observation, goal, action, reward, terminal, training=True):
+    def _append_batch(self, observations, actions, rewards, terminals, training=True):
+        super(SequentialMemory, self).append_batch(observations, actions, rewards, terminals, training=training)
+
+        if training:
+            self.observations.extend(observations)
+            self.actions.extend(actions)
+            self.rewards.extend(rewards)
+            self.terminals.extend(terminals)
+
+    def append(self, observation, action, reward, terminal, training=True):
+        self._append(observation, action, reward, terminal, training=training)
+
+    def append_goal(self, observation, goal, action, reward, terminal, training=True):
         self._append(observation, action, reward, terminal, training=training)
         if training:
             self.goals.append(goal)
 
-    def append(self, *args, **kwargs):
-        try:
-            self._appendg(*args, **kwargs)
-        except Exception as e:
-            self._append(*args, **kwargs)
+    def append_batch(self, observations, actions, rewards, terminals, goals=None, training=True):
+        """
+        Appends the transitions along the first axis of all arguments, contiguous
+        memories write every field with one assignment.
+        """
+        self._append_batch(observations, actions, rewards, terminals, training=training)
+        if training and goals is not None:
+            self.goals.extend(goals)
 
     @property
     def nb_entries(self):
@@ -126,6 +205,8 @@ class SequentialMemory(Memory):
     def get_config(self):
         config = super(SequentialMemory, self).get_config()
         config['limit'] = self.limit
+        config['contiguous'] = self.contiguous
+        config['stride'] = self.stride
         return config
 
 
@@ -136,38 +217,39 @@ class GeneralisedMemory(SequentialMemory):
 
     def __init__(self, limit,**kwargs):
         super(GeneralisedMemory, self).__init__(limit, **kwargs)
-        self.extra_info = RingBuffer(limit)
+        self.extra_info = self._create_buffer('extra_info', np.float32)
         self.limit = limit
 
     def sample(self, batch_size, batch_idxs=None):
+        stride = self.stride
         if batch_idxs is None:
             # Draw random indexes such that we have at least a single entry before each
             # index.
-            batch_idxs = sample_batch_indexes(0, self.nb_entries - 1, size=batch_size)
-        batch_idxs = np.array(batch_idxs) + 1
-        assert np.min(batch_idxs) >= 1
+            batch_idxs = sample_batch_indexes(0, self.nb_entries - stride, size=batch_size)
+        batch_idxs = np.array(batch_idxs) + stride
+        assert np.min(batch_idxs) >= stride
         assert np.max(batch_idxs) < self.nb_entries
         assert len(batch_idxs) == batch_size
 
         # Create experiences
         experiences = []
         for idx in batch_idxs:
-            terminal0 = self.terminals[idx - 2] if idx >= 2 else False
+            terminal0 = self.terminals[idx - 2*stride] if idx >= 2*stride else False
             while terminal0:
                 # Skip this transition because the environment was reset here. Select a new, random
                 # transition and use this instead. This may cause the batch to contain the same
                 # transition twice.
-                idx = sample_batch_indexes(1, self.nb_entries, size=1)[0]
-                terminal0 = self.terminals[idx - 2] if idx >= 2 else False
-            assert 1 <= idx < self.nb_entries
+                idx = sample_batch_indexes(stride, self.nb_entries, size=1)[0]
+                terminal0 = self.terminals[idx - 2*stride] if idx >= 2*stride else False
+            assert stride <= idx < self.nb_entries
 
             # This code is slightly complicated by the fact that subsequent observations might be
             # from different episodes. We ensure that an experience never spans multiple episodes.
             # This is probably not that important in practice but it seems cleaner.
-            state0 = [self.observations[idx - 1]]
+            state0 = [self.observations[idx - stride]]
             for offset in range(0, self.window_length - 1):
-                current_idx = idx - 2 - offset
-                current_terminal = self.terminals[current_idx - 1] if current_idx - 1 > 0 else False
+                current_idx = idx - (2 + offset) * stride
+                current_terminal = self.terminals[current_idx - stride] if current_idx - stride > 0 else False
                 if current_idx < 0 or (not self.ignore_episode_boundaries and current_terminal):
                     # The previously handled observation was terminal, don't add the current one.
                     # Otherwise we would leak into a different episode.
@@ -175,10 +257,10 @@ class GeneralisedMemory(SequentialMemory):
                 state0.insert(0, self.observations[current_idx])
             while len(state0) < self.window_length:
                 state0.insert(0, zeroed_observation(state0[0]))
-            action = self.actions[idx - 1]
-            reward = self.rewards[idx - 1]
-            terminal1 = self.terminals[idx - 1]
-            goal = self.goals[idx - 1] if self.goals.length > 0 else None
+            action = self.actions[idx - stride]
+            reward = self.rewards[idx - stride]
+            terminal1 = self.terminals[idx - stride]
+            goal = self.goals[idx - stride] if self.goals.length > 0 else None
 
             # Okay, now we need to create the follow-up state. This is state0 shifted on timestep
             # to the right. Again, we need to be careful to not include an observation from the next
@@ -203,36 +285,33 @@ class GeneralisedMemory(SequentialMemory):
             if training:
                 self.extra_info.append(extra_info)
 
+    def append_goal(self, observation, goal, action, reward, terminal, extra_info, training=True):
+        super(GeneralisedMemory, self).append_goal(observation, goal, action, reward, terminal, training=training)
+        if training:
+            self.extra_info.append(extra_info)
+
+    def append_batch(self, observations, actions, rewards, terminals, extra_info, goals=None, training=True):
+        super(GeneralisedMemory, self).append_batch(observations, actions, rewards, terminals, goals=goals, training=training)
+        if training:
+            self.extra_info.extend(extra_info)
 
 
-    def sample_and_split(self, batch_size, batch_idxs=None):
-        experiences = self.sample(batch_size, batch_idxs)
-
-        state0_batch = []
-        goal_batch = []
-        reward_batch = []
-        action_batch = []
-        terminal1_batch = []
-        state1_batch = []
-        extra_info = []
-        for e in experiences:
-            state0_batch.append(e[0])
-            reward_batch.append(e[2])
-            action_batch.append(e[1])
-            state1_batch.append(e[3])
-            terminal1_batch.append(0. if e[4] else 1.)
-            extra_info.append(e[-1])
+
+    def _split_batch(self, batch_idxs):
+        batch_size = len(batch_idxs)
+        state0_batch, state1_batch = self._sample_states(batch_idxs)
 
         # Prepare and validate parameters.
-        state0_batch = np.array(state0_batch).reshape(batch_size, -1)
-        state1_batch = np.array(state1_batch).reshape(batch_size, -1)
-        terminal1_batch = np.array(terminal1_batch).reshape(batch_size, -1)
-        reward_batch = np.array(reward_batch).reshape(batch_size, -1)
-        action_batch = np.array(action_batch).reshape(batch_size, -1)
-        extra_info_batch = np.array(extra_info).reshape(batch_size, -1)
+        state0_batch = state0_batch.reshape(batch_size, -1)
+        state1_batch = state1_batch.reshape(batch_size, -1)
+        idxs = batch_idxs - self.stride
+        terminal1_batch = (~self.terminals.take(idxs).astype(bool)).astype(np.float32).reshape(batch_size, -1)
+        reward_batch = np.asarray(self.rewards.take(idxs), dtype=np.float32).reshape(batch_size, -1)
+        action_batch = np.asarray(self.actions.take(idxs), dtype=np.float32).reshape(batch_size, -1)
+        extra_info_batch = np.asarray(self.extra_info.take(batch_idxs), dtype=np.float32).reshape(batch_size, -1)
 
         if self.goals.length > 0:
+            goal_batch = np.asarray(self.goals.take(idxs), dtype=np.float32).reshape(batch_size, -1)
             return state0_batch, goal_batch, action_batch, reward_batch, state1_batch, terminal1_batch
         else:
             return state0_batch, action_batch, reward_batch, state1_batch, terminal1_batch, extra_info_batch
-
@@ -0,0 +1,172 @@
+from torch_rl.memory.core import *
+from torch_rl.memory.sequential import SequentialMemory
+from torch_rl.envs.vec_env import SharedArrays
+import os
+
+
+class SharedRingBuffer(ArrayRingBuffer):
+    """
+        Array ring buffer on an array in shared memory. Start and length follow the
+        number of appended entries count, which the owning memory publishes to and
+        reads from shared memory, so all buffers of a memory see the same entries.
+    """
+
+    def __init__(self, data):
+        self.maxlen = len(data)
+        self.dtype = data.dtype
+        self.data = data
+        self.count = 0
+
+    @property
+    def length(self):
+        return min(self.count, self.maxlen)
+
+    @property
+    def start(self):
+        return max(self.count - self.maxlen, 0) % self.maxlen
+
+    def append(self, v):
+        self.data[self.count % self.maxlen] = v
+        self.count += 1
+
+    def extend(self, values):
+        values = np.asarray(values, dtype=self.dtype)
+        n = len(values)
+        # Only the last maxlen entries survive if more are appended than fit
+        first = self.count + max(n - self.maxlen, 0)
+        values = values[-self.maxlen:]
+        self.data[(first + np.arange(len(values))) % self.maxlen] = values
+        self.count += n
+
+
+class SharedRegionMemory(SequentialMemory):
+    """
+        Sequential memory on the region of one actor in the arrays of a SharedReplayMemory.
+        Only the actor appends to the region, the number of appended transitions is
+        published after all fields of a transition are written. Goals are not shared,
+        appending them raises.
+    """
+
+    def __init__(self, arrays, index, **kwargs):
+        self.arrays = arrays
+        self.index = index
+        super(SharedRegionMemory, self).__init__(arrays.observations.shape[1], contiguous=True, **kwargs)
+
+    def _create_buffer(self, name, dtype):
+        return SharedRingBuffer(getattr(self.arrays, name)[self.index]) if hasattr(self.arrays, name) else \
+            ArrayRingBuffer(self.limit, dtype=dtype)
+
+    @property
+    def buffers(self):
+        return [buffer for buffer in vars(self).values() if isinstance(buffer, SharedRingBuffer)]
+
+    def _append(self, observation, action, reward, terminal, training=True):
+        super(SharedRegionMemory, self)._append(observation, action, reward, terminal, training=training)
+        self.publish()
+
+    def _append_batch(self, observations, actions, rewards, terminals, training=True):
+        super(SharedRegionMemory, self)._append_batch(observations, actions, rewards, terminals, training=training)
+        self.publish()
+
+    def append_goal(self, observation, goal, action, reward, terminal, training=True):
+        raise NotImplementedError("Goals are not stored in shared memory")
+
+    def append_batch(self, observations, actions, rewards, terminals, goals=None, training=True):
+        if goals is not None:
+            raise NotImplementedError("Goals are not stored in shared memory")
+        super(SharedRegionMemory, self).append_batch(observations, actions, rewards, terminals, training=training)
+
+    def publish(self):
+        self.arrays.counts[self.index] = self.observations.count
+
+    def refresh(self):
+        """
+        Reads the number of transitions the actor appended so far.
+        """
+        count = int(self.arrays.counts[self.index])
+        for buffer in self.buffers:
+            buffer.count = count
+
+
+class SharedReplayMemory(object):
+    """
+        Replay memory in shared memory that is written by num_actors actor processes
+        and sampled by one learner. Every actor appends into its own region of
+        limit // num_actors transitions through region(index), so appends need no
+        locking and no transition is pickled. The learner samples from all regions
+        in proportion to the number of transitions they hold.
+
+        The memory can be passed to processes, which attach to the shared arrays by
+        name. The regions are ring buffers, a transition that is overwritten by its
+        actor while it is sampled might be mixed with the new one, as in Ape-X this is
+        considered negligible for large memories.
+    """
+
+    def __init__(self, limit, observation_shape, action_shape, num_actors, window_length=1,
+                 ignore_episode_boundaries=False):
+        self.limit = limit
+        self.num_actors = num_actors
+        self.window_length = window_length
+        self.ignore_episode_boundaries = ignore_episode_boundaries
+        region_limit = limit // num_actors
+        self.specs = [('counts', (num_actors,), np.int64),
+                      ('observations', (num_actors, region_limit) + tuple(observation_shape), np.float32),
+                      ('actions', (num_actors, region_limit) + tuple(action_shape), np.float32),
+                      ('rewards', (num_actors, region_limit), np.float32),
+                      ('terminals', (num_actors, region_limit), np.bool_)]
+        self._attach(SharedArrays(self.specs))
+        # Only the creating process unlinks the arrays, forked processes inherit this object
+        self.owner_pid = os.getpid()
+
+    def _attach(self, arrays):
+        self.arrays = arrays
+        self.regions = [SharedRegionMemory(arrays, i, window_length=self.window_length,
+                                           ignore_episode_boundaries=self.ignore_episode_boundaries)
+                        for i in range(self.num_actors)]
+
+    def __getstate__(self):
+        state = {k: v for k, v in self.__dict__.items() if k not in ('arrays', 'regions')}
+        state['name'] = self.arrays.name
+        return state
+
+    def __setstate__(self, state):
+        name = state.pop('name')
+        self.__dict__.update(state)
+        self._attach(SharedArrays(self.specs, name=name))
+
+    def region(self, index):
+        """
+        :return: Memory of actor index, its append methods write into shared memory
+        """
+        return self.regions[index]
+
+    def refresh(self):
+        for region in self.regions:
+            region.refresh()
+
+    @property
+    def nb_entries(self):
+        return int(np.minimum(self.arrays.counts, self.arrays.observations.shape[1]).sum())
+
+    def sample_and_split(self, batch_size, batch_idxs=None):
+        assert batch_idxs is None, "Indexes of a shared memory change with every append"
+        self.refresh()
+        # Transitions need their follow-up observation
+        available = np.array([max(region.nb_entries - 1, 0) for region in self.regions], dtype=np.float64)
+        assert available.sum() > 0, "No transitions in memory"
+        sizes = np.random.multinomial(batch_size, available / available.sum())
+
+        batches = [region.sample_and_split(size) for region, size in zip(self.regions, sizes) if size > 0]
+        return tuple(np.concatenate(fields) for fields in zip(*batches))
+
+    def close(self):
+        self.regions = []
+        self.arrays.close(unlink=os.getpid() == self.owner_pid)
+
+    def get_config(self):
+        return {
+            'limit': self.limit,
+            'num_actors': self.num_actors,
+            'window_length': self.window_length,
+            'ignore_episode_boundaries': self.ignore_episode_boundaries,
+        }
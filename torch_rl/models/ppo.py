@@ -2,6 +2,7 @@ from torch_rl.models.core import NeuralNet, StochasticContinuousNeuralNet
 from torch_rl.utils import gauss_weights_init
 from torch import nn
 from torch.distributions import Normal
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
 import numpy as np
 from torch_rl.utils import to_tensor, cuda_if_available
 import torch as tor
@@ -70,6 +71,7 @@ class PPONetwork(StochasticContinuousNeuralNet):
 #Abbr.
 class ActorCriticPPO(StochasticContinuousNeuralNet):
 
+    recurrent = False
 
     def __init__(self, architecture, weight_init=gauss_weights_init(0,0.02),activation_functions=None):
         super(ActorCriticPPO, self).__init__()
@@ -100,7 +102,7 @@ class ActorCriticPPO(StochasticContinuousNeuralNet):
         self.apply(weight_init)
 
 
-    def policy_forward(self, x):
+    def policy_mean(self, x):
 
         # Policy network
 
@@ -113,7 +115,11 @@ class ActorCriticPPO(StochasticContinuousNeuralNet):
 
         x = self.layer_list[-1](x)
 
-        self._means = self.tanh(x)
+        return self.tanh(x)
+
+    def policy_forward(self, x):
+
+        self._means = self.policy_mean(x)
         self._dist = Normal(self._means, tor.exp(self.siglog))
 
         self.sampled = self._dist.rsample()
@@ -171,6 +177,7 @@ class ActorCriticPPO(StochasticContinuousNeuralNet):
 
 class RecurrentActorCriticPPO(StochasticContinuousNeuralNet):
 
+    recurrent = True
 
     def __init__(self, architecture, num_grus=2, weight_init=gauss_weights_init(0,0.02),activation_functions=None):
         """ 
@@ -190,6 +197,9 @@ class RecurrentActorCriticPPO(StochasticContinuousNeuralNet):
 
         self.value_gru = nn.GRU(input_size=gru_size, hidden_size=gru_size, num_layers=num_grus,batch_first=True)
         self.policy_gru = nn.GRU(input_size=gru_size, hidden_size=gru_size, num_layers=num_grus,batch_first=True)
+        # Hidden states carried over between calls with use_last_state
+        self.lh_pol = None
+        self.lh_val = None
 
         self.siglog = tor.zeros(1, requires_grad=True)
 
@@ -212,13 +222,24 @@ class RecurrentActorCriticPPO(StochasticContinuousNeuralNet):
         self.apply(weight_init)
 
 
-    def policy_forward(self, x):
+    @staticmethod
+    def recurrent_forward(gru, x, h0=None, lengths=None):
+        """
+        Runs gru over the sequences x [B, L, D], sequences shorter than L are packed
+        so that the last hidden state is the one after their last valid step.
+        """
+        if lengths is None:
+            return gru(x, h0)
+        packed = pack_padded_sequence(x, tor.as_tensor(lengths).cpu(), batch_first=True, enforce_sorted=False)
+        out, h_n = gru(packed, h0)
+        out, _ = pad_packed_sequence(out, batch_first=True, total_length=x.shape[1])
+        return out, h_n
+
+    def policy_forward(self, x, h0=None, lengths=None):
 
         # Policy network
 
-        x, h_n = self.policy_gru(x)
-        x = x[:, -1, :].squeeze()
-        print(x.shape)
+        x, self.h_pol = self.recurrent_forward(self.policy_gru, x, h0, lengths)
 
         if self.activation_functions:
             for i, func in enumerate(self.activation_functions):
@@ -240,11 +261,9 @@ class RecurrentActorCriticPPO(StochasticContinuousNeuralNet):
     def mu(self):
         return self.means
 
-    def value_forward(self, x):
+    def value_forward(self, x, h0=None, lengths=None):
 
-        x, h_n = self.value_gru(x)
-        x = x[:, -1, :].squeeze()
-        print(x.shape)
+        x, self.h_val = self.recurrent_forward(self.value_gru, x, h0, lengths)
 
         if self.activation_functions:
             for i, func in enumerate(self.activation_functions):
@@ -263,15 +282,29 @@ class RecurrentActorCriticPPO(StochasticContinuousNeuralNet):
         action = self.policy_forward(x)
         value = self.value_forward(x)
 
-        return tor.cat([action, value], dim=1)
+        return tor.cat([action, value], dim=-1)
 
 
-    def __call__(self, state):
-        #self.sigma_log -= sigma_epsilon
-        action, value = self.policy_forward(state), self.value_forward(state)
+    def __call__(self, state, use_last_state=False, hidden=None, lengths=None):
+        """
+        :param state: Sequences of observations [B, L, D], outputs are returned for every step
+        :param use_last_state: Continue from the hidden states of the last call and keep the new ones
+        :param hidden: Initial hidden states of the policy and value GRUs [layers, B, D]
+        :param lengths: Valid lengths of the sequences if they are padded
+        """
+        if use_last_state:
+            hidden = (self.lh_pol, self.lh_val)
+        h_pol, h_val = (None, None) if hidden is None else hidden
+        action, value = self.policy_forward(state, h_pol, lengths), self.value_forward(state, h_val, lengths)
+        if use_last_state:
+            self.lh_pol, self.lh_val = self.h_pol.detach(), self.h_val.detach()
 
         return action, value
 
+    def reset(self):
+        self.lh_pol = None
+        self.lh_val = None
+
 
     def sigma(self):
 
@@ -0,0 +1,50 @@
+from torch_rl.training.ppo import AsyncGPUPPOTrainer
+from torch_rl.models.ppo import ActorCriticPPO
+from torch_rl.tests.recurrent_ppo_test import RandomEnv
+from torch_rl.tests.vec_env_test import FailingEnv
+from unittest import TestCase
+import torch as tor
+import pytest
+import sys
+
+
+def failing_env():
+    return FailingEnv(3)
+
+
+class AsyncPPOTest(TestCase):
+
+    def test_training(self):
+        trainer = AsyncGPUPPOTrainer(RandomEnv, ActorCriticPPO([3, 8, 2]), num_actors=2, queue_depth=1,
+                                     max_policy_lag=1, n_steps=16, n_update_steps=2)
+        try:
+            for _ in range(4):
+                trainer._horizon_step()
+            self.assertEqual(trainer.version.value, 4)
+            # Actors roll out with the weights of the last update
+            self.assertTrue(tor.equal(trainer.parameters, tor.nn.utils.parameters_to_vector(trainer.network.parameters())))
+        finally:
+            trainer.close()
+        self.assertFalse(trainer.processes)
+
+    def test_train_end(self):
+        trainer = AsyncGPUPPOTrainer(RandomEnv, ActorCriticPPO([3, 8, 2]), num_actors=2, n_steps=16)
+        try:
+            trainer.train(2, 16)
+            # The actors are stopped when training ends
+            self.assertFalse(trainer.processes)
+        finally:
+            trainer.close()
+
+    def test_failing_actor(self):
+        trainer = AsyncGPUPPOTrainer(RandomEnv, ActorCriticPPO([3, 8, 2]), num_actors=1, n_steps=16)
+        trainer.env_fn = failing_env
+        try:
+            with self.assertRaises(RuntimeError):
+                trainer._horizon_step()
+        finally:
+            trainer.close()
+
+
+if __name__ == '__main__':
+    pytest.main([sys.argv[0]])
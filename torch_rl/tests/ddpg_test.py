@@ -0,0 +1,107 @@
+from torch_rl.training.ddpg import DDPGTrainer, ApeXDDPGTrainer
+from torch_rl.models import SimpleNetwork
+from torch_rl.memory import SequentialMemory
+from torch_rl.envs import DummyVecEnv
+from torch_rl.tests.recurrent_ppo_test import RandomEnv
+from unittest import TestCase
+import torch as tor
+import time
+import pytest
+import sys
+
+
+def ddpg_trainer(env=None, stride=1, **kwargs):
+    actor = SimpleNetwork([3, 16, 2], activation_functions=[tor.nn.ReLU(), tor.nn.Tanh()])
+    critic = SimpleNetwork([5, 16, 1], activation_functions=[tor.nn.ReLU()])
+    return DDPGTrainer(RandomEnv() if env is None else env, actor, critic, warmup=50, batch_size=8,
+                       replay_memory=SequentialMemory(1000, window_length=1, contiguous=True, stride=stride), **kwargs)
+
+
+class DDPGTest(TestCase):
+
+    def test_update_to_data_ratio(self):
+        trainer = ddpg_trainer(n_updates=3, update_interval=4)
+        trainer._warmup()
+        self.assertEqual(len(trainer._sample_batches()), 3)
+        self.assertEqual(len(trainer._sample_batches()[0][0]), 8)
+
+        for _ in range(12):
+            trainer._episode_step(0)
+        self.assertEqual(trainer.learn_rounds, 3)
+
+        # The acting copy of the actor follows the learner after every round
+        self.assertTrue(tor.equal(trainer.actor_placement.actor_parameters.data, trainer.actor_parameters.data))
+
+    def test_background_learner(self):
+        trainer = ddpg_trainer(n_updates=2, update_interval=2, background_learner=True)
+        trainer._warmup()
+        try:
+            for _ in range(20):
+                trainer._episode_step(0)
+            deadline = time.time() + 10
+            while trainer.learn_rounds < 10 and time.time() < deadline:
+                time.sleep(.01)
+            # The learner catches up with the data but never exceeds the ratio
+            self.assertEqual(trainer.learn_rounds, 10)
+        finally:
+            trainer.stop_learner()
+        self.assertTrue(trainer.learner_thread is None)
+        self.assertTrue(trainer.learner_error is None)
+
+    def test_train_end(self):
+        trainer = ddpg_trainer(background_learner=True, prefetch=2)
+        trainer._warmup()
+        trainer._episode_step(0)
+        # An error of the learner after the last step is raised when training ends
+        trainer.learner_error = RuntimeError("learner failed")
+        with self.assertRaises(RuntimeError):
+            trainer._train_end()
+        self.assertTrue(trainer.learner_thread is None)
+        self.assertTrue(trainer.prefetcher.thread is None)
+
+    def test_vectorized(self):
+        env = DummyVecEnv([lambda: RandomEnv(episode_len=5)] * 4)
+        trainer = ddpg_trainer(env, stride=4)
+        self.assertEqual(trainer.random_process.X.shape, (4, 2))
+        trainer._warmup()
+        self.assertEqual(trainer.replay_memory.nb_entries, 52)
+
+        trainer.state = env.reset()
+        for _ in range(5):
+            state, reward, done, _ = trainer._episode_step(0)
+        self.assertEqual(state.shape, (4, 3))
+        self.assertEqual(trainer.replay_memory.nb_entries, 72)
+        # All environments finished their episode in the last step and restart their noise
+        self.assertTrue(tor.all(tor.from_numpy(trainer.random_process.X) == 0))
+        self.assertEqual(trainer.episodes, 4)
+
+        with self.assertRaises(AssertionError):
+            ddpg_trainer(env)
+
+    def test_default_memory(self):
+        actor = SimpleNetwork([3, 16, 2], activation_functions=[tor.nn.ReLU(), tor.nn.Tanh()])
+        critic = SimpleNetwork([5, 16, 1], activation_functions=[tor.nn.ReLU()])
+        trainers = [DDPGTrainer(RandomEnv(), actor, critic) for _ in range(2)]
+        # Every trainer gets its own memory
+        self.assertTrue(trainers[0].replay_memory is not trainers[1].replay_memory)
+
+    def test_apex(self):
+        actor = SimpleNetwork([3, 16, 2], activation_functions=[tor.nn.ReLU(), tor.nn.Tanh()])
+        critic = SimpleNetwork([5, 16, 1], activation_functions=[tor.nn.ReLU()])
+        trainer = ApeXDDPGTrainer(RandomEnv, actor, critic, num_actors=2, memory_limit=400, sync_interval=10,
+                                  warmup=50, batch_size=8, n_updates=2)
+        try:
+            trainer._warmup()
+            self.assertTrue(trainer.replay_memory.nb_entries >= 50)
+            for _ in range(5):
+                trainer._episode_step(0)
+            self.assertEqual(trainer.learn_rounds, 5)
+            self.assertTrue(tor.equal(trainer.parameters, trainer.actor_parameters.data))
+            self.assertTrue(all(count > 0 for count in trainer.replay_memory.arrays.counts))
+        finally:
+            trainer.close()
+        self.assertFalse(trainer.processes)
+
+
+if __name__ == '__main__':
+    pytest.main([sys.argv[0]])
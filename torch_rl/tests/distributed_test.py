@@ -0,0 +1,55 @@
+from torch_rl.utils import launch_distributed, all_reduce_gradients, DistributedRunningMeanStd
+from torch_rl.training.ppo import DistributedGPUPPOTrainer
+from torch_rl.models.ppo import ActorCriticPPO
+from torch_rl.envs.wrappers import RunningMeanStdNormalize
+from torch_rl.tests.recurrent_ppo_test import RandomEnv
+from unittest import TestCase
+import torch.distributed as dist
+import numpy as np
+import torch as tor
+import pytest
+import sys
+
+
+def reduce_worker(rank):
+    layer = tor.nn.Linear(3, 2)
+    for p in layer.parameters():
+        p.grad = tor.full_like(p, rank + 1.)
+    all_reduce_gradients(layer.parameters())
+    for p in layer.parameters():
+        assert tor.allclose(p.grad, tor.full_like(p, 1.5))
+
+    rms = DistributedRunningMeanStd(epsilon=0., shape=(2,))
+    rms.update(np.full((4, 2), rank, dtype=np.float32))
+    # Before the sync only the own data is seen
+    assert np.allclose(rms.mean, rank)
+    rms.sync()
+    assert np.allclose(rms.mean, .5)
+    assert np.allclose(rms.std, .5)
+
+
+def ppo_worker(rank):
+    tor.manual_seed(rank)
+    env = RunningMeanStdNormalize(RandomEnv(), distributed=True)
+    trainer = DistributedGPUPPOTrainer(env, ActorCriticPPO([3, 8, 2]), n_steps=16, n_update_steps=2, n_minibatches=2)
+    trainer._horizon_step()
+
+    params = tor.nn.utils.parameters_to_vector(trainer.network.parameters()).detach()
+    gathered = [tor.zeros_like(params) for _ in range(dist.get_world_size())]
+    dist.all_gather(gathered, params)
+    assert all(tor.equal(params, other) for other in gathered)
+    # Both processes normalize with the statistics of all 32 steps
+    assert np.isclose(env.ob_rms._count, 32 * 3 + 1e-2)
+
+
+class DistributedTest(TestCase):
+
+    def test_reduce(self):
+        launch_distributed(reduce_worker, 2, port=29531)
+
+    def test_ppo(self):
+        launch_distributed(ppo_worker, 2, port=29532)
+
+
+if __name__ == '__main__':
+    pytest.main([sys.argv[0]])
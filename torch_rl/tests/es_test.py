@@ -0,0 +1,111 @@
+from torch_rl.training.evolution_strategies import ESModel, ESTrainer, CMAESTrainer, SharedNoiseTable
+from torch_rl.training.evolution_strategies import PopulationEvaluator, run_episode
+from torch_rl.tests.recurrent_ppo_test import RandomEnv
+from torch_rl.tests.vec_env_test import CountingEnv, env_fns
+from torch_rl.envs import DummyVecEnv
+from unittest import TestCase
+import numpy as np
+import torch as tor
+from functools import partial
+import pytest
+import sys
+
+
+class SharedNoiseTableTest(TestCase):
+
+    def test_weighted_sum(self):
+        table = SharedNoiseTable(size=1000, seed=1)
+        offsets = table.sample_offsets(20, 7)
+        weights = np.random.randn(7)
+        expected = sum(w * table.get(o, 20) for o, w in zip(offsets, weights))
+        self.assertTrue(tor.allclose(table.weighted_sum(offsets, weights, 20, batch_size=3), expected, atol=1e-5))
+
+
+class ESTrainerTest(TestCase):
+
+    def test_horizon_step(self):
+        model = ESModel([3, 4, 2])
+        trainer = ESTrainer(RandomEnv(), model, population_size=6, num_threads=2,
+                            learning_rate=1e-1, noise_table=SharedNoiseTable(size=10000))
+        try:
+            parameters = trainer.parameters.clone()
+            trainer._horizon_step()
+        finally:
+            trainer._train_end()
+        self.assertFalse(tor.equal(parameters, trainer.parameters))
+        self.assertTrue(tor.equal(model.flattened_parameters(), trainer.parameters))
+        # Episodes of RandomEnv end after 13 steps
+        self.assertEqual(trainer.total_steps, 6 * 13)
+
+
+class CMAESTrainerTest(TestCase):
+
+    def test_horizon_step(self):
+        model = ESModel([3, 4, 2])
+        trainer = CMAESTrainer(RandomEnv(), model, population_size=8, lmbda=3, num_threads=2,
+                               env_fn=partial(RandomEnv, episode_len=5))
+        try:
+            population = trainer.population.clone()
+            trainer._horizon_step()
+        finally:
+            trainer._train_end()
+        self.assertEqual(trainer.population.shape, population.shape)
+        self.assertEqual(trainer.total_steps, 8 * 5)
+        self.assertTrue(tor.equal(model.flattened_parameters(), trainer.flattened_param_mean_old))
+
+    def test_covariance_modes(self):
+        for covariance in ('full', 'diagonal', 'lowrank'):
+            trainer = CMAESTrainer(RandomEnv(), ESModel([3, 2]), population_size=6, lmbda=2, num_threads=1,
+                                   env_fn=partial(RandomEnv, episode_len=3), covariance=covariance)
+            try:
+                trainer._horizon_step()
+            finally:
+                trainer._train_end()
+            self.assertEqual(trainer.population.shape, (6, 8))
+            self.assertEqual(trainer.covar_matrix is None, covariance != 'full')
+            self.assertEqual(trainer.covar_factor.shape[1], 2 if covariance == 'lowrank' else 0)
+
+    def test_lowrank_sampling(self):
+        trainer = CMAESTrainer(RandomEnv(), ESModel([1, 2]), population_size=100000, num_threads=1,
+                               covariance='lowrank')
+        trainer._train_end()
+        trainer.covar_factor = tor.tensor([[1.], [2.], [0.], [-1.]])
+        trainer.covar_diagonal = tor.full((4,), .5)
+        samples = trainer._sample_population(tor.ones(4))
+        expected = trainer.covar_factor.matmul(trainer.covar_factor.t()) + .5 * tor.eye(4)
+        centered = samples - samples.mean(0)
+        self.assertTrue(tor.allclose(centered.t().matmul(centered) / len(samples), expected, atol=5e-2))
+        self.assertTrue(tor.allclose(samples.mean(0), tor.ones(4), atol=2e-2))
+
+
+class PopulationEvaluatorTest(TestCase):
+
+    def test_matches_single_evaluation(self):
+        model = ESModel([1, 3, 1])
+        population = tor.randn(4, 10)
+        evaluator = PopulationEvaluator(model, DummyVecEnv(env_fns(4)), steps=4)
+        scores, steps = evaluator.evaluate(population)
+
+        # Episodes of individual i last i+2 steps, at most 4 are evaluated
+        self.assertTrue(np.all(steps == [2, 3, 4, 4]))
+        for i in range(4):
+            model.set_flattened_parameters(population[i].clone())
+            score, nsteps = run_episode(model, CountingEnv(i + 2), steps=4)
+            self.assertAlmostEqual(scores[i], score, places=5)
+            self.assertEqual(steps[i], nsteps)
+
+    def test_trainers(self):
+        trainer = ESTrainer(RandomEnv(), ESModel([3, 2]), population_size=5, noise_table=SharedNoiseTable(size=1000),
+                            evaluator=PopulationEvaluator(ESModel([3, 2]), DummyVecEnv([RandomEnv] * 5)))
+        self.assertTrue(trainer.pool is None)
+        trainer._horizon_step()
+        self.assertEqual(trainer.total_steps, 5 * 13)
+
+        trainer = CMAESTrainer(RandomEnv(), ESModel([3, 2]), population_size=5, lmbda=2, covariance='diagonal',
+                               evaluator=PopulationEvaluator(ESModel([3, 2]), DummyVecEnv([RandomEnv] * 5)))
+        trainer._horizon_step()
+        self.assertEqual(trainer.total_steps, 5 * 13)
+
+
+if __name__ == '__main__':
+    pytest.main([sys.argv[0]])
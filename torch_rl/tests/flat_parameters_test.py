@@ -0,0 +1,49 @@
+from torch_rl.utils import FlatParameters, soft_update
+from torch import nn
+from unittest import TestCase
+import copy
+import torch as tor
+import pytest
+import sys
+
+
+class FlatParametersTest(TestCase):
+
+    def setUp(self):
+        self.source = nn.Sequential(nn.Linear(3, 4), nn.Tanh(), nn.Linear(4, 2))
+        self.target = copy.deepcopy(self.source)
+        with tor.no_grad():
+            for p in self.target.parameters():
+                p.normal_()
+
+    def test_views(self):
+        params = [p.detach().clone() for p in self.source.parameters()]
+        flat = FlatParameters(self.source)
+        self.assertTrue(flat.bound)
+        self.assertTrue(tor.equal(flat.data, tor.cat([p.view(-1) for p in params])))
+
+        # Parameters and buffer share memory in both directions
+        flat.set(tor.zeros(len(flat)))
+        self.assertTrue(all(tor.all(p == 0) for p in self.source.parameters()))
+        with tor.no_grad():
+            self.source[0].bias.fill_(3.)
+        self.assertTrue(tor.all(flat.data[12:16] == 3.))
+
+        # Copies of the module get their own parameter storage
+        self.assertFalse(copy.deepcopy(flat).bound)
+
+    def test_soft_update(self):
+        expected = [tau_p.detach() * .9 + p.detach() * .1
+                    for tau_p, p in zip(self.target.parameters(), self.source.parameters())]
+        soft_update(FlatParameters(self.target), FlatParameters(self.source), .1)
+        for p, e in zip(self.target.parameters(), expected):
+            self.assertTrue(tor.allclose(p, e))
+
+        # Modules without flat buffers are updated parameter by parameter
+        soft_update(self.target, self.source, 1.)
+        for p, s in zip(self.target.parameters(), self.source.parameters()):
+            self.assertTrue(tor.allclose(p, s))
+
+
+if __name__ == '__main__':
+    pytest.main([sys.argv[0]])
@@ -1,4 +1,4 @@
-from torch_rl.memory import HindsightMemory
+from torch_rl.memory import HindsightMemory, sample_hindsight_indexes
 import gym
 import numpy as np
 from tqdm import tqdm
@@ -19,10 +19,10 @@ class HindsightReplayTest(TestCase):
         cls.episode = 1
         for i in range(500):
             if i % 20 == 0:
-                cls.memory.append(cls.episode, 1, 1, 1, True)
+                cls.memory.append(cls.episode, 1, 1, True, goal=cls.episode)
                 cls.episode += 1
             else:
-                cls.memory.append(cls.episode, 1, 1, 1, False)
+                cls.memory.append(cls.episode, 1, 1, False, goal=cls.episode)
     def test_append(self):
         self.memory.append(0,1,1,1,1,False)
 
@@ -36,22 +36,75 @@ class HindsightReplayTest(TestCase):
             self.assertTrue(self.memory.observations[i] == episode, "Episodes should come incrementally when iterating.")
 
     def test_hindsight(self):
-        for hindsight in self.memory.hindsight_buffer:
-            self.assertTrue(not hindsight is None, "If you can iterate over it, should not be None")
-            # self.assertTrue(len(hindsight) == 8, "Length of every hindsight entry should be 8")
-            # Check that all of the idxs belong to the same episode
-            episode = self.memory.observations[hindsight[0][0]]
-            for i,root_idx in hindsight[1:]:
-                e = self.memory.observations[i]
-                print(episode, e)
+        begins, ends = self.memory.episode_bounds()
+        self.assertTrue(len(begins) > 0, "Episodes should be stored")
+        root_idxs, hindsight_idxs = sample_hindsight_indexes(begins, ends, self.memory.hindsight_size, 100)
+        self.assertTrue(hindsight_idxs.shape == (100, self.memory.hindsight_size))
+        for root_idx, hindsight in zip(root_idxs, hindsight_idxs):
+            # Check that all of the idxs belong to the same episode and lie in the future
+            episode = self.memory.observations[root_idx]
+            for i in hindsight:
+                self.assertTrue(i > root_idx, "Hindsight experience has to be in the future")
                 self.assertTrue(self.memory.observations[i] == episode, "Every experience in hindsight should be from same episode")
 
 
     def test_hindsight_pairing(self):
-        for hindsight in self.memory.hindsight_buffer:
-            for i, root_idx in hindsight:
-                e = self.memory[i]
-                [self.assertTrue(nnone(obj), "Every object in experience should not be None") for obj in e]
+        begins, ends = self.memory.episode_bounds()
+        root_idxs, hindsight_idxs = sample_hindsight_indexes(begins, ends, self.memory.hindsight_size, 100)
+        for i in np.hstack((root_idxs, hindsight_idxs.ravel())):
+            e = self.memory[i]
+            [self.assertTrue(nnone(obj), "Every object in experience should not be None") for obj in e]
+
+
+class HindsightSampleTest(TestCase):
+
+    @classmethod
+    def setup_class(cls):
+        cls.memory = HindsightMemory(300, hindsight_size=4, goal_indices=[0, 1], contiguous=True)
+        step = 0
+        for episode in range(40):
+            for t in range(10):
+                observation = np.array([step, step, episode], dtype=np.float32)
+                cls.memory.append(observation, np.zeros(2), -1., t == 9, goal=np.array([-1., -1.]))
+                step += 1
+
+    def test_overwritten_episodes(self):
+        begins, ends = self.memory.episode_bounds()
+        self.assertTrue(np.all(begins >= 0))
+        self.assertTrue(len(begins) == 30, "Only complete episodes are sampled")
+
+    def test_append_batch(self):
+        memory = HindsightMemory(300, hindsight_size=4, goal_indices=[0, 1], contiguous=True)
+        observations = np.array([[step, step, step // 10] for step in range(400)], dtype=np.float32)
+        terminals = np.arange(400) % 10 == 9
+        for begin in range(0, 400, 16):
+            end = begin + 16
+            memory.append_batch(observations[begin:end], np.zeros((16, 2)), np.full(16, -1.), terminals[begin:end],
+                                goals=np.full((16, 2), -1.))
+        self.assertTrue(memory.nb_appended == self.memory.nb_appended)
+        for bounds, expected in zip(memory.episode_bounds(), self.memory.episode_bounds()):
+            self.assertTrue(np.all(bounds == expected))
+        idxs = np.arange(memory.nb_entries)
+        self.assertTrue(np.all(memory.observations.take(idxs) == self.memory.observations.take(idxs)))
+        self.assertTrue(np.all(memory.goals.take(idxs) == -1.))
+
+    def test_sample_and_split(self):
+        num_transitions, hindsight_size = 16, self.memory.hindsight_size
+        s0, a, r, s1, t1, g = self.memory.sample_and_split(num_transitions, split_goal=True)
+        self.assertTrue(s0.shape == (num_transitions*(hindsight_size+1), 3))
+        self.assertTrue(np.all(s1[:, 0] == s0[:, 0] + 1))
+        self.assertTrue(np.all(s1[:, 2] == s0[:, 2]), "Transitions never cross episodes")
+
+        is_root = np.arange(len(s0)) % (hindsight_size+1) == hindsight_size
+        self.assertTrue(np.all(r[is_root] == -1.) and np.all(r[~is_root] == 1.))
+        self.assertTrue(np.all(g[is_root] == -1.))
+        self.assertTrue(np.all(g[~is_root] == s1[~is_root][:, [0, 1]]), "Hindsight goal is the achieved state")
+
+        # Hindsight transitions are from the same episode as their root and lie in its future
+        episodes = s0[:, 2].reshape(num_transitions, -1)
+        steps = s0[:, 0].reshape(num_transitions, -1)
+        self.assertTrue(np.all(episodes == episodes[:, -1:]))
+        self.assertTrue(np.all(steps[:, :-1] > steps[:, -1:]))
 
 
 if __name__ == '__main__':
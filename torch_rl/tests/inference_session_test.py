@@ -0,0 +1,53 @@
+from torch_rl.core import InferenceSession
+from torch_rl.models.ppo import ActorCriticPPO
+from torch.distributions import Normal
+from unittest import TestCase
+import numpy as np
+import torch as tor
+import pytest
+import sys
+
+
+class InferenceSessionTest(TestCase):
+
+    @classmethod
+    def setup_class(cls):
+        tor.manual_seed(0)
+        cls.net = ActorCriticPPO([3, 8, 2])
+        with tor.no_grad():
+            cls.net.siglog.fill_(-.5)
+
+    def test_sample(self):
+        session = InferenceSession(self.net, batch_size=4)
+        obs = np.random.randn(4, 3).astype(np.float32)
+        actions, values, logprobs = session.sample(obs)
+
+        self.assertEqual(actions.shape, (4, 2))
+        self.assertEqual(values.shape, (4, 1))
+        self.assertEqual(logprobs.shape, (4, 2))
+        self.assertTrue(isinstance(actions, np.ndarray))
+
+        x = tor.from_numpy(obs)
+        with tor.no_grad():
+            dist = Normal(self.net.policy_mean(x), tor.exp(self.net.siglog))
+            expected_logprobs = dist.log_prob(tor.from_numpy(actions)).numpy()
+            expected_values = self.net.value_forward(x).numpy()
+        np.testing.assert_allclose(logprobs, expected_logprobs, rtol=1e-5, atol=1e-5)
+        np.testing.assert_allclose(values, expected_values, rtol=1e-5, atol=1e-6)
+
+    def test_call(self):
+        session = InferenceSession(self.net)
+        obs = np.random.randn(3).astype(np.float32)
+        out = session(obs[:2], obs[2:])
+        self.assertEqual(out.shape, (1, 3))
+
+        # The input tensor is reused between steps and no graph is recorded
+        input = session.input
+        session(obs)
+        self.assertTrue(session.input is input)
+        self.assertFalse(session.input.requires_grad)
+        np.testing.assert_allclose(session.input.numpy()[0], obs)
+
+
+if __name__ == '__main__':
+    pytest.main([sys.argv[0]])
@@ -0,0 +1,31 @@
+from torch_rl.training.core import ModelPlacement
+from torch_rl.models.ppo import ActorCriticPPO
+from unittest import TestCase
+import torch as tor
+import pytest
+import sys
+
+
+class ModelPlacementTest(TestCase):
+
+    def test_sync(self):
+        net = ActorCriticPPO([3, 8, 2])
+        placement = ModelPlacement(net, device='cpu')
+        self.assertTrue(placement.learner is net)
+        self.assertTrue(placement.actor is not net)
+
+        with tor.no_grad():
+            for p in placement.learner.parameters():
+                p.add_(1.)
+        x = tor.randn(4, 3)
+        self.assertFalse(tor.allclose(placement.actor.value_forward(x), placement.learner.value_forward(x)))
+
+        placement.sync()
+        for actor_param, learner_param in zip(placement.actor.parameters(), placement.learner.parameters()):
+            self.assertTrue(tor.equal(actor_param, learner_param))
+        self.assertTrue(tor.allclose(placement.actor.value_forward(x), placement.learner.value_forward(x)))
+        self.assertFalse(any(p.requires_grad for p in placement.actor.parameters()))
+
+
+if __name__ == '__main__':
+    pytest.main([sys.argv[0]])
@@ -1,4 +1,6 @@
 from unittest import TestCase
+from torch_rl.utils import compute_gae, normalize_advantages
+import torch as tor
 import pytest
 import gym
 import sys
@@ -44,6 +46,92 @@ class PPOTest(TestCase):
 
 
 
+def reference_gae(mb_rewards, mb_values, mb_dones, done, last_values, gamma, lam):
+    """
+    The loop of the advantage estimators, mb_dones are flagged before the first step of an episode.
+    """
+    nsteps = len(mb_rewards)
+    mb_advs = np.zeros_like(mb_rewards)
+    lastgaelam = 0
+    for t in reversed(range(nsteps)):
+        if t == nsteps - 1:
+            nextnonterminal = 1.0 - done
+            nextvalues = last_values
+        else:
+            nextnonterminal = 1.0 - mb_dones[t + 1]
+            nextvalues = mb_values[t + 1]
+        delta = mb_rewards[t] + gamma * nextvalues * nextnonterminal - mb_values[t]
+        mb_advs[t] = lastgaelam = delta + gamma * lam * nextnonterminal * lastgaelam
+    return mb_advs, mb_advs + mb_values
+
+
+class GAETest(TestCase):
+
+    @classmethod
+    def setup_class(cls):
+        cls.T, cls.N = 1024, 4
+        cls.gamma, cls.lmda = .99, .95
+        cls.rewards = np.random.normal(size=(cls.T, cls.N)).astype(np.float32)
+        cls.values = np.random.normal(size=(cls.T, cls.N)).astype(np.float32)
+        cls.mb_dones = np.random.uniform(size=(cls.T, cls.N)) < 0.01
+        cls.done = np.array([True, False, False, True])
+        cls.last_values = np.random.normal(size=cls.N).astype(np.float32)
+        cls.dones = np.vstack((cls.mb_dones[1:], cls.done[None]))
+
+    def test_numpy(self):
+        advs, returns = compute_gae(self.rewards, self.values, self.dones, self.last_values, self.gamma, self.lmda)
+        ref_advs, ref_returns = reference_gae(self.rewards, self.values, self.mb_dones, self.done,
+                                              self.last_values, self.gamma, self.lmda)
+        self.assertTrue(advs.dtype == np.float32)
+        self.assertTrue(np.allclose(advs, ref_advs, atol=1e-4))
+        self.assertTrue(np.allclose(returns, ref_returns, atol=1e-4))
+
+    def test_single_env(self):
+        advs, returns = compute_gae(self.rewards[:, :1], self.values[:, :1], self.dones[:, :1],
+                                    self.last_values[:1], self.gamma, self.lmda)
+        ref_advs, _ = reference_gae(self.rewards[:, :1], self.values[:, :1], self.mb_dones[:, :1], self.done[0],
+                                    self.last_values[:1], self.gamma, self.lmda)
+        self.assertTrue(np.allclose(advs, ref_advs, atol=1e-4))
+
+    def test_tensor(self):
+        advs, returns = compute_gae(self.rewards, self.values, self.dones, self.last_values, self.gamma, self.lmda)
+        tadvs, treturns = compute_gae(*map(tor.from_numpy, (self.rewards, self.values, self.dones, self.last_values)),
+                                      gamma=self.gamma, lam=self.lmda)
+        self.assertTrue(tor.is_tensor(tadvs))
+        self.assertTrue(np.allclose(tadvs.numpy(), advs, atol=1e-4))
+        self.assertTrue(np.allclose(treturns.numpy(), returns, atol=1e-4))
+
+
+class AdvantageNormalizationTest(TestCase):
+
+    @classmethod
+    def setup_class(cls):
+        cls.T, cls.N = 200, 3
+        cls.advs = np.random.normal(2., 3., size=(cls.T, cls.N)).astype(np.float32)
+        cls.masks = np.random.uniform(size=(cls.T, cls.N)) < 0.05
+        cls.masks[0] = True
+
+    def test_episode(self):
+        normalized = normalize_advantages(self.advs, self.masks)
+        for i in range(self.N):
+            starts = list(np.argwhere(self.masks[:, i])[:, 0]) + [self.T]
+            for start, end in zip(starts[:-1], starts[1:]):
+                episode_advs = self.advs[start:end, i]
+                expected = (episode_advs - episode_advs.mean()) / (episode_advs.std() + 1e-8)
+                self.assertTrue(np.allclose(normalized[start:end, i], expected, atol=1e-4))
+
+    def test_modes(self):
+        normalized = normalize_advantages(self.advs, self.masks, mode='env')
+        self.assertTrue(np.allclose(normalized.mean(0), 0., atol=1e-4) and np.allclose(normalized.std(0), 1., atol=1e-4))
+        normalized = normalize_advantages(self.advs, mode='global')
+        self.assertTrue(np.isclose(normalized.mean(), 0., atol=1e-4) and np.isclose(normalized.std(), 1., atol=1e-4))
+
+    def test_tensor(self):
+        for mode in ['episode', 'env', 'global']:
+            normalized = normalize_advantages(self.advs, self.masks, mode=mode)
+            tnormalized = normalize_advantages(tor.from_numpy(self.advs), tor.from_numpy(self.masks), mode=mode)
+            self.assertTrue(np.allclose(tnormalized.numpy(), normalized, atol=1e-4))
+
 
 if __name__ == '__main__':
     pytest.main([sys.argv[0]])
@@ -0,0 +1,47 @@
+from torch_rl.memory import BatchPrefetcher, SequentialMemory, PrioritizedSequentialMemory
+import numpy as np
+import torch as tor
+from unittest import TestCase
+import pytest
+import sys
+
+
+def fill(memory, n):
+    for i in range(n):
+        memory.append(np.full(3, i), np.zeros(2), float(i), (i+1) % 10 == 0)
+    return memory
+
+
+class BatchPrefetcherTest(TestCase):
+
+    @classmethod
+    def setup_class(cls):
+        cls.memory = fill(SequentialMemory(100, window_length=1, contiguous=True), 100)
+
+    def test_batches(self):
+        prefetcher = BatchPrefetcher(self.memory, 16, num_batches=2, device='cpu')
+        for _ in range(5):
+            s0, a, r, s1, t1 = next(prefetcher)
+            self.assertTrue(tor.is_tensor(s0) and s0.shape == (16, 3))
+            self.assertTrue(tor.equal(s1[:, 0], s0[:, 0] + 1))
+            self.assertTrue(isinstance(t1, np.ndarray), "Non float arrays are passed through")
+        prefetcher.stop()
+        self.assertTrue(prefetcher.thread is None)
+
+    def test_prioritized(self):
+        memory = fill(PrioritizedSequentialMemory(50, window_length=1, contiguous=True), 80)
+        prefetcher = BatchPrefetcher(memory, 8, num_batches=2, device='cpu').start()
+        batch = prefetcher.next()
+        prefetcher.stop()
+        weights, idxs = batch[-2:]
+        self.assertTrue(tor.is_tensor(weights))
+        self.assertTrue(idxs.dtype == np.int64)
+
+    def test_error(self):
+        prefetcher = BatchPrefetcher(SequentialMemory(10, window_length=1), 4, device='cpu')
+        with self.assertRaises(Exception):
+            prefetcher.next()
+
+
+if __name__ == '__main__':
+    pytest.main([sys.argv[0]])
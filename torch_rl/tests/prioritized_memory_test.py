@@ -0,0 +1,58 @@
+from torch_rl.memory import PrioritizedSequentialMemory, SumTree
+import numpy as np
+from unittest import TestCase
+import pytest
+import sys
+
+
+class SumTreeTest(TestCase):
+
+    def test_update(self):
+        tree = SumTree(10)
+        tree.update(np.arange(10), np.arange(10))
+        self.assertTrue(tree.total == 45)
+        tree.update([3, 9], [0., 1.])
+        self.assertTrue(tree.total == 45 - 3 - 8)
+
+    def test_find(self):
+        tree = SumTree(5)
+        tree.update(np.arange(5), [1., 0., 2., 0., 1.])
+        idxs = tree.find([0., 0.5, 1.5, 2.5, 3.5, 4.])
+        self.assertTrue(np.all(idxs == [0, 0, 2, 2, 4, 4]))
+
+    def test_proportional(self):
+        tree = SumTree(4)
+        tree.update(np.arange(4), [1., 2., 3., 4.])
+        idxs = tree.find(np.random.uniform(0, tree.total, 100000))
+        frequencies = np.bincount(idxs, minlength=4) / 100000.
+        self.assertTrue(np.allclose(frequencies, [.1, .2, .3, .4], atol=1e-2))
+
+
+class PrioritizedMemoryTest(TestCase):
+
+    @classmethod
+    def setup_class(cls):
+        cls.memory = PrioritizedSequentialMemory(50, window_length=1, contiguous=True)
+        for i in range(80):
+            cls.memory.append(np.full(3, i), np.zeros(2), float(i), (i+1) % 10 == 0)
+
+    def test_sample(self):
+        s0, a, r, s1, t1, weights, idxs = self.memory.sample_and_split(32)
+        self.assertTrue(weights.shape == (32, 1))
+        self.assertTrue(np.all(s1[:, 0] == s0[:, 0] + 1), "Follow-up observation has to be the next one")
+        # Newest transition has no follow-up, transitions after a reset are skipped
+        self.assertFalse(np.any(r == 79))
+        self.assertFalse(np.any(r.ravel() % 10 == 0))
+
+    def test_update_priorities(self):
+        s0, a, r, s1, t1, weights, idxs = self.memory.sample_and_split(8)
+        self.memory.update_priorities(idxs[:1], [100.])
+        self.assertTrue(np.isclose(self.memory.tree[idxs[0]], 100.**self.memory.alpha))
+        s0, a, r, s1, t1, weights, sampled_idxs = self.memory.sample_and_split(64)
+        # Roughly a third of the probability mass is on the updated transition
+        self.assertTrue(np.mean(sampled_idxs == idxs[0]) > .2)
+        self.assertTrue(np.min(weights[sampled_idxs == idxs[0]]) == np.min(weights))
+
+
+if __name__ == '__main__':
+    pytest.main([sys.argv[0]])
@@ -0,0 +1,55 @@
+from torch_rl.training.ppo import AdvantageEstimator, chunk_indexes
+from torch_rl.models.ppo import RecurrentActorCriticPPO
+from gym import spaces
+from unittest import TestCase
+import numpy as np
+import torch as tor
+import pytest
+import sys
+
+
+class RandomEnv(object):
+
+    def __init__(self, episode_len=13):
+        self.observation_space = spaces.Box(-1., 1., shape=(3,), dtype=np.float32)
+        self.action_space = spaces.Box(-1., 1., shape=(2,), dtype=np.float32)
+        self.episode_len = episode_len
+        self.t = 0
+
+    def reset(self):
+        self.t = 0
+        return np.random.uniform(-1, 1, 3).astype(np.float32)
+
+    def step(self, action):
+        self.t += 1
+        return np.random.uniform(-1, 1, 3).astype(np.float32), 1., self.t >= self.episode_len, {}
+
+
+class ChunkedRolloutTest(TestCase):
+
+    @classmethod
+    def setup_class(cls):
+        cls.network = RecurrentActorCriticPPO([3, 8, 2], num_grus=2)
+        cls.estimator = AdvantageEstimator(RandomEnv(), cls.network, nsteps=40, gamma=.99, lam=.95, chunk_length=6)
+        cls.estimator.run()
+        cls.rollout = cls.estimator.run()
+
+    def test_chunk_starts(self):
+        obs, returns, masks, actions, values, logpacs, (chunk_starts, states_policy, states_critic) = self.rollout
+        self.assertTrue(chunk_starts[0] == 0)
+        self.assertTrue(np.all(np.diff(np.append(chunk_starts, 40)) <= 6))
+        # Every episode starts a new chunk
+        self.assertTrue(set(np.argwhere(masks[:, 0])[:, 0]) <= set(chunk_starts))
+        self.assertTrue(states_policy.shape == (2, len(chunk_starts), 3))
+
+    def test_chunked_values(self):
+        obs, returns, masks, actions, values, logpacs, (chunk_starts, states_policy, states_critic) = self.rollout
+        inds, chunk_masks, lengths = chunk_indexes(chunk_starts, 40)
+        hidden = (tor.from_numpy(states_policy), tor.from_numpy(states_critic))
+        _, v_pred = self.network(tor.from_numpy(obs[inds]), hidden=hidden, lengths=lengths)
+        # Running whole chunks reproduces the values of the step by step rollout
+        self.assertTrue(np.allclose(v_pred.data.numpy()[chunk_masks], values[inds][chunk_masks], atol=1e-5))
+
+
+if __name__ == '__main__':
+    pytest.main([sys.argv[0]])
@@ -0,0 +1,227 @@
+from torch_rl.memory import SequentialMemory, GeneralisedMemory, PrioritizedSequentialMemory, MappedSequentialMemory, ArrayRingBuffer
+import numpy as np
+import tempfile
+import shutil
+from unittest import TestCase
+import pytest
+import sys
+
+
+def fill(memory, steps, obs_dim=3, act_dim=2, episode_len=10):
+    for i in range(steps):
+        memory.append(np.full(obs_dim, i), np.full(act_dim, -i), float(i), (i+1) % episode_len == 0)
+
+
+class ContiguousSequentialMemoryTest(TestCase):
+
+    @classmethod
+    def setup_class(cls):
+        """ setup any state specific to the execution of the given class (which
+        usually contains tests).
+        """
+        cls.limit = 100
+        cls.memory = SequentialMemory(cls.limit, window_length=1, contiguous=True)
+        cls.list_memory = SequentialMemory(cls.limit, window_length=1)
+        fill(cls.memory, 150)
+        fill(cls.list_memory, 150)
+
+    def test_storage(self):
+        self.assertTrue(isinstance(self.memory.observations, ArrayRingBuffer))
+        self.assertTrue(self.memory.observations.data.shape == (self.limit, 3))
+        self.assertTrue(self.memory.observations.data.dtype == np.float32)
+        self.assertTrue(self.memory.terminals.data.dtype == np.bool_)
+        self.assertTrue(self.memory.nb_entries == self.limit, "Memory should be full")
+
+    def test_same_content_as_list_storage(self):
+        for i in range(self.memory.nb_entries):
+            self.assertTrue(np.allclose(self.memory.observations[i], self.list_memory.observations[i]))
+            self.assertTrue(np.allclose(self.memory.actions[i], self.list_memory.actions[i]))
+            self.assertTrue(self.memory.rewards[i] == self.list_memory.rewards[i])
+            self.assertTrue(self.memory.terminals[i] == self.list_memory.terminals[i])
+
+    def test_sample(self):
+        batch_idxs = [0, 5, 17, 42, 98]
+        experiences = self.memory.sample(len(batch_idxs), batch_idxs)
+        list_experiences = self.list_memory.sample(len(batch_idxs), batch_idxs)
+        for e, le in zip(experiences, list_experiences):
+            self.assertTrue(np.allclose(e.state0, le.state0))
+            self.assertTrue(np.allclose(e.state1, le.state1))
+
+
+class VectorizedSampleTest(TestCase):
+
+    @classmethod
+    def setup_class(cls):
+        cls.memories = [SequentialMemory(100, window_length=3, contiguous=contiguous) for contiguous in (True, False)]
+        for memory in cls.memories:
+            fill(memory, 130, episode_len=7)
+
+    def test_matches_sample(self):
+        # Indexes are chosen such that no transition directly follows a terminal state
+        batch_idxs = [i for i in range(98) if not self.memories[0].terminals[max(i-1, 0)]]
+        for memory in self.memories:
+            experiences = memory.sample(len(batch_idxs), batch_idxs)
+            s0, a, r, s1, t1 = memory.sample_and_split(len(batch_idxs), batch_idxs)
+            self.assertTrue(s0.dtype == np.float32 and s1.dtype == np.float32)
+            for i, e in enumerate(experiences):
+                self.assertTrue(np.allclose(s0[i], np.asarray(e.state0).ravel()))
+                self.assertTrue(np.allclose(s1[i], np.asarray(e.state1).ravel()))
+                self.assertTrue(np.allclose(a[i], e.action))
+                self.assertTrue(r[i, 0] == e.reward)
+                self.assertTrue(t1[i, 0] == (not e.terminal1))
+
+    def test_skips_reset_transitions(self):
+        for memory in self.memories:
+            s0, a, r, s1, t1 = memory.sample_and_split(1000)
+            # Rewards are the step counters, the transition after a terminal one is never sampled
+            rewards = r.ravel().astype(np.int64)
+            self.assertFalse(np.any((rewards % 7 == 0) & (rewards > 30)))
+
+
+class StridedMemoryTest(TestCase):
+
+    @classmethod
+    def setup_class(cls):
+        cls.memories = [SequentialMemory(100, window_length=2, contiguous=contiguous, stride=3) for contiguous in (True, False)]
+        # Three environments stepped in lockstep, the observations encode environment and step
+        for memory in cls.memories:
+            for i in range(130):
+                for e in range(3):
+                    memory.append(np.full(3, 1000*e + i), np.full(2, -i), float(i), (i+1) % 7 == 0)
+
+    def test_follow_up_of_same_environment(self):
+        for memory in self.memories:
+            s0, a, r, s1, t1 = memory.sample_and_split(500)
+            s0, s1 = s0.reshape(500, 2, 3)[:, :, 0], s1.reshape(500, 2, 3)[:, :, 0]
+            self.assertTrue(np.all(s1[:, 1] == s0[:, 1] + 1))
+            self.assertTrue(np.all(s1[:, 0] == s0[:, 1]))
+            self.assertTrue(np.all(s0[:, 1] % 1000 == r.ravel()))
+            # Windows never leak into the previous episode of the environment
+            self.assertTrue(np.all((s0[:, 0] == 0) | (s0[:, 0] == s0[:, 1] - 1)))
+            self.assertFalse(np.any(r.ravel() % 7 == 0))
+
+    def test_generalised_memory(self):
+        memory = GeneralisedMemory(100, contiguous=True, stride=2)
+        for i in range(50):
+            for e in range(2):
+                memory.append(np.full(3, 100*e + i), np.full(2, 100*e + i), float(i), (i+1) % 7 == 0, np.full(2, i))
+        s0, a, r, s1, t1, extra_info = memory.sample_and_split(200)
+        self.assertTrue(np.all(a[:, 0] == s0[:, 0]), "Actions belong to the transition of the same environment")
+        self.assertTrue(np.all(s1[:, 0] == s0[:, 0] + 1))
+        for state0, action, reward, state1, terminal1, extra0 in memory.sample(50):
+            self.assertTrue(action[0] == state0[0][0] and state1[0][0] == state0[0][0] + 1)
+
+    def test_matches_sample(self):
+        batch_idxs = [i for i in range(90) if not self.memories[0].terminals[max(i-3, 0)]]
+        for memory in self.memories:
+            experiences = memory.sample(len(batch_idxs), batch_idxs)
+            s0, a, r, s1, t1 = memory.sample_and_split(len(batch_idxs), batch_idxs)
+            for i, e in enumerate(experiences):
+                self.assertTrue(np.allclose(s0[i], np.asarray(e.state0).ravel()))
+                self.assertTrue(np.allclose(s1[i], np.asarray(e.state1).ravel()))
+
+
+class BatchAppendTest(TestCase):
+
+    def assert_same_buffers(self, memory, batch_memory, names):
+        self.assertTrue(memory.nb_entries == batch_memory.nb_entries)
+        idxs = np.arange(memory.nb_entries)
+        for name in names:
+            self.assertTrue(np.all(getattr(memory, name).take(idxs) == getattr(batch_memory, name).take(idxs)), name)
+
+    def test_ring_buffer_extend(self):
+        buffer, list_buffer = ArrayRingBuffer(10), ArrayRingBuffer(10)
+        for values in (np.arange(4), np.arange(4, 11), np.arange(11, 36)):
+            buffer.extend(values)
+            for v in values:
+                list_buffer.append(v)
+            self.assertTrue(buffer.start == list_buffer.start and len(buffer) == len(list_buffer))
+            self.assertTrue(np.all(buffer.take(np.arange(10)) == list_buffer.take(np.arange(10))))
+
+    def test_same_content_as_append(self):
+        for contiguous in (True, False):
+            memory = SequentialMemory(50, contiguous=contiguous, stride=2)
+            batch_memory = SequentialMemory(50, contiguous=contiguous, stride=2)
+            for i in range(40):
+                obs, actions = np.full((2, 3), i), np.full((2, 2), -i)
+                rewards, terminals = np.array([i, 2*i]), np.array([i % 7 == 6, i % 5 == 4])
+                for e in range(2):
+                    memory.append_goal(obs[e], obs[e, :2], actions[e], rewards[e], terminals[e])
+                batch_memory.append_batch(obs, actions, rewards, terminals, goals=obs[:, :2])
+            self.assert_same_buffers(memory, batch_memory, ['observations', 'actions', 'rewards', 'terminals', 'goals'])
+
+    def test_generalised_memory(self):
+        memory, batch_memory = GeneralisedMemory(50, contiguous=True), GeneralisedMemory(50, contiguous=True)
+        obs, extra_info = np.random.randn(8, 3), np.random.randn(8, 4)
+        for i in range(8):
+            memory.append(obs[i], obs[i, :2], float(i), i == 5, extra_info[i])
+        batch_memory.append_batch(obs, obs[:, :2], np.arange(8), np.arange(8) == 5, extra_info)
+        self.assert_same_buffers(memory, batch_memory, ['observations', 'actions', 'rewards', 'terminals', 'extra_info'])
+
+    def test_prioritized_memory(self):
+        memory = PrioritizedSequentialMemory(30, contiguous=True, stride=3)
+        batch_memory = PrioritizedSequentialMemory(30, contiguous=True, stride=3)
+        for i in range(15):
+            obs = np.full((3, 3), i)
+            terminals = np.array([i % 4 == 3, False, i % 6 == 5])
+            for e in range(3):
+                memory.append(obs[e], np.zeros(2), float(i), terminals[e])
+            batch_memory.append_batch(obs, np.zeros((3, 2)), np.full(3, float(i)), terminals)
+            self.assertTrue(np.allclose(memory.tree.tree, batch_memory.tree.tree))
+
+
+class MappedSequentialMemoryTest(TestCase):
+
+    @classmethod
+    def setup_class(cls):
+        cls.directory = tempfile.mkdtemp()
+        cls.memory = MappedSequentialMemory(100, directory=cls.directory, flush_interval=0)
+        fill(cls.memory, 130)
+        cls.memory.flush()
+
+    @classmethod
+    def teardown_class(cls):
+        shutil.rmtree(cls.directory)
+
+    def test_memmap_storage(self):
+        self.assertTrue(isinstance(self.memory.observations.data, np.memmap))
+
+    def test_resume(self):
+        memory = MappedSequentialMemory(100, directory=self.directory)
+        self.assertTrue(memory.nb_entries == self.memory.nb_entries)
+        self.assertTrue(memory.observations.start == self.memory.observations.start)
+        batch_idxs = [3, 15, 47, 98]
+        for stored, resumed in zip(self.memory.sample_and_split(4, batch_idxs), memory.sample_and_split(4, batch_idxs)):
+            self.assertTrue(np.all(stored == resumed))
+
+    def test_resume_goals(self):
+        directory = tempfile.mkdtemp()
+        try:
+            memory = MappedSequentialMemory(100, directory=directory, flush_interval=5)
+            for i in range(10):
+                memory.append_goal(np.full(3, i), np.full(2, i), np.zeros(2), float(i), False)
+            resumed = MappedSequentialMemory(100, directory=directory)
+            self.assertTrue(resumed.nb_entries == 10)
+            self.assertTrue(len(resumed.goals) == 10)
+            self.assertTrue(np.all(resumed.goals.take(np.arange(10))[:, 0] == np.arange(10)))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_resume_batch_goals(self):
+        directory = tempfile.mkdtemp()
+        try:
+            memory = MappedSequentialMemory(100, directory=directory, flush_interval=8)
+            for i in range(3):
+                steps = np.arange(4*i, 4*i + 4)
+                memory.append_batch(np.repeat(steps[:, None], 3, axis=1), np.zeros((4, 2)), steps.astype(np.float32),
+                                    np.zeros(4, dtype=bool), goals=np.repeat(steps[:, None], 2, axis=1))
+            resumed = MappedSequentialMemory(100, directory=directory)
+            self.assertTrue(resumed.nb_entries == 8)
+            self.assertTrue(len(resumed.goals) == 8)
+            self.assertTrue(np.all(resumed.goals.take(np.arange(8))[:, 0] == resumed.observations.take(np.arange(8))[:, 0]))
+        finally:
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    pytest.main([sys.argv[0]])
@@ -0,0 +1,60 @@
+from torch_rl.memory import SharedReplayMemory
+from unittest import TestCase
+import multiprocessing as mp
+import numpy as np
+import pytest
+import sys
+
+
+def append_worker(memory, index, steps):
+    region = memory.region(index)
+    for i in range(steps):
+        region.append(np.full(3, 1000*index + i), np.full(2, index), float(i), (i+1) % 10 == 0)
+    del region
+    memory.close()
+
+
+class SharedReplayMemoryTest(TestCase):
+
+    def test_actor_regions(self):
+        memory = SharedReplayMemory(200, (3,), (2,), num_actors=2)
+        try:
+            ctx = mp.get_context('spawn')
+            processes = [ctx.Process(target=append_worker, args=(memory, i, 60 + 70*i)) for i in range(2)]
+            for p in processes:
+                p.start()
+            for p in processes:
+                p.join()
+            self.assertTrue(all(p.exitcode == 0 for p in processes))
+            # The second region of 100 transitions wrapped around
+            self.assertTrue(np.all(memory.arrays.counts == [60, 130]))
+            self.assertTrue(memory.nb_entries == 160)
+
+            s0, a, r, s1, t1 = memory.sample_and_split(256)
+            self.assertTrue(s0.shape == (256, 3) and a.shape == (256, 2))
+            # Transitions never mix actors and follow-ups are the next observation of the same actor
+            self.assertTrue(np.all(s0[:, 0] // 1000 == a[:, 0]))
+            self.assertTrue(np.all(s1[:, 0] == s0[:, 0] + 1))
+            self.assertTrue(np.all(s0[a[:, 0] == 1, 0] >= 1030), "Overwritten transitions are never sampled")
+            self.assertFalse(np.any((r % 10 == 0) & (r > 30)))
+        finally:
+            memory.close()
+
+    def test_goals(self):
+        memory = SharedReplayMemory(20, (3,), (2,), num_actors=1)
+        try:
+            region = memory.region(0)
+            with self.assertRaises(NotImplementedError):
+                region.append_goal(np.zeros(3), np.zeros(2), np.zeros(2), 0., False)
+            with self.assertRaises(NotImplementedError):
+                region.append_batch(np.zeros((2, 3)), np.zeros((2, 2)), np.zeros(2), np.zeros(2, dtype=bool),
+                                    goals=np.zeros((2, 2)))
+            region.append_batch(np.zeros((2, 3)), np.zeros((2, 2)), np.zeros(2), np.zeros(2, dtype=bool))
+            self.assertTrue(memory.arrays.counts[0] == 2)
+            del region
+        finally:
+            memory.close()
+
+
+if __name__ == '__main__':
+    pytest.main([sys.argv[0]])
@@ -0,0 +1,70 @@
+from torch_rl.envs import DummyVecEnv, SubprocVecEnv, SharedMemoryVecEnv
+from gym import spaces
+from unittest import TestCase
+import numpy as np
+import pytest
+import sys
+
+
+class CountingEnv(object):
+    """
+        Observation is the step in the episode, episodes of environment i last i+2 steps.
+    """
+    def __init__(self, episode_len):
+        self.episode_len = episode_len
+        self.observation_space = spaces.Box(-np.inf, np.inf, shape=(1,), dtype=np.float32)
+        self.action_space = spaces.Box(-1., 1., shape=(1,), dtype=np.float32)
+        self.t = 0
+
+    def reset(self):
+        self.t = 0
+        return np.zeros(1, dtype=np.float32)
+
+    def step(self, action):
+        self.t += 1
+        return np.full(1, self.t, dtype=np.float32), float(action[0]), self.t >= self.episode_len, {}
+
+
+class FailingEnv(CountingEnv):
+
+    def step(self, action):
+        raise ValueError("Simulation failed")
+
+
+def env_fns(num_envs):
+    return [lambda i=i: CountingEnv(i + 2) for i in range(num_envs)]
+
+
+class VecEnvTest(TestCase):
+
+    def check_rollout(self, env):
+        obs = env.reset()
+        self.assertTrue(obs.shape == (3, 1))
+        for t in range(1, 7):
+            obs, rewards, dones, infos = env.step(np.full((3, 1), 0.5))
+            self.assertTrue(np.all(rewards == 0.5))
+            episode_lens = np.arange(3) + 2
+            self.assertTrue(np.all(dones == (t % episode_lens == 0)))
+            # Finished environments are reset
+            self.assertTrue(np.all(obs[:, 0] == t % episode_lens))
+        env.close()
+
+    def test_dummy(self):
+        self.check_rollout(DummyVecEnv(env_fns(3)))
+
+    def test_subproc(self):
+        self.check_rollout(SubprocVecEnv(env_fns(3)))
+
+    def test_shared_memory(self):
+        self.check_rollout(SharedMemoryVecEnv(env_fns(3)))
+
+    def test_shared_memory_worker_error(self):
+        env = SharedMemoryVecEnv([lambda: CountingEnv(2), lambda: FailingEnv(2)])
+        env.reset()
+        with self.assertRaises(RuntimeError):
+            env.step(np.zeros((2, 1)))
+        env.close()
+
+
+if __name__ == '__main__':
+    pytest.main([sys.argv[0]])
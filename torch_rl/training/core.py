@@ -16,6 +16,52 @@ def mse_loss(input, target):
     return tor.mean(tor.sum((input - target) ** 2))
 
 
+def weighted_mse_loss(input, target, weights):
+    return tor.mean(tor.sum(weights * (input - target) ** 2))
+
+
+def shuffled_minibatches(n, batch_size, device=None):
+    """
+    Yields index tensors of random minibatches over range(n), the permutation is drawn on
+    device so that rollouts stored on the device can be indexed without a host round trip.
+    """
+    inds = tor.randperm(n, device=device)
+    for start in range(0, n, batch_size):
+        yield inds[start:start + batch_size]
+
+
+import copy
+
+class ModelPlacement(object):
+    """
+        Keeps a learner copy of a model on the training device and an actor copy on the
+        CPU for rollouts, so that no module has to move between devices during training.
+        The parameters of both copies are views into flat buffers, sync copies all learner
+        parameters into the actor with one copy after an update.
+    """
+
+    def __init__(self, model, device=None):
+        if device is None:
+            device = 'cuda' if tor.cuda.is_available() else 'cpu'
+        self.device = tor.device(device)
+        # Moves the parameters in place, optimizers created on the model stay valid
+        self.learner = model.to(self.device)
+        self.actor = copy.deepcopy(self.learner).cpu()
+        for p in self.actor.parameters():
+            p.requires_grad_(False)
+
+        self.learner_parameters = FlatParameters(self.learner)
+        self.actor_parameters = FlatParameters(self.actor, pin_memory=self.device.type == 'cuda')
+        self.flat = self.actor_parameters.data
+        self.sync()
+
+    def sync(self):
+        with tor.no_grad():
+            self.actor_parameters.hard_update(self.learner_parameters)
+            for actor_buffer, learner_buffer in zip(self.actor.buffers(), self.learner.buffers()):
+                actor_buffer.copy_(learner_buffer)
+
+
 
 class Trainer(object):
 
@@ -34,34 +80,37 @@ class Trainer(object):
     def train(self, num_episodes, max_episode_len, render=False, verbose=True, callbacks=[]):
         self._warmup()
         self.verbose = True
-        for episode in range(num_episodes):
-            self.state = self.env.reset()
-            t_episode_start = time.time()
-            self._episode_start()
-            acc_reward = 0
-            for step in range(max_episode_len):
-                s, r, d, i = self._episode_step(episode)
-                acc_reward += r
+        try:
+            for episode in range(num_episodes):
+                self.state = self.env.reset()
+                t_episode_start = time.time()
+                self._episode_start()
+                acc_reward = 0
+                for step in range(max_episode_len):
+                    s, r, d, i = self._episode_step(episode)
+                    acc_reward += r
+                    for callback in callbacks:
+                        callback.step(episode=episode, step=step, reward=r, **i)
+                    if render:
+                        self.env.render()
+                    if d:
+                        break
+
+                #TODO implement these callbacks a bit better
                 for callback in callbacks:
-                    callback.step(episode=episode, step=step, reward=r, **i)
-                if render:
-                    self.env.render()
-                if d:
-                    break
-
-            #TODO implement these callbacks a bit better
-            for callback in callbacks:
-                if hasattr(callback, "episode_step"):
-                    callback.episode_step(episode=episode, step=step, episode_reward=acc_reward)
-            acc_reward = 0
-            self._episode_end(episode)
-
-            episode_time = time.time() - t_episode_start
-            logger.logkv("training_time", "{:.2f}".format(time.clock() / 60))
-            logger.logkv("episode", episode)
-            logger.logkv("episode_time", episode_time / 60)
-            logger.logkv("episode_steps", step+1)
-            logger.dumpkvs()
+                    if hasattr(callback, "episode_step"):
+                        callback.episode_step(episode=episode, step=step, episode_reward=acc_reward)
+                acc_reward = 0
+                self._episode_end(episode)
+
+                episode_time = time.time() - t_episode_start
+                logger.logkv("training_time", "{:.2f}".format(time.clock() / 60))
+                logger.logkv("episode", episode)
+                logger.logkv("episode_time", episode_time / 60)
+                logger.logkv("episode_steps", step+1)
+                logger.dumpkvs()
+        finally:
+            self._train_end()
 
     def _episode_step(self):
         raise NotImplementedError()
@@ -78,6 +127,12 @@ class Trainer(object):
     def _warmup(self):
         pass
 
+    def _train_end(self):
+        """
+        Called when train returns, stops everything that runs in the background.
+        """
+        pass
+
 
 from multiprocessing import Lock
 import time
@@ -109,15 +164,18 @@ class HorizonTrainer(Trainer):
         self.verbose = True
         self.render = render
 
-        self.state = self.env.reset()
-        for self.hstep in range(horizon):
-
-            time_start = time.time()
-            self._horizon_step()
-            time_end = time.time()
-            dt = time_end - time_start
-            logger.logkv('stime', dt/60.)
-            self._horizon_step_end()
+        try:
+            self.state = self.env.reset()
+            for self.hstep in range(horizon):
+
+                time_start = time.time()
+                self._horizon_step()
+                time_end = time.time()
+                dt = time_end - time_start
+                logger.logkv('stime', dt/60.)
+                self._horizon_step_end()
+        finally:
+            self._train_end()
      
     def _horizon_step(self):
         raise NotImplementedError()
@@ -2,9 +2,14 @@ from torch_rl.training.core import *
 from torch.optim import Adam
 from torch_rl.utils import *
 
-from torch_rl.core import ActorCriticAgent
-from torch_rl.memory import SequentialMemory
+from torch_rl.core import ActorCriticAgent, InferenceSession
+from torch_rl.memory import SequentialMemory, BatchPrefetcher, SharedReplayMemory
+from torch_rl.envs.vec_env import VecEnv
+import numpy as np
 import copy
+import threading
+import time
+import torch.multiprocessing as tor_mp
 from torch_rl.utils import logger
 
 """
@@ -13,16 +18,37 @@ from torch_rl.utils import logger
 """
 
 class DDPGTrainer(Trainer):
+    """
+        Environment interaction and learning are decoupled: the learner runs n_updates
+        updates on batches drawn in one bulk sample after every update_interval
+        environment steps. With background_learner the updates run on a separate thread
+        that shares the replay memory under memory_lock, the environment loop then never
+        waits for updates and acts with a copy of the actor that is synced after every
+        round of updates. The update to data ratio is kept as long as the learner keeps up.
+
+        If env is a VecEnv the actions of all environments are computed with one forward
+        pass of the actor, the exploration noise has one process per environment and all
+        transitions of a step are appended interleaved into a replay memory with
+        stride=num_envs. Finished environments are reset by the VecEnv, an episode then
+        lasts max_episode_len steps of all environments and update_interval counts steps
+        of the VecEnv.
+    """
 
     critic_criterion = mse_loss
 
     def __init__(self, env, actor, critic, num_episodes=2000, max_episode_len=500, batch_size=32, gamma=.99,
-              replay_memory=SequentialMemory(1000000, window_length=1), tau=1e-3, lr_critic=1e-3, lr_actor=1e-4, warmup=2000, depsilon=1./5000,
+              replay_memory=None, tau=1e-3, lr_critic=1e-3, lr_actor=1e-4, warmup=2000, depsilon=1./5000,
                  epsilon=1., exploration_process=None,
-                 optimizer_critic=None, optimizer_actor=None):
+                 optimizer_critic=None, optimizer_actor=None, prefetch=0,
+                 n_updates=1, update_interval=1, background_learner=False):
         super(DDPGTrainer, self).__init__(env)
+        self.vectorized = isinstance(env, VecEnv)
+        self.num_envs = env.num_envs if self.vectorized else 1
+        if replay_memory is None:
+            replay_memory = SequentialMemory(1000000, window_length=1, contiguous=True, stride=self.num_envs)
         if exploration_process is None:
-            self.random_process = OrnsteinUhlenbeckActionNoise(self.env.action_space.shape[0])
+            self.random_process = OrnsteinUhlenbeckActionNoise(self.env.action_space.shape[0],
+                                                               num_envs=self.num_envs if self.vectorized else None)
         else:
             self.random_process = exploration_process
         self.action_choice_function = random_process_action_choice(self.random_process)
@@ -42,69 +68,212 @@ class DDPGTrainer(Trainer):
         self.optimizer_critic = Adam(critic.parameters(), lr=lr_critic) if optimizer_critic is None else optimizer_critic
 
         self.goal_based = hasattr(env, "goal")
+        # Prioritized memories are fed back the TD errors of the critic
+        self.prioritized = hasattr(replay_memory, "update_priorities")
+        assert not (self.vectorized and self.goal_based), "Goal based environments are not supported with vectorized environments"
+        assert getattr(replay_memory, "stride", 1) == self.num_envs, \
+            "The replay memory needs stride=num_envs to store the transitions of all environments"
+        self.episodes = 0
+
+        # K updates on one bulk sample of K batches every N environment steps
+        self.n_updates = n_updates
+        self.update_interval = update_interval
+        self.env_steps = 0
+        self.learn_rounds = 0
+
+        # Keep prefetch batches sampled in the background, the memory is shared under the lock
+        self.memory_lock = threading.Lock()
+        self.prefetcher = BatchPrefetcher(replay_memory, batch_size * n_updates, num_batches=prefetch,
+                                          lock=self.memory_lock) if prefetch > 0 else None
 
         self.target_agent = ActorCriticAgent(self.target_actor,self.target_critic)
         self.agent = ActorCriticAgent(actor, critic)
 
+        # The environment loop acts with a copy of the actor that is synced after learning
+        self.actor_placement = ModelPlacement(actor, device=next(actor.parameters()).device)
+        self.actor_lock = threading.Lock()
+        self.actor_session = InferenceSession(self.actor_placement.actor, batch_size=self.num_envs)
+
+        self.actor_parameters = self.actor_placement.learner_parameters
+        self.critic_parameters = FlatParameters(critic)
+        self.target_actor_parameters = FlatParameters(self.target_actor)
+        self.target_critic_parameters = FlatParameters(self.target_critic)
+
+        self.background_learner = background_learner
+        self.learn_condition = threading.Condition()
+        self.learner_thread = None
+        self.learner_error = None
+        self.losses = None
+
     def add_to_replay_memory(self,s,a,r,d):
-        if self.goal_based:
-            self.replay_memory.append(self.state, self.env.goal, a, r, d, training=True)
-        else:
-            self.replay_memory.append(self.state, a, r, d, training=True)
+        with self.memory_lock:
+            if self.vectorized:
+                self.replay_memory.append_batch(self.state, a, r, d, training=True)
+            elif self.goal_based:
+                self.replay_memory.append_goal(self.state, self.env.goal, a, r, d, training=True)
+            else:
+                self.replay_memory.append(self.state, a, r, d, training=True)
 
     def _warmup(self):
 
-        for i in range(self.warmup):
-            a = self.env.action_space.sample()
+        space = self.env.action_space
+        for i in range(-(-self.warmup // self.num_envs)):
+            if self.vectorized:
+                a = np.random.uniform(space.low, space.high, size=(self.num_envs,) + space.shape).astype(np.float32)
+            else:
+                a = space.sample()
             s, r, d, _ = self.env.step(a)
             self.add_to_replay_memory(self.state, a, r, d)
             self.state = s
 
+        if self.prefetcher is not None:
+            self.prefetcher.start()
+        if self.background_learner:
+            self.start_learner()
+
+    def start_learner(self):
+        if self.learner_thread is None:
+            self.learning = True
+            self.learner_thread = threading.Thread(target=self._learner_loop, daemon=True)
+            self.learner_thread.start()
+
+    def stop_learner(self):
+        if self.learner_thread is not None:
+            self.learning = False
+            with self.learn_condition:
+                self.learn_condition.notify()
+            self.learner_thread.join()
+            self.learner_thread = None
+
+    def _train_end(self):
+        self.stop_learner()
+        if self.prefetcher is not None:
+            self.prefetcher.stop()
+        # Errors of the learner after the last step are reported as well
+        if self.learner_error is not None:
+            error, self.learner_error = self.learner_error, None
+            raise error
+
+    def _learner_loop(self):
+        try:
+            while self.learning:
+                with self.learn_condition:
+                    # Wait for new data instead of exceeding the update to data ratio
+                    while self.learning and self.learn_rounds >= self.env_steps // self.update_interval:
+                        self.learn_condition.wait(timeout=1.)
+                if self.learning:
+                    self._learn()
+        except Exception as e:
+            self.learner_error = e
+
     def _episode_start(self):
 
         self.random_process.reset()
 
     def _episode_step(self, episode):
-        if self.goal_based:
-            action = self.agent.action(np.hstack((self.state, self.env.goal))).cpu().data.numpy()
-        else:
-            action = self.agent.action(self.state).cpu().data.numpy()
+        with self.actor_lock:
+            if self.goal_based:
+                action = self.actor_session(self.state, self.env.goal)[0]
+            elif self.vectorized:
+                action = self.actor_session(self.state)
+            else:
+                action = self.actor_session(self.state)[0]
 
         # Choose action with exploration
         action = self.action_choice_function(action, self.epsilon)
         if self.epsilon > 0:
-            self.epsilon -= self.depsilon
+            self.epsilon -= self.depsilon * self.num_envs
 
         state, reward, done, info = self.env.step(action)
 
         self.add_to_replay_memory(self.state, action, reward, done)
         self.state = state
+        self.env_steps += 1
+
+        if self.vectorized and np.any(done):
+            # Finished environments start a new episode with a new noise process
+            self.random_process.reset(done)
+            self.episodes += int(np.sum(done))
+            logger.logkv("episodes", self.episodes)
+
+        if self.background_learner:
+            if self.learner_error is not None:
+                raise self.learner_error
+            self.start_learner()
+            with self.learn_condition:
+                self.learn_condition.notify()
+        elif self.env_steps % self.update_interval == 0:
+            self._learn()
+
+        # Losses are logged from the environment loop, the learner thread must not write to the logger
+        if self.losses is not None:
+            logger.logkv('loss_actor', self.losses[0])
+            logger.logkv('loss_critic', self.losses[1])
+        logger.logkv('epsilon', self.epsilon)
+
+        if self.vectorized:
+            return state, np.mean(reward), False, {}
+        return state, reward, done, {}
+
+    def _sample_batches(self):
+        """
+        Samples the batches of all n_updates updates at once and splits them.
+        """
+        # Prefetched batches are already tensors on the device
+        if self.prefetcher is not None:
+            batch = self.prefetcher.next()
+        else:
+            with self.memory_lock:
+                batch = self.replay_memory.sample_and_split(self.batch_size * self.n_updates)
+        return [[x[i * self.batch_size:(i + 1) * self.batch_size] for x in batch] for i in range(self.n_updates)]
+
+    def _learn(self):
+        for batch in self._sample_batches():
+            self._update(batch)
+        with self.actor_lock:
+            self.actor_placement.sync()
+        self.learn_rounds += 1
+
+    def _update(self, batch):
+        """
+        One critic and actor update on batch followed by the soft target updates.
+        """
+        if self.prioritized:
+            batch, weights, batch_idxs = batch[:-2], batch[-2], batch[-1]
+            weights = weights if tor.is_tensor(weights) else to_tensor(weights)
 
-        # Optimize over batch
         if self.goal_based:
-            s1, g, a1, r, s2, terminal = self.replay_memory.sample_and_split(self.batch_size)
-            s1 = np.hstack((s1,g))
-            s2 = np.hstack((s2,g))
+            s1, g, a1, r, s2, terminal = batch
         else:
-            s1, a1, r, s2, terminal = self.replay_memory.sample_and_split(self.batch_size)
+            s1, a1, r, s2, terminal = batch
+        s1, a1, r, s2 = [x if tor.is_tensor(x) else to_tensor(x) for x in (s1, a1, r, s2)]
+        if self.goal_based:
+            g = g if tor.is_tensor(g) else to_tensor(g)
+            s1 = tor.cat((s1, g), 1)
+            s2 = tor.cat((s2, g), 1)
 
 
         a2 = self.target_agent.actions(s2, volatile=True)
 
-        q2 = self.target_agent.values(to_tensor(s2, volatile=True), a2, volatile=False)
+        q2 = self.target_agent.values(s2, a2, volatile=False)
         q2.volatile = False
 
-        q_expected = to_tensor(np.asarray(r), volatile=False) + self.gamma * q2
-        q_predicted = self.agent.values(to_tensor(s1), to_tensor(a1), requires_grad=True)
+        q_expected = r + self.gamma * q2
+        q_predicted = self.agent.values(s1, a1, requires_grad=True)
 
         self.optimizer_critic.zero_grad()
-        loss_critic = DDPGTrainer.critic_criterion(q_expected, q_predicted)
+        if self.prioritized:
+            loss_critic = weighted_mse_loss(q_expected, q_predicted, weights)
+            with self.memory_lock:
+                self.replay_memory.update_priorities(batch_idxs, (q_expected - q_predicted).cpu().data.numpy())
+        else:
+            loss_critic = DDPGTrainer.critic_criterion(q_expected, q_predicted)
         loss_critic.backward()
         self.optimizer_critic.step()
         # Actor optimization
 
         a1 = self.agent.actions(s1, requires_grad=True)
-        q_input = tor.cat([to_tensor(s1), a1], 1)
+        q_input = tor.cat([s1, a1], 1)
         q = self.agent.values(q_input, requires_grad=True)
         loss_actor = -q.mean()
 
@@ -112,15 +281,126 @@ class DDPGTrainer(Trainer):
         loss_actor.backward()
         self.optimizer_actor.step()
 
-        logger.logkv('loss_actor', loss_actor.cpu().data.numpy())
-        logger.logkv('loss_critic', loss_critic.cpu().data.numpy())
-        logger.logkv('epsilon', self.epsilon)
-
-        soft_update(self.target_agent.policy_network, self.agent.policy_network, self.tau)
-        soft_update(self.target_agent.critic_network, self.agent.critic_network, self.tau)
+        self.losses = (loss_actor.cpu().data.numpy(), loss_critic.cpu().data.numpy())
 
-        return state, reward, done, {}
+        soft_update(self.target_actor_parameters, self.actor_parameters, self.tau)
+        soft_update(self.target_critic_parameters, self.critic_parameters, self.tau)
 
     def _episode_end(self, episode):
         pass
 
+
+def ddpg_actor_worker(index, env_fn, actor, parameters, lock, memory, running, max_episode_len,
+                      sync_interval, exploration_kwargs):
+    tor.manual_seed(tor.initial_seed() + index)
+    np.random.seed((np.random.randint(2**31) + index) % 2**31)
+    env = env_fn()
+    region = memory.region(index)
+    random_process = OrnsteinUhlenbeckActionNoise(env.action_space.shape[0], **exploration_kwargs)
+    # The parameters of the actor become views into a local copy of the published weights
+    local_parameters = parameters.clone()
+    tor.nn.utils.vector_to_parameters(local_parameters, actor.parameters())
+    session = InferenceSession(actor)
+    try:
+        state, episode_step, step = env.reset(), 0, 0
+        while running.value:
+            if step % sync_interval == 0:
+                with lock:
+                    local_parameters.copy_(parameters)
+            action = session(state)[0] + random_process()
+            next_state, reward, done, _ = env.step(action)
+            region.append(state, action, reward, done)
+            state = next_state
+            step += 1
+            episode_step += 1
+            if done or episode_step == max_episode_len:
+                state, episode_step = env.reset(), 0
+                random_process.reset()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # Views into the shared arrays have to be released before they are closed
+        del region
+        memory.close()
+
+
+class ApeXDDPGTrainer(DDPGTrainer):
+    """
+        DDPG with actor processes in the style of Ape-X. Every actor builds its
+        environment with env_fn, acts with the weights the learner published at most
+        sync_interval steps ago and appends its transitions into its own region of a
+        SharedReplayMemory, no transition goes through a queue. The learner only samples
+        and updates, every step of the trainer is one round of n_updates updates
+        followed by the publication of the new actor weights.
+    """
+
+    def __init__(self, env_fn, actor, critic, num_actors=2, memory_limit=1000000, sync_interval=100,
+                 exploration_kwargs=None, context=None, max_episode_len=500, **kwargs):
+        # The local environment only provides the spaces, actors create their own
+        env = env_fn()
+        memory = SharedReplayMemory(memory_limit, env.observation_space.shape, env.action_space.shape, num_actors)
+        super(ApeXDDPGTrainer, self).__init__(env, actor, critic, replay_memory=memory,
+                                              max_episode_len=max_episode_len, **kwargs)
+        assert not self.goal_based, "Goal based environments are not supported by the Ape-X trainer"
+        assert not self.background_learner, "The learner of the Ape-X trainer runs in the main thread"
+        self.env_fn = env_fn
+        self.num_actors = num_actors
+        self.sync_interval = sync_interval
+        self.exploration_kwargs = {} if exploration_kwargs is None else exploration_kwargs
+
+        ctx = tor_mp.get_context(context)
+        self.ctx = ctx
+        self.lock = ctx.Lock()
+        self.running = ctx.Value('b', 0)
+        self.parameters = self.actor_placement.flat.clone().share_memory_()
+        self.processes = []
+
+    def start(self):
+        if self.processes:
+            return
+        self.running.value = 1
+        self.processes = [self.ctx.Process(target=ddpg_actor_worker, daemon=True,
+                                           args=(i, self.env_fn, copy.deepcopy(self.actor_placement.actor),
+                                                 self.parameters, self.lock, self.replay_memory, self.running,
+                                                 self.max_episode_len, self.sync_interval, self.exploration_kwargs))
+                          for i in range(self.num_actors)]
+        for p in self.processes:
+            p.start()
+
+    def _train_end(self):
+        self.running.value = 0
+        for p in self.processes:
+            p.join()
+        self.processes = []
+        super(ApeXDDPGTrainer, self)._train_end()
+
+    def close(self):
+        self._train_end()
+        self.replay_memory.close()
+
+    def _check_actors(self):
+        if not all(p.is_alive() for p in self.processes):
+            raise RuntimeError("An actor process failed")
+
+    def _warmup(self):
+        self.start()
+        # Wait for enough transitions to fill the first batches
+        while self.replay_memory.nb_entries < max(self.warmup, self.batch_size * self.n_updates + self.num_actors):
+            self._check_actors()
+            time.sleep(1e-2)
+        if self.prefetcher is not None:
+            self.prefetcher.start()
+
+    def _episode_step(self, episode):
+        self._check_actors()
+        self._learn()
+
+        # Publish the weights of the update
+        with self.lock:
+            self.parameters.copy_(self.actor_placement.flat)
+
+        logger.logkv('loss_actor', self.losses[0])
+        logger.logkv('loss_critic', self.losses[1])
+        logger.logkv('actor_steps', int(self.replay_memory.arrays.counts.sum()))
+
+        return self.state, 0., False, {}
@@ -2,20 +2,43 @@
     Implementation of evolution strategies for RL environments in PyTorch
 """
 
-from torch import nn
 import numpy as np
 import torch as tor
 from torch import nn
 import copy
-import numpy as np
 from multiprocessing import Pool
-from torch.distributions import MultivariateNormal, Normal, Uniform
+from functools import partial
+from torch_rl.core import InferenceSession
+from torch_rl.utils import FlatParameters, logger
+from torch_rl.envs.vec_env import VecEnv
+from torch.func import functional_call, vmap
 
 
 class ESModel(nn.Module):
+    """
+        Policy for evolution strategies, either wraps a module or builds a network of
+        linear layers with the activation functions of the given architecture.
+    """
     def __init__(self, architecture, activation_functions=None):
         super(ESModel, self).__init__()
-        self.model = nn.Sequential(*params)
+        if isinstance(architecture, nn.Module):
+            self.model = architecture
+        else:
+            if activation_functions is None:
+                activation_functions = [nn.Tanh() for _ in range(len(architecture) - 1)]
+            params = []
+            for i in range(len(architecture) - 1):
+                params.append(nn.Linear(architecture[i], architecture[i + 1]))
+                params.append(activation_functions[i])
+            self.model = nn.Sequential(*params)
+        self._flat_parameters = None
+
+    @property
+    def flat_parameters(self):
+        # Copies and device moves of the model allocate new parameters, those are bound again
+        if self._flat_parameters is None or not self._flat_parameters.bound:
+            self._flat_parameters = FlatParameters(self.model)
+        return self._flat_parameters
 
     def sample_from_distribution(self, distribution):
 
@@ -24,16 +47,14 @@ class ESModel(nn.Module):
         self.set_flattened_parameters(parameters)
 
     def flattened_parameters(self):
-        return tor.cat([param.data.view(-1) for param in self.parameters()])
+        """
+        Flat buffer the parameters are views of, changes to it change the model.
+        """
+        return self.flat_parameters.data
 
 
     def set_flattened_parameters(self, parameters):
-        ind = 0
-        for param in self.model.parameters():
-            param_shape = param.data.shape
-            num_params = np.prod(param_shape)
-            param.data = parameters[ind:ind+num_params].view(param_shape)
-            ind+=num_params
+        self.flat_parameters.set(parameters)
 
     def __call__(self, x):
         return self.model.forward(x)
@@ -42,110 +63,258 @@ class ESModel(nn.Module):
         return self.model.forward(x)
 
 
-def es_eval_policy(policy, env, seed, sigma,steps=200):
-        import numpy as np
-        import scipy
-
+def run_episode(policy, env, steps=200):
+        """
+        Runs policy for one episode of at most steps steps.
+        :return: Sum of the rewards and number of steps of the episode
+        """
         s = env.reset()
-        dist = Normal(tor.zeros_like(policy.flattened_parameters()), 1.)
         rewards = []
-        #Apply gaussian noise to parameters
-        tor.manual_seed(seed)
-        policy.set_flattened_parameters(policy.flattened_parameters() + dist.rsample()*sigma)
+        session = InferenceSession(policy)
 
         for i in range(steps):
-            a = policy(tor.from_numpy(s.reshape(1,-1).astype(np.float32))).data.numpy().flatten()
+            a = session(s).flatten()
             s, r, d, _ = env.step(a)
-            if d:
-                s = env.reset()
             rewards.append(r)
+            if d:
+                break
 
         rewards = np.asarray(rewards)
         #rewards = (rewards - rewards.mean())/rewards.std()
         #Use mean reward
         F = np.sum(rewards)
-        return F
-
-
+        return F, len(rewards)
 
-def cma_eval_policy(policy, env ,steps=200):
-        import numpy as np
-        import scipy
 
-        s = env.reset()
-        rewards = []
+def es_eval_policy(policy, env, parameters, noise, sigma, steps=200):
+        #Apply gaussian noise to parameters
+        policy.set_flattened_parameters(parameters + noise*sigma)
+        return run_episode(policy, env, steps)
+
+
+
+def cma_eval_policy(policy, env, parameters, steps=200):
+        policy.set_flattened_parameters(parameters)
+        return run_episode(policy, env, steps)
 
-        for i in range(steps):
-            a = policy(tor.from_numpy(s.reshape(1,-1).astype(np.float32))).data.numpy().flatten()
-            s, r, d, _ = env.step(a)
-            if d:
-                s = env.reset()
-            rewards.append(r)
 
-        rewards = np.asarray(rewards)
-        #rewards = (rewards - rewards.mean())/rewards.std()
-        #Use mean reward
-        F = np.sum(rewards)
-        return F
+class SharedNoiseTable(object):
+    """
+        Block of standard normal noise in shared memory as in https://arxiv.org/abs/1703.03864.
+        A perturbation is the slice of the table at an offset, so only offsets have to be
+        sent to the workers and the master never has to regenerate any noise.
+    """
+
+    def __init__(self, size=25000000, seed=123):
+        self.noise = tor.from_numpy(np.random.RandomState(seed).randn(size).astype(np.float32)).share_memory_()
+
+    def __len__(self):
+        return len(self.noise)
+
+    def get(self, offset, dim):
+        return self.noise[offset:offset + dim]
+
+    def sample_offsets(self, dim, num):
+        return np.random.randint(0, len(self.noise) - dim + 1, size=num)
+
+    def get_batch(self, offsets, dim):
+        """
+        :return: Noise slices at offsets [len(offsets), dim]
+        """
+        return self.noise[tor.as_tensor(offsets)[:, None] + tor.arange(dim)[None]]
+
+    def weighted_sum(self, offsets, weights, dim, batch_size=None):
+        """
+        Sum of the noise slices at offsets weighted by weights, computed as matrix products
+        over batches of slices. By default a batch holds about 16M noise values.
+        """
+        if batch_size is None:
+            batch_size = max(2**24 // dim, 1)
+        weights = tor.as_tensor(np.asarray(weights, dtype=np.float32))
+        result = tor.zeros(dim)
+        for start in range(0, len(offsets), batch_size):
+            result += weights[start:start + batch_size].matmul(self.get_batch(offsets[start:start + batch_size], dim))
+        return result
+
+
+# Resident state of an ES pool worker, set once by the pool initializer
+es_worker = {}
+
+
+def init_es_worker(env_fn, model_fn, eval_function, noise_table, parameters):
+    es_worker.update(env=env_fn(), model=model_fn(), eval_function=eval_function,
+                     noise_table=noise_table, parameters=parameters)
+
+
+def es_worker_eval(task):
+    index, (offset, sigma) = task
+    parameters = es_worker['parameters']
+    noise = es_worker['noise_table'].get(offset, len(parameters))
+    return (index,) + es_worker['eval_function'](es_worker['model'], es_worker['env'], parameters, noise, sigma)
+
+
+def cma_worker_eval(task):
+    index, parameters = task
+    return (index,) + es_worker['eval_function'](es_worker['model'], es_worker['env'], tor.from_numpy(parameters))
+
+
+class ESWorkerPool(object):
+    """
+        Pool of processes that build their environment and model once with env_fn and
+        model_fn and keep them for the whole training, which also makes environments
+        usable that cannot be copied such as the OpenSim ones. Per generation the workers
+        only receive noise offsets or parameter vectors and return scores and episode
+        lengths. Tasks are handed out in small chunks as workers finish, so episodes of
+        different lengths do not leave workers idle.
+    """
+
+    def __init__(self, env_fn, model_fn, eval_function, num_workers=8, noise_table=None, parameters=None):
+        self.num_workers = num_workers
+        self.pool = Pool(num_workers, initializer=init_es_worker,
+                         initargs=(env_fn, model_fn, eval_function, noise_table, parameters))
+
+    def evaluate(self, worker_function, tasks):
+        """
+        :param worker_function: es_worker_eval or cma_worker_eval
+        :param tasks: Noise offsets with sigmas or parameter vectors of the population members
+        :return: Scores and episode lengths in the order of tasks
+        """
+        tasks = list(enumerate(tasks))
+        scores = np.empty(len(tasks))
+        steps = np.empty(len(tasks), dtype=np.int64)
+        chunksize = max(len(tasks) // (4 * self.num_workers), 1)
+        for index, score, nsteps in self.pool.imap_unordered(worker_function, tasks, chunksize=chunksize):
+            scores[index] = score
+            steps[index] = nsteps
+        return scores, steps
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+    def terminate(self):
+        self.pool.terminate()
+
+
+class PopulationEvaluator(object):
+    """
+        Evaluates a whole population in the current process. The flat parameters of all
+        individuals are mapped over model with vmap, so that one batched forward pass
+        computes the actions of the whole population, and the individuals step a VecEnv
+        with one environment per individual in lockstep. Like run_episode every individual
+        is scored on its first episode of at most steps steps, finished individuals are
+        masked out until all are done. Made for cheap environments where inter-process
+        communication would dominate.
+    """
+
+    def __init__(self, model, env, steps=200):
+        assert isinstance(env, VecEnv), "The population is evaluated on a VecEnv"
+        self.model = model
+        self.env = env
+        self.steps = steps
+        self.names, self.shapes = zip(*[(name, param.shape) for name, param in model.named_parameters()])
+        self.forward = vmap(lambda params, x: functional_call(model, params, (x,)))
+
+    def unflatten(self, population):
+        """
+        Splits flat parameters [population_size, dim] into batched parameters by name.
+        """
+        params, offset = {}, 0
+        for name, shape in zip(self.names, self.shapes):
+            num_params = int(np.prod(shape, dtype=np.int64))
+            params[name] = population[:, offset:offset + num_params].reshape((-1,) + tuple(shape))
+            offset += num_params
+        return params
+
+    def evaluate(self, population):
+        """
+        :param population: Flat parameters of the individuals [population_size, dim]
+        :return: Scores and episode lengths of the individuals
+        """
+        population = tor.as_tensor(population, dtype=tor.float32)
+        assert len(population) == self.env.num_envs, "Population and VecEnv sizes differ"
+        params = self.unflatten(population)
+
+        scores = np.zeros(len(population))
+        steps = np.zeros(len(population), dtype=np.int64)
+        active = np.ones(len(population), dtype=np.bool_)
+        obs = self.env.reset()
+        with tor.inference_mode():
+            for _ in range(self.steps):
+                actions = self.forward(params, tor.as_tensor(np.asarray(obs, dtype=np.float32))).numpy()
+                obs, rewards, dones, _ = self.env.step(actions)
+                scores += rewards * active
+                steps += active
+                active &= ~dones
+                if not active.any():
+                    break
+        return scores, steps
 
 
 from torch_rl.training.core import HorizonTrainer
 
 class ESTrainer(HorizonTrainer):
+    """
+        Evolution strategies with a shared noise table. The current parameters and the
+        noise table live in shared memory, every generation the workers only receive the
+        noise offset and sigma of their population member and return its score. Workers
+        create their environment and model with env_fn and model_fn, by default copies
+        of env and model. With a PopulationEvaluator the population is evaluated in the
+        current process instead.
+    """
 
     def __init__(self, env, model, population_size=100, policy_eval_function=es_eval_policy,
-        num_threads=8, learning_rate=1e-3, sigma=0.1, tau=0.0):
+        num_threads=8, learning_rate=1e-3, sigma=0.1, tau=0.0, noise_table=None, env_fn=None, model_fn=None,
+        evaluator=None):
         super(ESTrainer, self).__init__(env)
         self.population_size = population_size
         self.policy_eval_function = policy_eval_function
         self.learning_rate = learning_rate
         self.model = model
-        self.rollout_models =  np.asarray([copy.deepcopy(model) for i in range(population_size)])
         self.sigma = np.full(population_size, sigma)
-        self.pool = Pool(num_threads)
-        self.envs = np.asarray([copy.deepcopy(env) for _ in range(self.population_size)])
-        self.eligibility_trace = tor.zeros_like(model.flattened_parameters())
+        self.noise_table = SharedNoiseTable() if noise_table is None else noise_table
+        self.parameters = model.flattened_parameters().clone().share_memory_()
+        self.evaluator = evaluator
+        self.pool = None if evaluator is not None else \
+            ESWorkerPool(partial(copy.deepcopy, env) if env_fn is None else env_fn,
+                         partial(copy.deepcopy, model) if model_fn is None else model_fn,
+                         policy_eval_function, num_threads, self.noise_table, self.parameters)
+        self.total_steps = 0
+        self.eligibility_trace = tor.zeros_like(self.parameters)
         self.tau = tau
 
     def _horizon_step(self):
-        
-
-        from collections import deque
-
-        d = deque(maxlen=100)
-            
-        seeds = np.random.randint(0,100000000, self.population_size)
-        params = list(zip(self.rollout_models, self.envs, seeds, self.sigma))
-        scores = self.pool.starmap(self.policy_eval_function, params)
-        real_scores = np.asarray(scores)
-        scores = real_scores
-
-        #Ranked score
-        ranked_scores = np.arange(0, len(scores))
-        sorted_indices = np.flip(np.argsort(scores),0)
-        scores = ranked_scores[sorted_indices]
-
-        sscores = (scores-scores.mean())/(scores.std()+1e-7)
-        nscores = (scores-scores.min())/scores.max()
-        dist = Normal(tor.zeros_like(model.flattened_parameters()), 1.)
-        param_updates = []
-        for score, seed in zip(sscores, seeds):
-            tor.manual_seed(seed)
-            params_update = dist.rsample() * score
-            param_updates.append(params_update)
-
-        param_updates = tor.stack(param_updates)
-        self.eligibility_trace = tor.mean(param_updates, 0) + self.eligibility_trace*self.tau
-        model.set_flattened_parameters(model.flattened_parameters() + (self.learning_rate/self.sigma[0])*self.eligibility_trace)
-
-        #Update main model
-        [m.load_state_dict(model.state_dict()) for m in self.rollout_models]
-
-        d.append(np.mean(real_scores))
-        if self.hstep%1 == 0:
-            print("Step {}, avg score {}, max score {}".format(self.hstep, np.mean(d), np.max(real_scores)), end='\r')
+        offsets = self.noise_table.sample_offsets(len(self.parameters), self.population_size)
+        if self.evaluator is not None:
+            noise = self.noise_table.get_batch(offsets, len(self.parameters))
+            population = self.parameters + noise * tor.from_numpy(self.sigma.astype(np.float32))[:, None]
+            real_scores, steps = self.evaluator.evaluate(population)
+        else:
+            real_scores, steps = self.pool.evaluate(es_worker_eval, zip(offsets, self.sigma))
+        self.total_steps += steps.sum()
+
+        #Centered ranks of the scores
+        ranks = np.empty(len(real_scores))
+        ranks[np.argsort(real_scores)] = np.arange(len(real_scores))
+
+        sscores = (ranks-ranks.mean())/(ranks.std()+1e-7)
+        update = self.noise_table.weighted_sum(offsets, sscores, len(self.parameters)) / self.population_size
+        self.eligibility_trace = update + self.eligibility_trace*self.tau
+
+        #Update main model, the workers read the shared parameters
+        self.parameters += (self.learning_rate/self.sigma[0])*self.eligibility_trace
+        self.model.set_flattened_parameters(self.parameters.clone())
+
+        logger.logkv("avg_score", np.mean(real_scores))
+        logger.logkv("max_score", np.max(real_scores))
+        logger.logkv("total_steps", self.total_steps)
+        logger.dumpkvs()
         #sigma -= sigma_decay
 
+    def _train_end(self):
+        if self.pool is not None:
+            self.pool.close()
+
 
 
 
@@ -153,61 +322,83 @@ class ESTrainer(HorizonTrainer):
 
 
 class CMAESTrainer(HorizonTrainer):
+    """
+        CMA evolution strategy over the flat parameters of model. The covariance of the
+        search distribution is either a dense 'full' matrix, its 'diagonal' as in sep-CMA
+        or 'lowrank', the deviations of the lmbda best individuals plus a diagonal. The
+        diagonal and low rank variants never store a dim x dim matrix. The whole
+        population is sampled as one [population_size, dim] tensor and evaluated by a
+        worker pool or, if given, a PopulationEvaluator.
+    """
     #TODO: better way to guarantee a positive-definite covariance matrix
 
     def __init__(self, env, model, population_size=100, lmbda=25, 
         policy_eval_function=cma_eval_policy, num_threads=8,
-        learning_rate=1e-3, sigma=0.1):
+        learning_rate=1e-3, sigma=0.1, env_fn=None, model_fn=None, covariance='full', evaluator=None):
+        if covariance not in ('full', 'diagonal', 'lowrank'):
+            raise ValueError("Unknown covariance {}".format(covariance))
         super(CMAESTrainer, self).__init__(env)
         self.population_size = population_size
         self.lmbda = lmbda
-        self.policy_eval_function = cma_eval_policy
+        self.policy_eval_function = policy_eval_function
         self.learning_rate = learning_rate
         self.model = model
-        self.rollout_models =  np.asarray([copy.deepcopy(model) for i in range(population_size)])
         self.sigma = np.full(population_size, sigma)
-        self.pool = Pool(num_threads)
-        self.envs = np.asarray([copy.deepcopy(env) for _ in range(self.population_size)])
+        # Workers evaluate the parameter vectors of the population with resident models and environments
+        self.evaluator = evaluator
+        self.pool = None if evaluator is not None else \
+            ESWorkerPool(partial(copy.deepcopy, env) if env_fn is None else env_fn,
+                         partial(copy.deepcopy, model) if model_fn is None else model_fn,
+                         policy_eval_function, num_threads)
+        self.total_steps = 0
 
-        dim = np.prod([param.data.view(-1).shape[0] for param in model.parameters()])
         flat_params = model.flattened_parameters()
+        dim = flat_params.shape[0]
         self.flattened_param_mean_old = tor.zeros_like(flat_params)
 
-        mean = tor.from_numpy(np.zeros(flat_params.shape[0]).astype(np.float32))
-        covar_matrix = tor.from_numpy(np.identity(flat_params.shape[0]).astype(np.float32)+1e-7)
-        distribution = MultivariateNormal(mean, covar_matrix)
-        #Update main model, takes a long time
-        [m.sample_from_distribution(distribution) for m in self.rollout_models]
+        # The search starts from the identity covariance, the low rank factor is empty
+        self.covariance = covariance
+        self.covar_matrix = tor.eye(dim) if covariance == 'full' else None
+        self.covar_diagonal = tor.ones(dim)
+        self.covar_factor = tor.zeros(dim, 0)
+        # Parameters of the population [population_size, dim]
+        self.population = self._sample_population(self.flattened_param_mean_old)
+
+    def _sample_population(self, mean):
+        """
+        Samples the parameters of all individuals with one matrix operation.
+        :return: Parameters [population_size, dim]
+        """
+        noise = tor.randn(self.population_size, mean.shape[0])
+        if self.covariance == 'full':
+            return mean + noise.matmul(tor.linalg.cholesky(self.covar_matrix).t())
+
+        samples = mean + noise * self.covar_diagonal.sqrt()
+        if self.covar_factor.shape[1] > 0:
+            samples += tor.randn(self.population_size, self.covar_factor.shape[1]).matmul(self.covar_factor.t())
+        return samples
     
     def _horizon_step(self):
         #Layer-wise randomness
 
-        from collections import deque
-
-        d = deque(maxlen=100)
-            
-        params = list(zip(self.rollout_models, self.envs))
-        scores = self.pool.starmap(self.policy_eval_function, params)
-        scores = np.asarray(scores)
+        if self.evaluator is not None:
+            scores, steps = self.evaluator.evaluate(self.population)
+        else:
+            scores, steps = self.pool.evaluate(cma_worker_eval, self.population.numpy())
+        self.total_steps += steps.sum()
         
-        env_scores = scores
-        parameters_stacked = tor.stack([m.flattened_parameters() for m in self.rollout_models], 0)
+        env_scores = scores.copy()
+        parameters_stacked = self.population
         #L2 loss
         l2_loss = tor.mean(parameters_stacked * parameters_stacked, 1)         
         scores -= l2_loss.data.numpy()
 
         sscores = (scores-scores.mean())/(scores.std()+1e-7).astype(np.float32)
-        nscores = (scores-scores.min())/scores.max()
 
         #Sort scores and take first lambda best individuals
         best_indices = np.flip(np.argsort(sscores), axis=0)[:self.lmbda]
-        worst_indices = np.full(scores.shape[0], True)
-        worst_indices[best_indices[0]] = False
-
-        self.flattened_param_mean_old = model.flattened_parameters()
 
-        tor_scores  = tor.from_numpy(sscores[:self.lmbda])
-        best_parameters_stacked = tor.stack([m.flattened_parameters() for m in self.rollout_models[best_indices]], 0)
+        best_parameters_stacked = self.population[tor.from_numpy(best_indices.copy())]
         mean_parameters_new = tor.mean(best_parameters_stacked, 0)
 
         best_new_parameters = mean_parameters_new 
@@ -215,29 +406,38 @@ class CMAESTrainer(HorizonTrainer):
         #Calculate covariance matrix
 
 
-        covar_matrix = best_parameters_stacked - self.flattened_param_mean_old
-        covar_matrix = (covar_matrix.transpose(1,0).matmul(covar_matrix))/float(self.lmbda)
+        deviations = best_parameters_stacked - self.flattened_param_mean_old
         #Make the matrix positive definite
         #dist = Uniform(tor.zeros(covar_matrix.shape[0])+5e-2, tor.zeros(covar_matrix.shape[0]) + 5e-1)
-        covar_matrix+=tor.eye(covar_matrix.shape[0])*5e-2
+        if self.covariance == 'full':
+            self.covar_matrix = (deviations.transpose(1,0).matmul(deviations))/float(self.lmbda)
+            self.covar_matrix += tor.eye(self.covar_matrix.shape[0])*5e-2
+        elif self.covariance == 'diagonal':
+            self.covar_diagonal = tor.mean(deviations**2, 0) + 5e-2
+        else:
+            # Covariance is covar_factor covar_factor^T + diag(covar_diagonal)
+            self.covar_factor = deviations.transpose(1,0)/np.sqrt(self.lmbda)
+            self.covar_diagonal = tor.full_like(self.covar_diagonal, 5e-2)
 
         self.flattened_param_mean_old = mean_parameters_new
         #assert not np.any(scores == np.nan)
 
         mean = mean_parameters_new
-        #print("Covar max: ", tor.max(covar_matrix), "Mean max: ", tor.max(mean))
-
-        distribution = MultivariateNormal(mean, covar_matrix)
-
 
         #Sample new population from calculated mean and 
-        [m.sample_from_distribution(distribution) for m in self.rollout_models]
+        self.population = self._sample_population(mean)
+        self.model.set_flattened_parameters(mean.clone())
 
-        d.append(np.mean(env_scores[best_indices]))
-        if self.hstep%1 == 0:
-            print("Step {}, avg score {}, max score {}".format(self.hstep, np.mean(d), np.max(env_scores)), end='\r')
+        logger.logkv("avg_score", np.mean(env_scores[best_indices]))
+        logger.logkv("max_score", np.max(env_scores))
+        logger.logkv("total_steps", self.total_steps)
+        logger.dumpkvs()
         #sigma -= sigma_decay
 
+    def _train_end(self):
+        if self.pool is not None:
+            self.pool.close()
+
 
 
 
@@ -1,4 +1,5 @@
-from torch_rl.training.core import HorizonTrainer, mse_loss
+from torch_rl.training.core import HorizonTrainer, mse_loss, shuffled_minibatches, ModelPlacement
+from torch_rl.core import InferenceSession
 from torch_rl.memory import GeneralisedMemory
 from torch.optim import Adam
 from torch_rl.utils import to_tensor as tt
@@ -31,6 +32,8 @@ class AdvantageEstimator(object):
         self.env = env
         self.policy_network = policy_network
         self.critic_network = critic_network
+        self.policy_session = InferenceSession(policy_network)
+        self.critic_session = InferenceSession(critic_network)
         nenv = 1
         self.obs = env.reset()
         self.gamma = gamma
@@ -46,29 +49,26 @@ class AdvantageEstimator(object):
         mb_obs, mb_rewards, mb_actions, mb_values, mb_dones, mb_logpacs = [], [], [], [], [], []
         mb_state = self.state
         epinfos = []
-        self.critic_network.cpu()
-
         # 
 
         for _ in range(self.nsteps):
-            actions, values = self.policy_network(tt(self.obs, cuda=False).view(1,-1))
-            logpacs = self.policy_network.logprob(actions)
+            actions, values, logpacs = self.policy_session.sample(self.obs)
 
             mb_obs.append(self.obs.copy().flatten())
-            mb_actions.append(actions.data.numpy().flatten())
-            mb_values.append(values.detach().data.numpy().flatten())
-            mb_logpacs.append(logpacs.data.numpy().flatten())
+            mb_actions.append(actions.flatten())
+            mb_values.append(values.flatten())
+            mb_logpacs.append(logpacs.flatten())
 
             mb_dones.append(self.done)
 
-            a = actions.data.numpy().flatten()
+            a = actions.flatten()
             obs, reward, self.done, infos = self.env.step(a)
 
-            q = self.critic_network(tt(self.obs.reshape(1,-1), cuda=False), actions)
+            q = self.critic_session(self.obs, a)
 
 
             #Additional step in comparison to PPO
-            self.replay_memory.append(obs, a, reward, self.done, extra_info=np.hstack((mb_logpacs[-1],q.cpu().data.numpy().flatten())))
+            self.replay_memory.append(obs, a, reward, self.done, extra_info=np.hstack((mb_logpacs[-1],q.flatten())))
 
             self.obs = obs
             self.global_step += 1
@@ -80,32 +80,20 @@ class AdvantageEstimator(object):
                 self.obs = self.env.reset()
 
 
-        self.critic_network.cuda()
         # batch of steps to batch of rollouts
         mb_obs = np.asarray(mb_obs, dtype=np.float32).reshape(self.nsteps, -1)
         mb_rewards = np.asarray(mb_rewards, dtype=np.float32).reshape(self.nsteps, -1)
         mb_actions = np.asarray(mb_actions, dtype=np.float32).reshape(self.nsteps,self.env.action_space.shape[0])
         mb_values = np.asarray(mb_values, dtype=np.float32).reshape(self.nsteps, -1)
         mb_logpacs = np.asarray(mb_logpacs, dtype=np.float32).reshape(self.nsteps,  self.env.action_space.shape[0])
-        mb_dones = np.asarray(mb_dones, dtype=np.bool).reshape(self.nsteps, -1)
+        mb_dones = np.asarray(mb_dones, dtype=np.bool_).reshape(self.nsteps, -1)
 
-        action, last_values = self.policy_network(tt(self.obs.reshape(1,-1), cuda=False))
-        action, last_values = action.data.numpy().reshape(-1), last_values.data.numpy().reshape(-1)
+        _, last_values, _ = self.policy_session.sample(self.obs)
+        last_values = last_values.reshape(-1)
 
         # discount/bootstrap off value fn
-        mb_returns = np.zeros_like(mb_rewards)
-        mb_advs = np.zeros_like(mb_rewards)
-        lastgaelam = 0
-        for t in reversed(range(self.nsteps)):
-            if t == self.nsteps - 1:
-                nextnonterminal = 1.0 - self.done
-                nextvalues = last_values
-            else:
-                nextnonterminal = 1.0 - mb_dones[t + 1]
-                nextvalues = mb_values[t + 1]
-            delta = mb_rewards[t] + self.gamma * nextvalues * nextnonterminal - mb_values[t]
-            mb_advs[t] = lastgaelam = delta + self.gamma * self.lam * nextnonterminal * lastgaelam
-        mb_returns = mb_advs + mb_values
+        mb_advs, mb_returns = compute_gae(mb_rewards, mb_values, np.vstack((mb_dones[1:], [[self.done]])),
+                                          last_values, self.gamma, self.lam)
 
 
         return mb_obs, mb_returns, mb_dones, mb_actions, mb_values, mb_logpacs, mb_state
@@ -132,7 +120,7 @@ class HERIPGGPUPPOTrainer(HorizonTrainer):
 
     def __init__(self, env, policy_network, critic_network, replay_memory, max_episode_len=500, gamma=.99,
                 lr=3e-4, n_steps=40, epsilon=0.2, optimizer=None, lmda=0.95, ent_coef=0., n_update_steps=10, 
-                 n_minibatches=1, v=0.5, tau=1e-3):
+                 n_minibatches=1, v=0.5, tau=1e-3, adv_normalization='episode'):
         super(HERIPGGPUPPOTrainer, self).__init__(env)
 
         self.n_minibatches = n_minibatches
@@ -144,13 +132,19 @@ class HERIPGGPUPPOTrainer(HorizonTrainer):
         self.epsilon = epsilon
         self.gamma = gamma
         self.lmda = lmda
+        # Updates run on the learner copies, rollouts on the CPU copies
+        self.policy_placement = ModelPlacement(policy_network)
+        self.critic_placement = ModelPlacement(critic_network)
         self.optimizer = Adam(policy_network.parameters(), lr=lr, weight_decay=0.001) if optimizer is None else optimizer
         self.goal_based = hasattr(env, "goal")
         self.policy_network = policy_network
         self.ent_coef = ent_coef
         self.n_update_steps = n_update_steps
         self.n_steps = n_steps
-        self.advantage_estimator = AdvantageEstimator(env, self.policy_network, critic_network, n_steps, self.gamma, self.lmda, self.replay_memory)
+        # Advantages are normalized per 'episode' or 'global' over the rollout
+        self.adv_normalization = adv_normalization
+        self.advantage_estimator = AdvantageEstimator(env, self.policy_placement.actor, self.critic_placement.actor,
+                                                      n_steps, self.gamma, self.lmda, self.replay_memory)
         
         self.v = v
         self.tau = tau
@@ -158,6 +152,8 @@ class HERIPGGPUPPOTrainer(HorizonTrainer):
         self.target_critic_network = cuda_if_available(copy.deepcopy(self.critic_network))
         self.target_policy_network = cuda_if_available(copy.deepcopy(self.policy_network))
         self.critic_optimizer = Adam(critic_network.parameters(), lr=3e-4, weight_decay=0.001)
+        self.target_policy_parameters = FlatParameters(self.target_policy_network)
+        self.target_critic_parameters = FlatParameters(self.target_critic_network)
 
 
     def _off_policy_loss(self, batch_size): 
@@ -213,12 +209,7 @@ class HERIPGGPUPPOTrainer(HorizonTrainer):
 
     def _ppo_loss(self, bobs, bactions, badvs, breturns, blogpacs, bvalues):
 
-        OBS = tt(bobs)
-        A = tt(bactions)
-        ADV = tt(badvs)
-        R = tt(breturns)
-        OLDLOGPAC = tt(blogpacs)
-        OLDVPRED = tt(bvalues)
+        OBS, A, ADV, R, OLDLOGPAC, OLDVPRED = bobs, bactions, badvs, breturns, blogpacs, bvalues
 
         self.policy_network(OBS)
         logpac = self.policy_network.logprob(A)
@@ -226,7 +217,7 @@ class HERIPGGPUPPOTrainer(HorizonTrainer):
 
         #### Value function loss ####
         #print(bobs)
-        actions_new, v_pred = self.policy_network(tt(bobs))
+        actions_new, v_pred = self.policy_network(OBS)
         v_pred_clipped = OLDVPRED + tor.clamp(v_pred - OLDVPRED, -self.epsilon, self.epsilon)
         v_loss1 = (v_pred - R)**2
         v_loss2 = (v_pred_clipped - R)**2
@@ -261,31 +252,17 @@ class HERIPGGPUPPOTrainer(HorizonTrainer):
         obs, returns, masks, actions, values, logpacs, states = self.advantage_estimator.run() #pylint: disable=E0632
         
         # Normalize advantages over episodes
-        advs = returns - values
-        prev_ind = 0
-        for ind in np.argwhere(masks == True)[:, 0]:
-            episode_advs = advs[prev_ind:ind+1]
-            advs[prev_ind:ind+1] = (episode_advs - episode_advs.mean())/(episode_advs.std() + 1e-8)
-            prev_ind = ind+1
-
-        episode_advs = advs[prev_ind:-1]
-        advs[prev_ind:-1] = (episode_advs - episode_advs.mean())/(episode_advs.std() + 1e-8)
-    
+        advs = normalize_advantages(returns - values, masks, self.adv_normalization)
 
         nbatch_train = self.n_steps // self.n_minibatches
 
-        self.policy_network.cuda()
         #self.optimizer = Adam(self.policy_network.parameters(), lr=self.lr) 
 
         if states is None: # nonrecurrent version
-            inds = np.arange(self.n_steps)
+            obs, returns, actions, values, logpacs, advs = map(tt, (obs, returns, actions, values, logpacs, advs))
             for _ in range(self.n_update_steps):
-                np.random.shuffle(inds)
-                for start in range(0, self.n_steps, nbatch_train):
-                    end = start + nbatch_train
-                    mbinds = inds[start:end]
-                    bobs, breturns, bmasks, bactions, bvalues, blogpacs, badvs = map(lambda arr: arr[mbinds], (obs, returns, 
-                        masks, actions, values, logpacs, advs))
+                for mbinds in shuffled_minibatches(self.n_steps, nbatch_train, device=obs.device):
+                    bobs, breturns, bactions, bvalues, blogpacs, badvs = map(lambda arr: arr[mbinds], (obs, returns, actions, values, logpacs, advs))
 
                     # This introduces bias since the advantages can be normalized over more episodes
                     #advs = (advs - advs.mean()) / (advs.std() + 1e-8)
@@ -305,12 +282,12 @@ class HERIPGGPUPPOTrainer(HorizonTrainer):
 
                     # Soft updates for target policies and critic
                     # Soft updates of critic don't help
-                    soft_update(self.target_policy_network, self.policy_network, self.tau)
-                    soft_update(self.target_critic_network, self.critic_network, self.tau)
+                    soft_update(self.target_policy_parameters, self.policy_placement.learner_parameters, self.tau)
+                    soft_update(self.target_critic_parameters, self.critic_placement.learner_parameters, self.tau)
 
 
-        #Push to CPU
-        self.policy_network.cpu()
+        self.policy_placement.sync()
+        self.critic_placement.sync()
         logger.dumpkvs()
 
 
@@ -1,4 +1,4 @@
-from torch_rl.training.core import HorizonTrainer, mse_loss
+from torch_rl.training.core import HorizonTrainer, mse_loss, shuffled_minibatches, ModelPlacement
 from torch.optim import Adam
 from torch_rl.utils import to_tensor as tt
 import torch as tor
@@ -6,7 +6,14 @@ from collections import deque
 from torch_rl.utils import prGreen
 import time
 import sys
-from torch_rl.utils import logger
+from torch_rl.utils import logger, compute_gae, normalize_advantages
+from torch_rl.utils import broadcast_parameters, all_reduce_gradients, sync_running_stats
+import torch.distributed as dist
+import torch.multiprocessing as tor_mp
+from queue import Empty, Full
+import copy
+from torch_rl.envs.vec_env import VecEnv
+from torch_rl.core import InferenceSession
 import numpy as np
 
 def queue_to_array(q):
@@ -24,53 +31,89 @@ def queue_to_array(q):
 
 
 
-class AdvantageEstimator(object):
+def flatten_env_rollout(arr):
+    """
+    Flattens rollout arrays of shape [nsteps, nenv, ...] to [nenv*nsteps, ...] so that
+    the steps of every environment stay contiguous.
+    """
+    arr = arr.swapaxes(0, 1)
+    return arr.reshape(arr.shape[0] * arr.shape[1], *arr.shape[2:])
+
+
+def chunk_indexes(chunk_starts, nsteps):
+    """
+    Step indexes of every chunk of a rollout as padded rows [chunks, L], padding repeats
+    the first step of the chunk.
+    :return: Indexes, mask of the valid steps and the length of every chunk
+    """
+    lengths = np.diff(np.append(chunk_starts, nsteps))
+    steps = np.arange(lengths.max())
+    masks = steps[None] < lengths[:, None]
+    inds = np.where(masks, chunk_starts[:, None] + steps[None], chunk_starts[:, None])
+    return inds, masks, lengths
+
 
-    def __init__(self, env, network, nsteps, gamma, lam):
+class AdvantageEstimator(object):
+    """
+        Collects rollouts of nsteps and estimates the advantages with GAE. If env is a VecEnv
+        all of its environments are stepped in lockstep with a single batched forward pass of
+        the network and the rollout arrays have the shape [nsteps, nenv, ...].
+
+        For recurrent networks the rollout is split into chunks of at most chunk_length steps
+        that never cross an episode boundary. The hidden states are only stored at the start
+        of every chunk, the states returned by run are the chunk starts with the policy and
+        critic hidden states [layers, chunks, hidden].
+    """
+
+    def __init__(self, env, network, nsteps, gamma, lam, chunk_length=16):
         self.env = env
         self.network = network
-        nenv = 1
+        self.vectorized = isinstance(env, VecEnv)
+        nenv = env.num_envs if self.vectorized else 1
+        self.nenv = nenv
         self.obs = env.reset()
         self.gamma = gamma
         self.lam = lam
         self.nsteps = nsteps
-        self.state = [] if network.recurrent else None
-        self.done = False
+        self.recurrent = getattr(network, 'recurrent', False)
+        assert not (self.vectorized and self.recurrent), "Recurrent networks are not supported with vectorized environments"
+        self.state = [] if self.recurrent else None
+        self.chunk_length = chunk_length
+        self.done = np.zeros(nenv, dtype=np.bool_) if self.vectorized else False
+        # Rollouts of feedforward networks run without autograd on a preallocated input
+        self.session = None if self.recurrent else InferenceSession(network, batch_size=nenv)
         self.global_step = 0
         self.episodes = 0
-        self.recurrent = network.recurrent
 
     def run(self):
+        if self.vectorized:
+            return self._run_vectorized()
         mb_obs, mb_rewards, mb_actions, mb_values, mb_dones, mb_logpacs = [], [], [], [], [], []
         mb_states = self.state
         epinfos = []
-        for _ in range(self.nsteps):
+        chunk_starts, states_policy, states_critic = [], [], []
+        for t in range(self.nsteps):
             if mb_states is None:
-                actions, values = self.network(tt(self.obs, cuda=False).view(1,-1))
+                actions, values, logpacs = self.session.sample(self.obs)
             else:
-                state_critic = self.network.lh_val
-                state_policy = self.network.lh_pol
-                actions, values = self.network(tt(self.obs, cuda=False).view(1,1,-1), use_last_state=True)
-                if state_critic is None:
-                    state_critic = np.zeros_like(self.network.lh_val.data.numpy())
-                    state_policy = np.zeros_like(self.network.lh_pol.data.numpy())
-                else:
-                    state_critic = state_critic.data.numpy()
-                    state_policy = state_policy.data.numpy()
-
-                mb_states.append([state_policy,state_critic])
-
-
-            logpacs = self.network.logprob(actions)
+                # New chunk at the start of the rollout, of an episode or when the chunk is full
+                if t == 0 or self.done or t - chunk_starts[-1] == self.chunk_length:
+                    chunk_starts.append(t)
+                    states_policy.append(self.hidden_state(self.network.lh_pol, self.network.policy_gru))
+                    states_critic.append(self.hidden_state(self.network.lh_val, self.network.value_gru))
+                with tor.inference_mode():
+                    actions, values = self.network(tt(self.obs, cuda=False).view(1,1,-1), use_last_state=True)
+                    logpacs = self.network.logprob(actions)
+                actions, values, logpacs = actions.numpy(), values.numpy(), logpacs.numpy()
 
             mb_obs.append(self.obs.copy().flatten())
-            mb_actions.append(actions.data.numpy().flatten())
-            mb_values.append(values.detach().data.numpy().flatten())
-            mb_logpacs.append(logpacs.data.numpy().flatten())
+            mb_actions.append(actions.flatten())
+            mb_values.append(values.flatten())
+            mb_logpacs.append(logpacs.flatten())
 
             mb_dones.append(self.done)
 
-            obs, reward, self.done, infos = self.env.step(actions.data.numpy().flatten())
+            obs, reward, self.done, infos = self.env.step(actions.flatten())
             self.obs = obs
             self.global_step += 1
             mb_rewards.append(reward)
@@ -79,7 +122,7 @@ class AdvantageEstimator(object):
                 self.episodes+=1
                 logger.logkv("episodes", self.episodes)
                 self.obs = self.env.reset()
-                if self.network.recurrent:
+                if self.recurrent:
                     self.network.reset() 
 
 
@@ -89,35 +132,67 @@ class AdvantageEstimator(object):
         mb_actions = np.asarray(mb_actions, dtype=np.float32).reshape(self.nsteps, -1)
         mb_values = np.asarray(mb_values, dtype=np.float32).reshape(self.nsteps, -1)
         mb_logpacs = np.asarray(mb_logpacs, dtype=np.float32).reshape(self.nsteps, -1)
-        mb_dones = np.asarray(mb_dones, dtype=np.bool).reshape(self.nsteps, -1)
+        mb_dones = np.asarray(mb_dones, dtype=np.bool_).reshape(self.nsteps, -1)
         if not mb_states is None:
-            #mb_states = np.asarray(mb_states, dtype=np.float32).reshape(self.nsteps, 1, -1)
-            action, last_values = self.network(tt(self.obs.reshape(1,1,-1), cuda=False), use_last_state=True)
-            mb_states = np.asarray(mb_states, dtype=np.float32)
+            # Bootstrap value without advancing the hidden states of the next rollout
+            with tor.inference_mode():
+                action, last_values = self.network(tt(self.obs.reshape(1,1,-1), cuda=False),
+                                                   hidden=(self.network.lh_pol, self.network.lh_val))
+            last_values = last_values.numpy()
+            mb_states = (np.asarray(chunk_starts), np.concatenate(states_policy, axis=1),
+                         np.concatenate(states_critic, axis=1))
 
         else:
-            action, last_values = self.network(tt(self.obs.reshape(1,-1), cuda=False))
-
-        action, last_values = action.data.numpy().reshape(-1), last_values.data.numpy().reshape(-1)
-
-        # discount/bootstrap off value fn
-        mb_returns = np.zeros_like(mb_rewards)
-        mb_advs = np.zeros_like(mb_rewards)
-        lastgaelam = 0
-        for t in reversed(range(self.nsteps)):
-            if t == self.nsteps - 1:
-                nextnonterminal = 1.0 - self.done
-                nextvalues = last_values
-            else:
-                nextnonterminal = 1.0 - mb_dones[t + 1]
-                nextvalues = mb_values[t + 1]
-            delta = mb_rewards[t] + self.gamma * nextvalues * nextnonterminal - mb_values[t]
-            mb_advs[t] = lastgaelam = delta + self.gamma * self.lam * nextnonterminal * lastgaelam
-        mb_returns = mb_advs + mb_values
+            _, last_values, _ = self.session.sample(self.obs)
 
+        last_values = last_values.reshape(-1)
+        # dones are flagged before the first step of an episode, GAE needs them after the last one
+        mb_advs, mb_returns = compute_gae(mb_rewards, mb_values, np.vstack((mb_dones[1:], np.reshape(self.done, (1, -1)))),
+                                          last_values, self.gamma, self.lam)
 
         return mb_obs, mb_returns, mb_dones, mb_actions, mb_values, mb_logpacs, mb_states
 
+    @staticmethod
+    def hidden_state(state, gru):
+        if state is None:
+            return np.zeros((gru.num_layers, 1, gru.hidden_size), dtype=np.float32)
+        return state.data.numpy()
+
+    def _run_vectorized(self):
+        mb_obs, mb_rewards, mb_actions, mb_values, mb_dones, mb_logpacs = [], [], [], [], [], []
+        for _ in range(self.nsteps):
+            actions, values, logpacs = self.session.sample(self.obs)
+
+            mb_obs.append(np.asarray(self.obs, dtype=np.float32).reshape(self.nenv, -1))
+            mb_actions.append(actions)
+            mb_values.append(values.reshape(self.nenv))
+            mb_logpacs.append(logpacs)
+            mb_dones.append(self.done)
+
+            # Finished environments are reset by the VecEnv
+            self.obs, rewards, self.done, infos = self.env.step(actions)
+            self.global_step += self.nenv
+            mb_rewards.append(rewards)
+
+            if np.any(self.done):
+                self.episodes += int(np.sum(self.done))
+                logger.logkv("episodes", self.episodes)
+
+        mb_obs = np.asarray(mb_obs, dtype=np.float32)
+        mb_rewards = np.asarray(mb_rewards, dtype=np.float32)
+        mb_actions = np.asarray(mb_actions, dtype=np.float32)
+        mb_values = np.asarray(mb_values, dtype=np.float32)
+        mb_logpacs = np.asarray(mb_logpacs, dtype=np.float32)
+        mb_dones = np.asarray(mb_dones, dtype=np.bool_)
+
+        _, last_values, _ = self.session.sample(self.obs)
+        last_values = last_values.reshape(self.nenv)
+        # dones are flagged before the first step of an episode, GAE needs them after the last one
+        mb_advs, mb_returns = compute_gae(mb_rewards, mb_values, np.vstack((mb_dones[1:], np.reshape(self.done, (1, -1)))),
+                                          last_values, self.gamma, self.lam)
+
+        return mb_obs, mb_returns, mb_dones, mb_actions, mb_values, mb_logpacs, None
+
         # obs, returns, masks, actions, values, neglogpacs, states = runner.run()
 
     def constfn(val):
@@ -133,7 +208,8 @@ class GPUPPOTrainer(HorizonTrainer):
 
 
     def __init__(self, env, network, max_episode_len=500, gamma=.99, lr=3e-4, n_steps=40,
-                 epsilon=0.2, optimizer=None, lmda=0.95, ent_coef=0., n_update_steps=10, num_threads=5, n_minibatches=1):
+                 epsilon=0.2, optimizer=None, lmda=0.95, ent_coef=0., n_update_steps=10, num_threads=5, n_minibatches=1,
+                 adv_normalization='episode', chunk_length=16):
         super(GPUPPOTrainer, self).__init__(env)
 
         self.n_minibatches = n_minibatches
@@ -142,152 +218,115 @@ class GPUPPOTrainer(HorizonTrainer):
         self.epsilon = epsilon
         self.gamma = gamma
         self.lmda = lmda
+        # Updates run on the learner copy, rollouts on the CPU copy
+        self.placement = ModelPlacement(network)
         self.optimizer = Adam(network.parameters(), lr=lr) if optimizer is None else optimizer
         self.goal_based = hasattr(env, "goal")
-        self.network = network
-        self.recurrent = network.recurrent
+        self.network = self.placement.learner
+        self.recurrent = getattr(network, 'recurrent', False)
         self.ent_coef = ent_coef
         self.num_threads = num_threads
         self.n_update_steps = n_update_steps
         self.n_steps = n_steps
-        self.advantage_estimator = AdvantageEstimator(env, self.network, n_steps, self.gamma, self.lmda)
+        # Advantages are normalized per 'episode', per 'env' or 'global' over the rollout
+        self.adv_normalization = adv_normalization
+        self.advantage_estimator = AdvantageEstimator(env, self.placement.actor, n_steps, self.gamma, self.lmda,
+                                                      chunk_length=chunk_length)
+        # Rollouts of all environments are trained on as one batch
+        self.n_batch = n_steps * self.advantage_estimator.nenv
 
-    def _horizon_step(self):
+    def _ppo_loss(self, v_pred, logpac, entropy, R, OLDVPRED, OLDLOGPAC, ADV):
 
+        #### Value function loss ####
+        v_pred_clipped = OLDVPRED + tor.clamp(v_pred - OLDVPRED, -self.epsilon, self.epsilon)
+        v_loss1 = (v_pred - R)**2/2.
+        v_loss2 = (v_pred_clipped - R)**2/2.
 
-        obs, returns, masks, actions, values, logpacs, states = self.advantage_estimator.run() #pylint: disable=E0632
-        #Normalize advantages over episodes
-        advs = returns - values
-        prev_ind = 0
-        for ind in np.argwhere(masks == True)[:, 0]:
-            episode_advs = advs[prev_ind:ind+1]
-            advs[prev_ind:ind+1] = (episode_advs - episode_advs.mean())/(episode_advs.std() + 1e-8)
-            prev_ind = ind+1
-
-        episode_advs = advs[prev_ind:-1]
-        advs[prev_ind:-1] = (episode_advs - episode_advs.mean())/(episode_advs.std() + 1e-8)
-    
-
-        nbatch_train = self.n_steps // self.n_minibatches
-
-        
-        if tor.cuda.is_available():
-            network = self.network.cuda()
-        else:
-            network=self.network
-        #self.optimizer = Adam(self.network.parameters(), lr=self.lr) 
-        if not states is None:
-            #store last network state
-            lh_val = network.lh_val
-            lh_pol = network.lh_pol
-
-        inds = np.arange(self.n_steps)
-        for _ in range(self.n_update_steps):
-            np.random.shuffle(inds)
-            for start in range(0, self.n_steps, nbatch_train):
-                end = start + nbatch_train
-                mbinds = inds[start:end]
-                if states is None: # nonrecurrent version
-
-                    bobs, breturns, bmasks, bactions, bvalues, blogpacs, badvs = map(\
-                        lambda arr: arr[mbinds], (obs, returns, masks, actions, values, logpacs, advs))
-                    # This introduces bias since the advantages can be normalized over more episodes
-                    #advs = (advs - advs.mean()) / (advs.std() + 1e-8)
+        v_loss = .5 * tor.mean(tor.max(v_loss1, v_loss2))
 
-                    OBS = tt(bobs)
-                    A = tt(bactions)
-                    ADV = tt(badvs)
-                    R = tt(breturns)
-                    OLDLOGPAC = tt(blogpacs)
-                    OLDVPRED = tt(bvalues)
+        ### Ratio calculation ####
+        # In the baselines implementation these are negative logits, then it is flipped
+        ratio = tor.exp(logpac - OLDLOGPAC)
 
-                    actions_new, v_pred  = self.network(OBS)
-                    logpac = self.network.logprob(A)
-                    entropy = tor.mean(self.network.entropy())
+        ### Policy gradient calculation ###
+        pg_loss1 = -ADV * ratio
+        pg_loss2 = -ADV * tor.clamp(ratio, 1. - self.epsilon, 1. + self.epsilon)
+        pg_loss = tor.mean(tor.max(pg_loss1, pg_loss2))
+        approxkl = .5 * tor.mean((logpac - OLDLOGPAC)**2)
 
-                    #### Value function loss ####
-                    #print(bobs)
-                    v_pred_clipped = OLDVPRED + tor.clamp(v_pred - OLDVPRED, -self.epsilon, self.epsilon)
-                    v_loss1 = (v_pred - R)**2/2.
-                    v_loss2 = (v_pred_clipped - R)**2/2.
+        loss = v_loss  + pg_loss + self.ent_coef*entropy
 
-                    v_loss = .5 * tor.mean(tor.max(v_loss1, v_loss2))
+        #clipfrac = tor.mean((tor.abs(ratio - 1.0) > self.epsilon).type(tor.FloatTensor))
 
-                    ### Ratio calculation ####
-                    # In the baselines implementation these are negative logits, then it is flipped
-                    ratio = tor.exp(logpac - OLDLOGPAC)
+        return loss, pg_loss, v_loss, approxkl
 
-                    ### Policy gradient calculation ###
-                    pg_loss1 = -ADV * ratio
-                    pg_loss2 = -ADV * tor.clamp(ratio, 1. - self.epsilon, 1. + self.epsilon)
-                    pg_loss = tor.mean(tor.max(pg_loss1, pg_loss2))
-                    approxkl = .5 * tor.mean((logpac - OLDLOGPAC)**2)
+    def _optimize(self, loss):
+        self.optimizer.zero_grad()
+        loss.backward()
+        self.optimizer.step()
 
+    def _horizon_step(self):
+        self._update(*self.advantage_estimator.run())
 
-                    loss = v_loss  + pg_loss + self.ent_coef*entropy
-
-                    #clipfrac = tor.mean((tor.abs(ratio - 1.0) > self.epsilon).type(tor.FloatTensor))
-
-                    self.optimizer.zero_grad()
-                    loss.backward()
-                    self.optimizer.step()
+    def _update(self, obs, returns, masks, actions, values, logpacs, states):
+        """
+        Optimizes the learner on one rollout of the advantage estimator.
+        """
+        #Normalize advantages over episodes
+        advs = normalize_advantages(returns - values, masks, self.adv_normalization)
+        if self.advantage_estimator.vectorized:
+            obs, returns, masks, actions, values, logpacs, advs = map(flatten_env_rollout,
+                (obs, returns, masks, actions, values, logpacs, advs))
+            returns, masks, values, advs = [arr.reshape(-1, 1) for arr in (returns, masks, values, advs)]
 
-                else:
+        nbatch_train = self.n_batch // self.n_minibatches
 
-                    bobs, breturns, bmasks, bactions, bvalues, blogpacs, badvs, bstates = map(\
-                        lambda arr: arr[mbinds], (obs, returns, masks, actions, values, logpacs, advs, states))
-                    OBS = tt(bobs)
-                    A = tt(bactions)
-                    ADV = tt(badvs)
-                    R = tt(breturns)
-                    OLDLOGPAC = tt(blogpacs)
-                    OLDVPRED = tt(bvalues)
+        obs, returns, actions, values, logpacs, advs = map(tt, (obs, returns, actions, values, logpacs, advs))
 
-                    STATES_POLICY = np.asarray([x for x,y in bstates]).squeeze().transpose((1,0,2))
-                    STATES_CRITIC = np.asarray([y for x,y in bstates]).squeeze().transpose((1,0,2))
+        #self.optimizer = Adam(self.network.parameters(), lr=self.lr) 
+        if states is None: # nonrecurrent version
+            for _ in range(self.n_update_steps):
+                for mbinds in shuffled_minibatches(self.n_batch, nbatch_train, device=obs.device):
 
-                    self.network.lh_pol = tt(STATES_POLICY)
-                    self.network.lh_val = tt(STATES_CRITIC)
-                    actions_new, v_pred  = self.network(OBS.view(nbatch_train, 1, -1), use_last_state=True)
+                    OBS, R, A, OLDVPRED, OLDLOGPAC, ADV = map(\
+                        lambda arr: arr[mbinds], (obs, returns, actions, values, logpacs, advs))
+                    # This introduces bias since the advantages can be normalized over more episodes
+                    #advs = (advs - advs.mean()) / (advs.std() + 1e-8)
 
+                    actions_new, v_pred  = self.network(OBS)
                     logpac = self.network.logprob(A)
                     entropy = tor.mean(self.network.entropy())
 
-                    #### Value function loss ####
-                    #print(bobs)
-                    v_pred_clipped = OLDVPRED + tor.clamp(v_pred - OLDVPRED, -self.epsilon, self.epsilon)
-                    v_loss1 = (v_pred - R)**2/2.
-                    v_loss2 = (v_pred_clipped - R)**2/2.
-
-                    v_loss = .5 * tor.mean(tor.max(v_loss1, v_loss2))
-
-                    ### Ratio calculation ####
-                    # In the baselines implementation these are negative logits, then it is flipped
-                    ratio = tor.exp(logpac - OLDLOGPAC)
+                    loss, pg_loss, v_loss, approxkl = self._ppo_loss(v_pred, logpac, entropy, R, OLDVPRED, OLDLOGPAC, ADV)
 
-                    ### Policy gradient calculation ###
-                    pg_loss1 = -ADV * ratio
-                    pg_loss2 = -ADV * tor.clamp(ratio, 1. - self.epsilon, 1. + self.epsilon)
-                    pg_loss = tor.mean(tor.max(pg_loss1, pg_loss2))
-                    approxkl = .5 * tor.mean((logpac - OLDLOGPAC)**2)
+                    self._optimize(loss)
 
-
-                    loss = v_loss  + pg_loss + self.ent_coef*entropy
-
-                    #clipfrac = tor.mean((tor.abs(ratio - 1.0) > self.epsilon).type(tor.FloatTensor))
-
-                    self.optimizer.zero_grad()
-                    loss.backward()
-                    self.optimizer.step()
-
-        if not states is None:
-            #restore last states for runner
-            self.network.lh_pol = lh_pol
-            self.network.lh_val = lh_val
-
-        #Push to CPU
-        self.network.cpu()
-        logger.logkv("siglog", self.network.siglog.data.numpy()[0])
+        else:
+            chunk_starts, states_policy, states_critic = states
+            chunk_inds, chunk_masks, lengths = chunk_indexes(chunk_starts, self.n_batch)
+            chunk_inds, chunk_masks = [tor.as_tensor(arr, device=obs.device) for arr in (chunk_inds, chunk_masks)]
+            lengths = tor.as_tensor(lengths)
+            states_policy, states_critic = tt(states_policy), tt(states_critic)
+
+            num_chunks = len(chunk_starts)
+            chunks_train = max(num_chunks // self.n_minibatches, 1)
+            for _ in range(self.n_update_steps):
+                for mbchunks in shuffled_minibatches(num_chunks, chunks_train, device=obs.device):
+                    binds, bmasks = chunk_inds[mbchunks], chunk_masks[mbchunks]
+                    hidden = (states_policy[:, mbchunks], states_critic[:, mbchunks])
+                    actions_new, v_pred = self.network(obs[binds], hidden=hidden, lengths=lengths[mbchunks.cpu()])
+
+                    # Only the valid steps of the chunks enter the loss
+                    R, OLDVPRED, OLDLOGPAC, ADV = map(lambda arr: arr[binds][bmasks], (returns, values, logpacs, advs))
+                    logpac = self.network.logprob(actions[binds])[bmasks]
+                    entropy = tor.mean(self.network.entropy()[bmasks])
+
+                    loss, pg_loss, v_loss, approxkl = self._ppo_loss(v_pred[bmasks], logpac, entropy, R, OLDVPRED, OLDLOGPAC, ADV)
+
+                    self._optimize(loss)
+
+        self.placement.sync()
+        logger.logkv("siglog", self.network.siglog.cpu().data.numpy()[0])
         logger.logkv("pgloss", pg_loss.cpu().data.numpy())
         logger.logkv("vfloss", v_loss.cpu().data.numpy())
         logger.logkv("vfloss", v_loss.cpu().data.numpy())
@@ -296,6 +335,157 @@ class GPUPPOTrainer(HorizonTrainer):
         logger.dumpkvs()
 
 
+class DistributedGPUPPOTrainer(GPUPPOTrainer):
+    """
+        Data parallel PPO over the processes of a torch.distributed group, e.g. started
+        with launch_distributed. Every process collects rollouts in its own environment
+        and computes gradients on them, the gradients are averaged with an all-reduce
+        before the optimizer step so that all processes keep identical weights. Running
+        statistics of RunningMeanStdNormalize(distributed=True) wrappers are synchronized
+        after every update. Only the process of rank 0 logs.
+
+        Recurrent networks are not supported, their number of minibatches depends on
+        the episodes of the rollout and would differ between the processes.
+    """
+
+    def __init__(self, env, network, **kwargs):
+        assert dist.is_available() and dist.is_initialized(), "The torch.distributed process group is not initialized"
+        assert not getattr(network, 'recurrent', False), "Distributed training of recurrent networks is not supported"
+        super(DistributedGPUPPOTrainer, self).__init__(env, network, **kwargs)
+        self.rank = dist.get_rank()
+        self.world_size = dist.get_world_size()
+
+        # All processes start from the weights of rank 0 but explore with different noise
+        broadcast_parameters(self.network)
+        self.placement.sync()
+        tor.manual_seed(tor.initial_seed() + self.rank)
+        if self.rank != 0:
+            logger.set_level(logger.DISABLED)
+
+    def _optimize(self, loss):
+        self.optimizer.zero_grad()
+        loss.backward()
+        all_reduce_gradients(self.network.parameters())
+        self.optimizer.step()
+
+    def _horizon_step(self):
+        super(DistributedGPUPPOTrainer, self)._horizon_step()
+        sync_running_stats(self.env)
+
+
+def ppo_actor_worker(index, env_fn, network, parameters, version, lock, rollouts, running, estimator_kwargs):
+    tor.manual_seed(tor.initial_seed() + index)
+    np.random.seed((np.random.randint(2**31) + index) % 2**31)
+    estimator = AdvantageEstimator(env_fn(), network, **estimator_kwargs)
+    # The parameters of the network become views into a local copy of the published weights
+    local_parameters = parameters.clone()
+    tor.nn.utils.vector_to_parameters(local_parameters, network.parameters())
+    try:
+        while running.value:
+            # Weights and version are read together, the learner publishes under the same lock
+            with lock:
+                local_parameters.copy_(parameters)
+                rollout_version = version.value
+            rollout = estimator.run()
+
+            # A full queue blocks the actor, this bounds how stale queued rollouts get
+            while running.value:
+                try:
+                    rollouts.put((rollout_version, rollout), timeout=1.)
+                    break
+                except Full:
+                    pass
+    except KeyboardInterrupt:
+        pass
+
+
+class AsyncGPUPPOTrainer(GPUPPOTrainer):
+    """
+        PPO with actor processes that keep collecting rollouts while the learner
+        optimizes. Every actor builds its environment with env_fn and rolls out with
+        the latest published weights, rollouts wait in a queue of queue_depth entries.
+        The learner trains on one rollout per horizon step and publishes the new weights
+        afterwards. Rollouts collected with weights that are more than max_policy_lag
+        updates old are dropped, the others are corrected for the behaviour policy through
+        the clipped ratio of the stored old log probabilities as in the synchronous trainer.
+    """
+
+    def __init__(self, env_fn, network, num_actors=2, queue_depth=2, max_policy_lag=2, context=None,
+                 max_episode_len=500, gamma=.99, lmda=0.95, n_steps=40, chunk_length=16, **kwargs):
+        # The local environment only provides the spaces, actors create their own
+        super(AsyncGPUPPOTrainer, self).__init__(env_fn(), network, max_episode_len=max_episode_len, gamma=gamma,
+                                                 lmda=lmda, n_steps=n_steps, chunk_length=chunk_length, **kwargs)
+        self.env_fn = env_fn
+        self.num_actors = num_actors
+        self.max_policy_lag = max_policy_lag
+        self.estimator_kwargs = dict(nsteps=n_steps, gamma=gamma, lam=lmda, chunk_length=chunk_length)
+
+        ctx = tor_mp.get_context(context)
+        self.ctx = ctx
+        self.rollouts = ctx.Queue(maxsize=queue_depth)
+        self.lock = ctx.Lock()
+        self.version = ctx.Value('l', 0)
+        self.running = ctx.Value('b', 0)
+        self.parameters = self.placement.flat.clone().share_memory_()
+        self.processes = []
+        self.dropped_rollouts = 0
+
+    def start(self):
+        if self.processes:
+            return
+        self.running.value = 1
+        self.processes = [self.ctx.Process(target=ppo_actor_worker, daemon=True,
+                                           args=(i, self.env_fn, copy.deepcopy(self.placement.actor), self.parameters,
+                                                 self.version, self.lock, self.rollouts, self.running,
+                                                 self.estimator_kwargs))
+                          for i in range(self.num_actors)]
+        for p in self.processes:
+            p.start()
+
+    def close(self):
+        self.running.value = 0
+        # Unblock actors that wait on a full queue
+        while any(p.is_alive() for p in self.processes):
+            try:
+                self.rollouts.get(timeout=1e-2)
+            except Empty:
+                pass
+        for p in self.processes:
+            p.join()
+        self.processes = []
+
+    def _warmup(self):
+        self.start()
+
+    def _train_end(self):
+        self.close()
+
+    def _next_rollout(self):
+        while True:
+            try:
+                rollout_version, rollout = self.rollouts.get(timeout=1.)
+            except Empty:
+                if not all(p.is_alive() for p in self.processes):
+                    raise RuntimeError("An actor process failed")
+                continue
+
+            lag = self.version.value - rollout_version
+            if lag <= self.max_policy_lag:
+                logger.logkv("policy_lag", lag)
+                return rollout
+            self.dropped_rollouts += 1
+            logger.logkv("dropped_rollouts", self.dropped_rollouts)
+
+    def _horizon_step(self):
+        self.start()
+        self._update(*self._next_rollout())
+
+        # Publish the weights of the update
+        with self.lock:
+            self.parameters.copy_(self.placement.flat)
+            self.version.value += 1
+
+
 
 if __name__ == '__main__':
 
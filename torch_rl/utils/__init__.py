@@ -4,4 +4,7 @@ try:
     from .mpi_running_mean_std import *
 
 except ImportError as e:
-    from .running_mean_std import *
\ No newline at end of file
+    from .running_mean_std import *
+
+from .advantages import *
+from .distributed import *
@@ -0,0 +1,105 @@
+import numpy as np
+import torch as tor
+
+
+def compute_gae(rewards, values, dones, last_values, gamma, lam):
+    """
+    Generalized advantage estimation https://arxiv.org/abs/1506.02438 for rollouts of
+    T steps in N environments. Works on numpy arrays or on torch tensors on any device,
+    the result has the type of rewards.
+
+    :param rewards: Rewards [T, N]
+    :param values: Value estimates of the visited states [T, N]
+    :param dones: Whether the episode ended with step t [T, N]
+    :param last_values: Value estimates of the states after the last step [N]
+    :return: Advantages and returns [T, N]
+    """
+    if tor.is_tensor(rewards):
+        return compute_gae_tensor(rewards, values, dones, last_values, gamma, lam)
+
+    rewards = np.asarray(rewards)
+    values = np.asarray(values, dtype=rewards.dtype)
+    nonterminals = 1. - np.asarray(dones, dtype=rewards.dtype)
+    last_values = np.asarray(last_values, dtype=rewards.dtype).reshape(values.shape[1:])
+
+    # TD errors of all steps at once, only the discounted sum runs backwards in time
+    next_values = np.concatenate((values[1:], last_values[None]), axis=0)
+    deltas = rewards + gamma * next_values * nonterminals - values
+    decays = gamma * lam * nonterminals
+
+    advs = np.empty_like(deltas)
+    lastgaelam = np.zeros_like(deltas[0])
+    for t in reversed(range(len(deltas))):
+        advs[t] = lastgaelam = deltas[t] + decays[t] * lastgaelam
+
+    return advs, advs + values
+
+
+def compute_gae_tensor(rewards, values, dones, last_values, gamma, lam):
+    values = values.type_as(rewards)
+    nonterminals = 1. - dones.type_as(rewards)
+    last_values = last_values.type_as(rewards).reshape(values.shape[1:])
+
+    next_values = tor.cat((values[1:], last_values.unsqueeze(0)), 0)
+    deltas = rewards + gamma * next_values * nonterminals - values
+    decays = gamma * lam * nonterminals
+
+    advs = tor.empty_like(deltas)
+    lastgaelam = tor.zeros_like(deltas[0])
+    for t in reversed(range(deltas.shape[0])):
+        advs[t] = lastgaelam = deltas[t] + decays[t] * lastgaelam
+
+    return advs, advs + values
+
+
+def normalize_advantages(advs, masks=None, mode='episode', epsilon=1e-8):
+    """
+    Normalizes advantages to zero mean and unit standard deviation over segments of
+    a rollout in one pass. Works on numpy arrays or torch tensors.
+
+    :param advs: Advantages [T] or [T, N] of N environments
+    :param masks: Flags that a new episode starts with step t, same shape as advs
+    :param mode: 'episode' normalizes every episode of every environment separately,
+        'env' every environment over the whole rollout and 'global' all advantages together
+    :return: Normalized advantages of the shape of advs
+    """
+    shape = advs.shape
+    T = shape[0]
+    N = int(np.prod(shape[1:], dtype=np.int64))
+    if mode == 'episode':
+        # Episode ids are made unique over environments, unused ids just stay empty
+        if tor.is_tensor(masks):
+            offsets = (T + 1) * tor.arange(N, device=masks.device)
+            segment_ids = masks.reshape(T, N).long().cumsum(0) + offsets[None]
+        else:
+            segment_ids = np.cumsum(np.reshape(masks, (T, N)), axis=0) + (T + 1) * np.arange(N)[None]
+        num_segments = (T + 1) * N
+    elif mode == 'env':
+        segment_ids = np.repeat(np.arange(N)[None], T, axis=0)
+        num_segments = N
+    elif mode == 'global':
+        segment_ids = np.zeros((T, N), dtype=np.int64)
+        num_segments = 1
+    else:
+        raise ValueError("Unknown normalization mode {}".format(mode))
+
+    if tor.is_tensor(advs):
+        flat_advs = advs.reshape(-1)
+        segment_ids = tor.as_tensor(segment_ids, device=advs.device).reshape(-1)
+        counts = tor.zeros(num_segments, dtype=flat_advs.dtype, device=advs.device)
+        counts = counts.index_add_(0, segment_ids, tor.ones_like(flat_advs)).clamp(min=1)
+        means = tor.zeros_like(counts).index_add_(0, segment_ids, flat_advs) / counts
+        centered = flat_advs - means[segment_ids]
+        stds = (tor.zeros_like(counts).index_add_(0, segment_ids, centered**2) / counts).sqrt()
+    else:
+        flat_advs = np.asarray(advs).reshape(-1)
+        segment_ids = np.asarray(segment_ids).reshape(-1)
+        counts = np.maximum(np.bincount(segment_ids, minlength=num_segments), 1)
+        means = np.bincount(segment_ids, weights=flat_advs, minlength=num_segments) / counts
+        centered = flat_advs - means[segment_ids]
+        stds = np.sqrt(np.bincount(segment_ids, weights=centered**2, minlength=num_segments) / counts)
+
+    normalized = centered / (stds[segment_ids] + epsilon)
+    if not tor.is_tensor(advs):
+        normalized = normalized.astype(advs.dtype)
+    return normalized.reshape(shape)
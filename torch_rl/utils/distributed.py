@@ -0,0 +1,127 @@
+import os
+import numpy as np
+import torch as tor
+import torch.distributed as dist
+import torch.multiprocessing as tor_mp
+
+
+def _distributed_worker(rank, fn, num_workers, args, backend, address, port):
+    os.environ['MASTER_ADDR'] = address
+    os.environ['MASTER_PORT'] = str(port)
+    dist.init_process_group(backend, rank=rank, world_size=num_workers)
+    try:
+        fn(rank, *args)
+    finally:
+        dist.destroy_process_group()
+
+
+def launch_distributed(fn, num_workers, args=(), backend='gloo', address='127.0.0.1', port=29500):
+    """
+    Runs fn(rank, *args) in num_workers local processes that form one torch.distributed
+    group. The gloo backend runs on CPU only machines, fn has to be picklable.
+    """
+    tor_mp.spawn(_distributed_worker, args=(fn, num_workers, args, backend, address, port),
+              nprocs=num_workers, join=True)
+
+
+def broadcast_parameters(module, src=0):
+    """
+    Overwrites the parameters and buffers of module with the ones of process src.
+    """
+    with tor.no_grad():
+        params = list(module.parameters())
+        flat = tor.nn.utils.parameters_to_vector(params)
+        dist.broadcast(flat, src)
+        # Copies in place, the parameters may be views into a flat buffer
+        offset = 0
+        for p in params:
+            p.copy_(flat[offset:offset + p.numel()].view_as(p))
+            offset += p.numel()
+        for buffer in module.buffers():
+            dist.broadcast(buffer, src)
+
+
+def all_reduce_gradients(parameters):
+    """
+    Averages the gradients of parameters over all processes with one all-reduce
+    on a flat buffer. Missing gradients count as zeros.
+    """
+    params = [p for p in parameters if p.requires_grad]
+    flat = tor.cat([p.grad.reshape(-1) if p.grad is not None else tor.zeros(p.numel(), device=p.device)
+                    for p in params])
+    dist.all_reduce(flat)
+    flat /= dist.get_world_size()
+
+    offset = 0
+    for p in params:
+        grad = flat[offset:offset + p.numel()].view_as(p)
+        if p.grad is None:
+            p.grad = grad.clone()
+        else:
+            p.grad.copy_(grad)
+        offset += p.numel()
+
+
+class DistributedRunningMeanStd(object):
+    """
+        Running mean and standard deviation over the data of all processes of a
+        torch.distributed group, a drop in replacement of the MPI RunningMeanStd.
+        Updates are accumulated locally and merged with the other processes on sync,
+        until then the statistics of a process include its own pending updates.
+        Without an initialized process group sync only merges the local updates.
+    """
+
+    def __init__(self, epsilon=1e-2, shape=()):
+        self.shape = shape
+        self._sum = np.zeros(shape, 'float64')
+        self._sumsq = np.full(shape, epsilon, 'float64')
+        self._count = epsilon
+        # Sums, sums of squares and count that are not yet synchronized
+        self._pending = np.zeros(2 * int(np.prod(shape, dtype=np.int64)) + 1, 'float64')
+
+    def update(self, x):
+        n = int(np.prod(self.shape, dtype=np.int64))
+        x = np.asarray(x, dtype='float64').reshape((-1,) + np.shape(self._sum))
+        self._pending[:n] += x.sum(axis=0).ravel()
+        self._pending[n:2 * n] += np.square(x).sum(axis=0).ravel()
+        self._pending[2 * n] += len(x)
+
+    def sync(self):
+        pending = tor.from_numpy(self._pending)
+        if dist.is_available() and dist.is_initialized():
+            dist.all_reduce(pending)
+        n = int(np.prod(self.shape, dtype=np.int64))
+        self._sum += self._pending[:n].reshape(self.shape)
+        self._sumsq += self._pending[n:2 * n].reshape(self.shape)
+        self._count += self._pending[2 * n]
+        self._pending[:] = 0.
+
+    def _moments(self):
+        n = int(np.prod(self.shape, dtype=np.int64))
+        count = self._count + self._pending[2 * n]
+        mean = (self._sum + self._pending[:n].reshape(self.shape)) / count
+        sumsq = self._sumsq + self._pending[n:2 * n].reshape(self.shape)
+        return mean, np.sqrt(np.maximum(sumsq / count - mean**2, 1e-2))
+
+    @property
+    def mean(self):
+        return self._moments()[0]
+
+    @property
+    def std(self):
+        return self._moments()[1]
+
+
+def sync_running_stats(env):
+    """
+    Synchronizes the distributed running statistics of all wrappers of env.
+    """
+    stats = []
+    while env is not None:
+        # Wrappers forward attribute lookups, every statistic is synchronized once
+        for rms in (getattr(env, 'ob_rms', None), getattr(env, 'ret_rms', None)):
+            if hasattr(rms, 'sync') and not any(rms is s for s in stats):
+                stats.append(rms)
+        env = getattr(env, 'env', None)
+    for rms in stats:
+        rms.sync()
@@ -39,26 +39,79 @@ Transition = namedtuple(
     'Transition', ('state', 'action', 'next_state', 'reward'))
 
 
+class FlatParameters(object):
+    """
+        Rebinds the parameters of a module as views into one contiguous buffer, so that
+        the flat parameter vector is available without copies and updates of all
+        parameters are single in-place operations on data. Optimizers created on the module
+        stay valid. Moving or copying the module allocates new parameter storage, bind
+        after the module is on its device and check bound before relying on the buffer.
+    """
+
+    def __init__(self, module, pin_memory=False):
+        self.module = module
+        self.params = list(module.parameters())
+        first = self.params[0]
+        self.data = tor.zeros(sum(p.numel() for p in self.params), dtype=first.dtype, device=first.device)
+        if pin_memory:
+            self.data = self.data.pin_memory()
+        offset = 0
+        with tor.no_grad():
+            for p in self.params:
+                view = self.data[offset:offset + p.numel()].view_as(p)
+                view.copy_(p)
+                p.data = view
+                offset += p.numel()
+
+    def __len__(self):
+        return len(self.data)
+
+    @property
+    def bound(self):
+        """
+        Whether the parameters of the module are still views into data.
+        """
+        first, last = self.params[0], self.params[-1]
+        return first.data_ptr() == self.data.data_ptr() and \
+            last.data_ptr() == self.data[len(self.data) - last.numel():].data_ptr()
+
+    def set(self, vector):
+        with tor.no_grad():
+            self.data.copy_(vector)
+
+    def soft_update(self, source, tau):
+        with tor.no_grad():
+            self.data.lerp_(source.data, tau)
+
+    def hard_update(self, source):
+        self.set(source.data)
+
+
 def soft_update(target, source, tau):
     """
     Copies the parameters from source network (x) to target network (y) using the below update
     y = TAU*x + (1 - TAU)*y
-    :param target: Target network (PyTorch)
-    :param source: Source network (PyTorch)
+    :param target: Target network (PyTorch) or its FlatParameters
+    :param source: Source network (PyTorch) or its FlatParameters
     :return:
     """
-    for target_param, param in zip(target.parameters(), source.parameters()):
-        target_param.data.copy_(
-            target_param.data * (1.0 - tau) + param.data * tau
-        )
+    if isinstance(target, FlatParameters):
+        target.soft_update(source, tau)
+        return
+    with tor.no_grad():
+        for target_param, param in zip(target.parameters(), source.parameters()):
+            target_param.lerp_(param, tau)
 
 def hard_update(target, source):
     """
     Copies the parameters from source network to target network
-    :param target: Target network (PyTorch)
-    :param source: Source network (PyTorch)
+    :param target: Target network (PyTorch) or its FlatParameters
+    :param source: Source network (PyTorch) or its FlatParameters
     :return:
     """
+    if isinstance(target, FlatParameters):
+        target.hard_update(source)
+        return
     for target_param, param in zip(target.parameters(), source.parameters()):
         target_param.data.copy_(param.data)
 
@@ -92,19 +145,30 @@ def compact_timestamp():
 
 # Based on http://math.stackexchange.com/questions/1287634/implementing-ornstein-uhlenbeck-in-matlab
 class OrnsteinUhlenbeckActionNoise:
-    def __init__(self, action_dim, mu=0, theta=0.15, sigma=0.2):
+    """
+        With num_envs the process has the state [num_envs, action_dim], one independent
+        process for every environment of a vectorized environment.
+    """
+    def __init__(self, action_dim, mu=0, theta=0.15, sigma=0.2, num_envs=None):
         self.action_dim = action_dim
         self.mu = mu
         self.theta = theta
         self.sigma = sigma
-        self.X = np.ones(self.action_dim) * self.mu
+        self.shape = (action_dim,) if num_envs is None else (num_envs, action_dim)
+        self.X = np.ones(self.shape) * self.mu
 
-    def reset(self):
-        self.X = np.ones(self.action_dim) * self.mu
+    def reset(self, mask=None):
+        """
+        :param mask: Boolean mask of the environments whose processes are reset, all if None
+        """
+        if mask is None:
+            self.X = np.ones(self.shape) * self.mu
+        else:
+            self.X[np.asarray(mask, dtype=bool)] = self.mu
 
     def sample(self):
         dx = self.theta * (self.mu - self.X)
-        dx = dx + self.sigma * np.random.randn(len(self.X))
+        dx = dx + self.sigma * np.random.randn(*self.shape)
         self.X = self.X + dx
         return self.X
 